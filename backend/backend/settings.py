@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'sysrev.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -94,6 +95,17 @@ DATABASES = {
 }
 
 
+# Cache, used for per-review responses (sysrev/cache.py). The local-memory backend needs no
+# external service, use django.core.cache.backends.filebased.FileBasedCache to share it between processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pudu',
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -139,6 +151,33 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Request profiling (sysrev/profiling.py): Server-Timing headers and /api/_metrics. Off unless enabled here
+# or with SYSREV_PROFILING=1 in the production profile.
+SYSREV_PROFILING = False
+
+# Uploads and results of background import/export jobs (run with: manage.py run_jobs)
+JOB_FILES_ROOT = BASE_DIR / 'job_files'
+# manage.py prune_jobs removes the jobs that finished more than this ago, with their result files
+JOB_RETENTION = timedelta(days=7)
+# a running job without progress for this long is marked failed by the workers, its worker is assumed dead
+JOB_STALE_AFTER = timedelta(minutes=30)
+
+# Content-addressed PDF store (sysrev/blobs.py). With PDF_ACCEL_REDIRECT_PREFIX set, e.g. '/protected-pdfs/'
+# mapped to PDF_STORAGE_ROOT as an nginx internal location, the web server sends the files itself.
+PDF_STORAGE_ROOT = BASE_DIR / 'pdf_store'
+PDF_MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+PDF_ACCEL_REDIRECT_PREFIX = None
+# manage.py prune_pdfs removes the PDFs no study uses that were stored more than this ago
+PDF_BLOB_GRACE = timedelta(hours=1)
+
+# Review change feed (sysrev/changes.py): entries older than this are removed by manage.py prune_changes.
+# A change stream sends the pending changes and stays open for CHANGE_STREAM_DURATION seconds more, then
+# EventSource reconnects from the last change it received (Last-Event-ID). An open stream holds a worker,
+# so with sync workers (runserver, gunicorn's default) keep it at 0: each connection returns at once and the
+# browser polls every 2 s. Raise it only with threaded or async workers, e.g. gunicorn --threads or an ASGI server.
+CHANGE_FEED_RETENTION = timedelta(days=30)
+CHANGE_STREAM_DURATION = 0
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -0,0 +1,40 @@
+"""
+Production profile for running pudu on SQLite with several concurrent reviewers.
+
+Use it with DJANGO_SETTINGS_MODULE=backend.settings_production. It extends the base settings with:
+- WAL journal mode, so readers do not block the writer and the writer does not block readers
+- synchronous=NORMAL, safe with WAL and much cheaper than FULL
+- busy_timeout, so a writer waits for the lock instead of failing with "database is locked"
+- a larger page cache and memory mapped reads
+- BEGIN IMMEDIATE for write transactions, so a transaction takes the write lock up front instead
+  of failing when it upgrades from a read to a write while another writer is active
+- persistent connections with health checks, so requests do not open a new connection each time
+
+Load test the profile with: manage.py sqlite_write_load --writers 8
+"""
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+from sysrev.loadtest import SQLITE_PRAGMAS, SQLITE_TRANSACTION_MODE
+
+# New dicts, so importing this module does not change the base settings of the running process
+DATABASES = {
+    **DATABASES,
+    'default': {
+        **DATABASES['default'],
+        'CONN_MAX_AGE': int(os.environ.get('PUDU_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': '; '.join(SQLITE_PRAGMAS),
+            'transaction_mode': SQLITE_TRANSACTION_MODE,
+        },
+    },
+}
+
+DEBUG = os.environ.get('DJANGO_DEBUG', '') == '1'
+ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',')
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', SECRET_KEY)  # noqa: F405
+# seconds a change stream stays open, see settings.py; only raise it with threaded or async workers
+CHANGE_STREAM_DURATION = int(os.environ.get('PUDU_CHANGE_STREAM_DURATION', 0))
+SYSREV_PROFILING = os.environ.get('SYSREV_PROFILING', '') == '1'
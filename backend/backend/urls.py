@@ -16,7 +16,8 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from sysrev.views import TagTreeView, StudiesView, AuthorsView, SysRevView, tag_study_counts,flag_study_counts, ReviewExportView, ReviewImportView, RegisterView, ReviewCSVExportView
+from sysrev.views import TagTreeView, StudiesView, AuthorsView, SysRevView, tag_study_counts, tag_tree_study_counts, flag_study_counts, tag_analytics, ReviewChangesView, ReviewChangeStreamView, ReviewExportView, ReviewImportView, RegisterView, ReviewCSVExportView, StudySearchView, StudyDuplicatesView, StudyBulkView, StudyPdfView, JobView, JobResultView
+from sysrev.profiling import metrics_view
 from rest_framework.authtoken.views import obtain_auth_token
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
@@ -28,12 +29,20 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/reviews/', SysRevView.as_view(), name='review-list'),
     path('api/reviews/<int:review_id>/', SysRevView.as_view(), name='review-detail'),
+    path('api/reviews/<int:review_id>/changes/', ReviewChangesView.as_view(), name='review-changes'),
+    path('api/reviews/<int:review_id>/changes/stream/', ReviewChangeStreamView.as_view(), name='review-change-stream'),
     path('api/tags/', TagTreeView.as_view(), name='tag-tree'),
     path('api/tags/<int:tag_id>/', TagTreeView.as_view(), name='tag-detail'),
     path('api/studies/', StudiesView.as_view(), name='study-list'),
+    path('api/studies/search/', StudySearchView.as_view(), name='study-search'),
+    path('api/studies/duplicates/', StudyDuplicatesView.as_view(), name='study-duplicates'),
+    path('api/studies/bulk/', StudyBulkView.as_view(), name='study-bulk'),
     path('api/studies/<int:study_id>/', StudiesView.as_view(), name='study-detail'),
+    path('api/studies/<int:study_id>/pdf/', StudyPdfView.as_view(), name='study-pdf'),
     path('api/tags/count/', tag_study_counts, name='tag-study-counts'),
+    path('api/tags/count/tree/', tag_tree_study_counts, name='tag-tree-study-counts'),
     path('api/flags/count/', flag_study_counts, name='flag-study-counts'),
+    path('api/tags/analytics/', tag_analytics, name='tag-analytics'),
     path('api/authors/', AuthorsView.as_view(), name='author-list'),
     path('api/authors/<int:author_id>/', AuthorsView.as_view(), name='author-detail'),
     path('api/export/', ReviewExportView.as_view(), name='review-export'),
@@ -42,6 +51,10 @@ urlpatterns = [
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/register/', RegisterView.as_view(), name='register'),
     path('api/export_csv/', ReviewCSVExportView.as_view(), name='review-export-csv'),
+    path('api/jobs/', JobView.as_view(), name='job-list'),
+    path('api/jobs/<int:job_id>/', JobView.as_view(), name='job-detail'),
+    path('api/jobs/<int:job_id>/result/', JobResultView.as_view(), name='job-result'),
+    path('api/_metrics', metrics_view, name='metrics'),
 
 
 ]
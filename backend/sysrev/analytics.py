@@ -0,0 +1,220 @@
+'''
+Tag analytics of a review: tag coverage, tag co-occurrence, studies per year by tag and
+tag × flag cross-tabs.
+
+The study-tag incidence of the review is read in one query and every table is a matrix product:
+with A the studies × tags incidence (restricted to the top tags), co-occurrence is AᵀA and the
+year and flag tables are AᵀY and AᵀF, with Y and F the one-hot studies × years and studies × flags
+matrices. NumPy (in requirements.txt) is used when it is installed, otherwise the same tables are
+counted in Python, which gives the same results more slowly on large reviews.
+The tables are read in one transaction (a REPEATABLE READ snapshot on PostgreSQL), and rows of studies
+or tags missing from the study and tag lists, e.g. on databases without snapshots, are left out.
+'''
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from itertools import chain
+from django.db import connection, transaction
+from .models import Study, Tag, TagClosure
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+DEFAULT_TOP = 20
+MAX_TOP = 200
+
+INCIDENCE_SQL = '''
+    SELECT st.study_id, st.tag_id FROM sysrev_study_tags st
+    JOIN sysrev_study s ON s.id = st.study_id
+    WHERE s.review_id = %s
+'''
+
+
+@contextmanager
+def _snapshot():
+    '''A transaction whose reads all see the same state of the database.'''
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        # only possible as the first statement of the transaction, an enclosing one keeps its own level
+        if outermost and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        yield
+
+
+def tag_analytics(review_id, top=DEFAULT_TOP, include_descendants=False):
+    '''
+    Returns
+        study_count, tagged_count: studies of the review, and those with at least one tag
+        tags: every tag with the number and fraction (coverage) of studies tagged with it, most used first
+        cooccurrence: studies tagged with both tags, for the first top tags of tags (a top × top matrix)
+        years, tags_by_year: studies per year (known years only) for each of the first top tags
+        flags, tags_by_flag: studies per flag for each of the first top tags
+        year_totals, flag_totals: the same counts over all studies
+    '''
+    with _snapshot():
+        with connection.cursor() as cursor:
+            cursor.execute(INCIDENCE_SQL, [review_id])
+            incidence = cursor.fetchall()
+        # with include_descendants a study counts for every ancestor of its tags, as given by the closure table
+        closure = list(
+            TagClosure.objects.filter(descendant__review_id=review_id).values_list('descendant_id', 'ancestor_id')
+        ) if include_descendants else None
+        studies = Study.objects.filter(review_id=review_id)
+        years = list(studies.order_by('id').values_list('id', 'year'))
+        flag_rows = studies.flag_rows()
+        tags = list(Tag.objects.filter(review_id=review_id).order_by('id').values_list('id', 'name'))
+
+    tables = (_tables_numpy if np is not None else _tables_python)(
+        incidence, closure, years, flag_rows, [tag_id for tag_id, _ in tags], top,
+    )
+    names = dict(tags)
+    study_count = len(years)
+    tables['tags'] = [
+        {'id': tag_id, 'name': names[tag_id], 'count': count, 'coverage': round(count / study_count, 4) if study_count else 0.0}
+        for tag_id, count in tables['tags']
+    ]
+    return {'study_count': study_count, **tables}
+
+
+def _ranked(counts, tag_ids):
+    '''(tag id, count) of every tag, the most used first.'''
+    return sorted(((tag_id, counts.get(tag_id, 0)) for tag_id in tag_ids), key=lambda item: (-item[1], item[0]))
+
+
+def _tables_python(incidence, closure, years, flag_rows, tag_ids, top):
+    known_studies, known_tags = {study_id for study_id, _ in years}, set(tag_ids)
+    incidence = [(study_id, tag_id) for study_id, tag_id in incidence if study_id in known_studies and tag_id in known_tags]
+    flag_rows = [(study_id, flag) for study_id, flag in flag_rows if study_id in known_studies]
+    if closure is not None:
+        ancestors = defaultdict(list)
+        for descendant_id, ancestor_id in closure:
+            if ancestor_id in known_tags:
+                ancestors[descendant_id].append(ancestor_id)
+        incidence = {(study_id, ancestor_id) for study_id, tag_id in incidence for ancestor_id in ancestors[tag_id]}
+    ranked = _ranked(Counter(tag_id for _, tag_id in incidence), tag_ids)
+    top_index = {tag_id: index for index, (tag_id, _) in enumerate(ranked[:top])}
+    study_tags = defaultdict(list)
+    for study_id, tag_id in incidence:
+        if tag_id in top_index:
+            study_tags[study_id].append(top_index[tag_id])
+
+    study_years = {study_id: year for study_id, year in years if year is not None}
+    year_list = sorted(set(study_years.values()))
+    flag_list = sorted({flag for _, flag in flag_rows})
+    year_index = {year: index for index, year in enumerate(year_list)}
+    flag_index = {flag: index for index, flag in enumerate(flag_list)}
+
+    size = len(top_index)
+    cooccurrence = [[0] * size for _ in range(size)]
+    by_year = [[0] * len(year_list) for _ in range(size)]
+    by_flag = [[0] * len(flag_list) for _ in range(size)]
+    for study_id, indexes in study_tags.items():
+        year = study_years.get(study_id)
+        for i in indexes:
+            row = cooccurrence[i]
+            for j in indexes:
+                row[j] += 1
+            if year is not None:
+                by_year[i][year_index[year]] += 1
+    for study_id, flag in flag_rows:
+        for i in study_tags.get(study_id, ()):
+            by_flag[i][flag_index[flag]] += 1
+
+    year_totals = Counter(study_years.values())
+    flag_totals = Counter(flag for _, flag in flag_rows)
+    return {
+        'tagged_count': len({study_id for study_id, _ in incidence}),
+        'tags': ranked,
+        'cooccurrence': cooccurrence,
+        'years': year_list,
+        'tags_by_year': by_year,
+        'year_totals': [year_totals[year] for year in year_list],
+        'flags': flag_list,
+        'tags_by_flag': by_flag,
+        'flag_totals': [flag_totals[flag] for flag in flag_list],
+    }
+
+
+def _one_hot(rows, columns, shape):
+    matrix = np.zeros(shape, dtype=np.float32)
+    matrix[rows, columns] = 1
+    return matrix
+
+
+def _pairs(rows):
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)).reshape(-1, 2)
+
+
+def _positions(sorted_ids, ids):
+    '''Positions of ids in sorted_ids, and whether each id is in sorted_ids at all.'''
+    positions = np.searchsorted(sorted_ids, ids)
+    found = positions < len(sorted_ids)
+    found[found] = sorted_ids[positions[found]] == ids[found]
+    return positions, found
+
+
+def _expand_numpy(rows, columns, closure, all_tags):
+    '''Replaces every (study, tag) of the incidence by the (study, ancestor) of all the tag's ancestors, once each.'''
+    closure = _pairs(closure)
+    closure = closure[_positions(all_tags, closure[:, 0])[1] & _positions(all_tags, closure[:, 1])[1]]
+    closure = closure[np.argsort(closure[:, 0], kind='stable')]
+    descendants = np.searchsorted(all_tags, closure[:, 0])
+    starts = np.searchsorted(descendants, columns, side='left')
+    lengths = np.searchsorted(descendants, columns, side='right') - starts
+    # the closure rows starts[i]..starts[i] + lengths[i] of every incidence row i, concatenated
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ancestors = np.searchsorted(all_tags, closure[np.repeat(starts, lengths) + offsets, 1])
+    codes = np.unique(np.repeat(rows, lengths) * len(all_tags) + ancestors)
+    return codes // len(all_tags), codes % len(all_tags)
+
+
+def _tables_numpy(incidence, closure, years, flag_rows, tag_ids, top):
+    study_ids = np.fromiter((study_id for study_id, _ in years), dtype=np.int64, count=len(years))
+    all_tags = np.array(tag_ids, dtype=np.int64)
+    pairs = _pairs(incidence)
+    rows, known_studies = _positions(study_ids, pairs[:, 0])
+    columns, known_tags = _positions(all_tags, pairs[:, 1])
+    in_review = known_studies & known_tags
+    rows, columns = rows[in_review], columns[in_review]
+    if closure is not None:
+        rows, columns = _expand_numpy(rows, columns, closure, all_tags)
+
+    counts = np.bincount(columns, minlength=len(all_tags))
+    order = np.lexsort((all_tags, -counts))  # most used first, then by id
+    top_tags = order[:top]
+    top_position = np.full(len(all_tags), -1)
+    top_position[top_tags] = np.arange(len(top_tags))
+    in_top = top_position[columns] >= 0
+    # float32 products use BLAS and are exact for counts below 2**24
+    tagged = _one_hot(rows[in_top], top_position[columns[in_top]], (len(study_ids), len(top_tags)))
+
+    known = [(index, year) for index, (_, year) in enumerate(years) if year is not None]
+    year_list, year_columns = np.unique(np.array([year for _, year in known], dtype=np.int64), return_inverse=True)
+    by_year = _one_hot([index for index, _ in known], year_columns, (len(study_ids), len(year_list)))
+
+    flag_studies, known_flags = _positions(study_ids, np.array([study_id for study_id, _ in flag_rows], dtype=np.int64))
+    flag_rows = [row for row, known in zip(flag_rows, known_flags) if known]
+    flag_list = sorted({flag for _, flag in flag_rows})
+    flag_index = {flag: index for index, flag in enumerate(flag_list)}
+    by_flag = _one_hot(
+        flag_studies[known_flags],
+        [flag_index[flag] for _, flag in flag_rows],
+        (len(study_ids), len(flag_list)),
+    )
+
+    def table(matrix):
+        return np.rint(matrix).astype(np.int64).tolist()
+
+    return {
+        'tagged_count': int(np.unique(rows).size),
+        'tags': [(int(all_tags[index]), int(counts[index])) for index in order],
+        'cooccurrence': table(tagged.T @ tagged),
+        'years': year_list.tolist(),
+        'tags_by_year': table(tagged.T @ by_year),
+        'year_totals': table(by_year.sum(axis=0)),
+        'flags': flag_list,
+        'tags_by_flag': table(tagged.T @ by_flag),
+        'flag_totals': table(by_flag.sum(axis=0)),
+    }
@@ -0,0 +1,152 @@
+'''
+Content-addressed store for study PDFs.
+
+Every file is stored once under settings.PDF_STORAGE_ROOT, at a path derived from the SHA-256
+of its content (ab/cd/abcd...), so the same PDF attached to studies of different reviews takes
+the space of one. Uploads are written to a temporary file in chunks while they are hashed, then
+moved into place, so a file is never held in memory and a reader never sees a partial blob.
+Blobs no study uses any more, after a study delete or a PDF replace, are removed with their files
+by prune_blobs (manage.py prune_pdfs).
+'''
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
+from .models import PdfBlob
+
+CHUNK_SIZE = 64 * 1024
+PDF_MAGIC = b'%PDF-'
+
+
+class BlobError(ValueError):
+    '''Raised when an upload is not a valid PDF.'''
+
+
+def storage_root():
+    return Path(settings.PDF_STORAGE_ROOT)
+
+
+def blob_path(sha256):
+    return storage_root() / sha256[:2] / sha256[2:4] / sha256
+
+
+def store_pdf(stream, max_size=None):
+    '''
+    Reads a PDF from a file-like stream into the store and returns its PdfBlob,
+    the existing one if the same content was stored before.
+    '''
+    max_size = max_size or settings.PDF_MAX_UPLOAD_SIZE
+    tmp_dir = storage_root() / 'tmp'
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0 and not chunk.startswith(PDF_MAGIC[:len(chunk)]):
+                    raise BlobError('The file is not a PDF')
+                size += len(chunk)
+                if size > max_size:
+                    raise BlobError(f'The file is larger than {max_size} bytes')
+                digest.update(chunk)
+                tmp.write(chunk)
+            if size < len(PDF_MAGIC):
+                raise BlobError('The file is not a PDF')
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+
+    sha256 = digest.hexdigest()
+    path = blob_path(sha256)
+    if path.exists():
+        os.remove(tmp.name)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp.name, path)
+
+    try:
+        with transaction.atomic():
+            blob, _ = PdfBlob.objects.defer('text').get_or_create(sha256=sha256, defaults={'size': size})
+    except IntegrityError:
+        # stored concurrently by another upload of the same file
+        blob = PdfBlob.objects.defer('text').get(sha256=sha256)
+    return blob
+
+
+def prune_blobs(before=None):
+    '''
+    Removes the blobs no study uses, and their files. Only blobs stored before the given time,
+    by default settings.PDF_BLOB_GRACE ago, are removed, so an upload that has stored its blob but
+    not attached it to its study yet keeps it. Returns the number of blobs removed.
+    '''
+    if before is None:
+        before = now() - settings.PDF_BLOB_GRACE
+    unused = PdfBlob.objects.filter(created_at__lt=before, studies__isnull=True)
+    candidates = dict(unused.values_list('id', 'sha256'))
+    if not candidates:
+        return 0
+    with transaction.atomic():
+        # studies__isnull again, a study may have been given one of the blobs in the meantime
+        removed = PdfBlob.objects.filter(id__in=candidates, studies__isnull=True).delete()[1].get(PdfBlob._meta.label, 0)
+        kept = set(PdfBlob.objects.filter(id__in=candidates).values_list('sha256', flat=True))
+    for sha256 in set(candidates.values()) - kept:
+        try:
+            os.remove(blob_path(sha256))
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    '''
+    Parses a single range Range header into (start, end) inclusive offsets.
+    Returns None when the header is absent or not a single byte range (the whole file is sent),
+    and raises ValueError when the range cannot be satisfied.
+    '''
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # suffix range, the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+class FileRange:
+    '''A file-like view of bytes start..end of a file, streamed in chunks.'''
+    def __init__(self, file, start, end):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = end - start + 1
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,58 @@
+'''
+Per-review response cache.
+Every review has a version counter, bumped whenever its studies, tags or authors change
+(see sysrev/signals.py, bulk code paths bump it themselves). Cached responses are keyed on
+that version, so a change makes all cached views of the review stale at once, and the
+key doubles as an ETag for If-None-Match requests.
+'''
+import hashlib
+from functools import wraps
+from django.core.cache import cache
+from django.db.models import F
+from rest_framework.request import Request
+from rest_framework.response import Response
+from .models import Review
+
+CACHE_TIMEOUT = 60 * 60
+
+
+def bump_review_version(review_id):
+    Review.objects.filter(id=review_id).update(version=F('version') + 1)
+
+
+def get_review_version(review_id):
+    return Review.objects.filter(id=review_id).values_list('version', flat=True).first()
+
+
+def review_cached(view):
+    '''
+    Caches successful GET responses of a review scoped view (one taking ?review_id=).
+    Works on APIView methods and on @api_view functions.
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, Request))
+        review_id = request.query_params.get('review_id')
+        version = get_review_version(review_id) if review_id and review_id.isdigit() else None
+        if version is None:
+            return view(*args, **kwargs)
+
+        query = sorted(request.query_params.lists())
+        digest = hashlib.sha1(f'{request.path}:{query}'.encode()).hexdigest()
+        key = f'sysrev:review:{review_id}:v{version}:{digest}'
+        etag = f'"{review_id}-{version}-{digest}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=304, headers=headers)
+
+        data = cache.get(key)
+        if data is None:
+            response = view(*args, **kwargs)
+            if response.status_code != 200 or not isinstance(response, Response):
+                return response
+            cache.set(key, response.data, CACHE_TIMEOUT)
+            data = response.data
+        return Response(data, headers=headers)
+
+    return wrapper
@@ -0,0 +1,95 @@
+'''
+Change feed of a review, so clients apply what changed instead of downloading the review again.
+
+Every create, update or delete of a study, tag or author is logged as a ReviewChange, whose id is
+the sequence number of the feed: a client loads the review, remembers the head of the feed and
+then reads the changes after it (see ReviewChangesView). Logging a change also bumps the review
+version (sysrev/cache.py) in the same transaction. The version update locks the review row until
+the transaction commits, so the changes of a review become visible in sequence order and a reader
+that has seen a sequence number never misses a change below it.
+
+Logged by the signals in sysrev/signals.py, bulk code paths call record_changes themselves.
+Changes older than settings.CHANGE_FEED_RETENTION are removed by the prune_changes command,
+a reader behind them gets reset=True and must load the review again.
+'''
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.timezone import now
+from .cache import bump_review_version
+from .models import Review, ReviewChange
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 1000
+
+
+def record_changes(review_id, entity, object_ids, op):
+    '''Logs the same change of several objects of a review, and bumps the review version.'''
+    record(review_id, [(entity, object_id, op) for object_id in sorted(set(object_ids))])
+
+
+def record(review_id, entries):
+    '''
+    Logs (entity, object id, op) changes of a review in the given order, and bumps the review version.
+    The rows are inserted with a single executemany, however many objects changed.
+    '''
+    if not entries:
+        return
+    created_at = connection.ops.adapt_datetimefield_value(now())
+    with transaction.atomic(savepoint=False):
+        bump_review_version(review_id)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {ReviewChange._meta.db_table} (review_id, entity, object_id, op, created_at) VALUES (%s, %s, %s, %s, %s)',
+                [(review_id, entity, object_id, op, created_at) for entity, object_id, op in entries],
+            )
+
+
+def head(review):
+    '''The sequence number of the latest change of a review, the position of a client that has just loaded it.'''
+    latest = ReviewChange.objects.filter(review_id=review.id).aggregate(seq=Max('id'))['seq']
+    return max(latest or 0, review.changes_pruned_through)
+
+
+def read_changes(review, since, limit=DEFAULT_LIMIT):
+    '''
+    The changes of a review after the sequence number since, at most limit of them, as
+    (changes, seq, has_more): seq is the position to read from next.
+    Changes of the same object are merged into the last one, an update of an object created
+    in the same read stays a create. Returns None when changes after since were pruned.
+    '''
+    if since < review.changes_pruned_through:
+        return None
+    rows = list(
+        ReviewChange.objects.filter(review_id=review.id, id__gt=since).order_by('id')
+        .values_list('id', 'entity', 'object_id', 'op')[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    latest = {}
+    for seq, entity, object_id, op in rows:
+        previous = latest.pop((entity, object_id), None)
+        if previous is not None and previous['op'] == ReviewChange.CREATE and op == ReviewChange.UPDATE:
+            op = ReviewChange.CREATE
+        latest[(entity, object_id)] = {'seq': seq, 'entity': entity, 'id': object_id, 'op': op}
+    return list(latest.values()), rows[-1][0] if rows else since, has_more
+
+
+def prune(before=None):
+    '''
+    Removes the changes logged before the given time, by default settings.CHANGE_FEED_RETENTION ago.
+    Returns the number of changes removed.
+    '''
+    if before is None:
+        before = now() - settings.CHANGE_FEED_RETENTION
+    pruned = 0
+    last_ids = (
+        ReviewChange.objects.filter(created_at__lt=before)
+        .values('review_id').annotate(last_id=Max('id')).values_list('review_id', 'last_id')
+    )
+    for review_id, last_id in list(last_ids):
+        with transaction.atomic():
+            Review.objects.filter(id=review_id).update(changes_pruned_through=last_id)
+            pruned += ReviewChange.objects.filter(review_id=review_id, id__lte=last_id).delete()[0]
+    return pruned
@@ -0,0 +1,301 @@
+'''
+Near-duplicate detection, for the same paper imported into a review from several databases.
+
+Every study is indexed under a few keys (StudyDuplicateKey):
+- the LSH bands of a MinHash signature of its title (character 5-grams of the normalized title),
+- the LSH bands of a MinHash signature of the start of its abstract (word 3-grams),
+- its normalized DOI.
+Studies sharing a key are candidates, and only candidates are compared, by the exact Jaccard
+similarity of their shingles, so finding the duplicates of a review reads its keys once instead
+of comparing every pair of studies, and checking new studies only reads the keys they share.
+
+The signatures use one permutation hashing: each shingle is hashed once into one of
+SIGNATURE_SIZE bins and the minimum of every bin is kept, empty bins take the value of the next
+non-empty one. With BANDS bands of ROWS bins, studies with a title similarity of 0.8 share a
+band with probability 0.98, studies with a similarity of 0.3 with probability 0.06.
+
+Kept in sync by the Study signals in sysrev/signals.py, bulk paths call index_studies themselves.
+'''
+import re
+import string
+import unicodedata
+import zlib
+from bisect import bisect_left
+from collections import defaultdict
+from hashlib import blake2b
+from django.db import connection, transaction
+from django.db.models import Count
+from .models import Study, StudyDuplicateKey
+
+BANDS = 8
+ROWS = 4
+SIGNATURE_SIZE = BANDS * ROWS
+TITLE_SHINGLE_CHARS = 5
+ABSTRACT_WORDS = 100
+
+DEFAULT_THRESHOLD = 0.8
+DUPLICATE_FLAG = 'Possible Duplicate'
+BATCH_SIZE = 500
+MAX_REPRESENTATIVES = 50
+
+_MASK = (1 << 64) - 1
+# SIGNATURE_SIZE is a power of two, the top bits of a 64 bit hash select its bin
+_BIN_SHIFT = 64 - (SIGNATURE_SIZE.bit_length() - 1)
+_DOI_PREFIX_RE = re.compile(r'^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)', re.IGNORECASE)
+_ACCENT_RE = re.compile(r'[\u0300-\u036f]')
+_SEPARATOR_RE = re.compile(r'[\W_]+')
+_ASCII_PUNCTUATION = str.maketrans(dict.fromkeys(string.punctuation, ' '))
+
+
+def normalize_text(text):
+    '''Lowercase words without accents or punctuation, separated by single spaces.'''
+    text = (text or '').casefold()
+    if text.isascii():
+        # the common case, several times faster than the regular expression
+        return ' '.join(text.translate(_ASCII_PUNCTUATION).split())
+    text = _ACCENT_RE.sub('', unicodedata.normalize('NFKD', text))
+    return _SEPARATOR_RE.sub(' ', text).strip()
+
+
+def normalize_doi(doi):
+    return _DOI_PREFIX_RE.sub('', (doi or '').strip()).lower()
+
+
+# Shingles are kept as 32 bit hashes, word n-grams combine the hashes of their words
+def title_shingles(title):
+    text = normalize_text(title).encode()
+    if len(text) <= TITLE_SHINGLE_CHARS:
+        return {zlib.crc32(text)} if text else set()
+    return {zlib.crc32(text[i:i + TITLE_SHINGLE_CHARS]) for i in range(len(text) - TITLE_SHINGLE_CHARS + 1)}
+
+
+def abstract_shingles(abstract):
+    '''Word 3-grams of the first ABSTRACT_WORDS words, which are enough to tell abstracts apart.'''
+    head = ' '.join((abstract or '').split(None, ABSTRACT_WORDS)[:ABSTRACT_WORDS])
+    words = [zlib.crc32(word.encode()) for word in normalize_text(head).split()[:ABSTRACT_WORDS]]
+    if 0 < len(words) < 3:
+        words += [0] * (3 - len(words))
+    return {
+        ((first * 0x01000193 ^ second) * 0x01000193 ^ third) & 0xFFFFFFFF
+        for first, second, third in zip(words, words[1:], words[2:])
+    }
+
+
+def signature(shingles):
+    '''
+    One permutation MinHash signature of a non-empty set of shingles. The bin of a hash is given
+    by its top bits, so once the hashes are sorted the minimum of each bin is found by bisection.
+    '''
+    values = sorted((shingle * 0x9E3779B97F4A7C15) & _MASK for shingle in shingles)
+    bins = []
+    for index in range(SIGNATURE_SIZE):
+        position = bisect_left(values, index << _BIN_SHIFT)
+        if position < len(values) and values[position] >> _BIN_SHIFT == index:
+            bins.append(values[position])
+        else:
+            bins.append(None)
+    filled = [i for i, value in enumerate(bins) if value is not None]
+    result = []
+    for i, value in enumerate(bins):
+        if value is None:
+            # the next non-empty bin, and how far it is, so different gaps give different values
+            source = next((j for j in filled if j > i), filled[0])
+            value = (bins[source] << 6) | ((source - i) % SIGNATURE_SIZE)
+        result.append(value)
+    return result
+
+
+def _key(*parts):
+    return int.from_bytes(blake2b(repr(parts).encode(), digest_size=8).digest(), 'big', signed=True)
+
+
+def study_keys(title, abstract, doi):
+    '''The index keys of a study.'''
+    keys = []
+    for field, shingles in (('title', title_shingles(title)), ('abstract', abstract_shingles(abstract))):
+        if shingles:
+            values = signature(shingles)
+            keys.extend(_key(field, band, *values[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS))
+    doi = normalize_doi(doi)
+    if doi:
+        keys.append(_key('doi', doi))
+    return keys
+
+
+def _insert_keys(rows):
+    '''
+    Inserts the keys of the studies given as (id, review_id, title, abstract, doi) rows,
+    with a single executemany as there are a few keys per study.
+    '''
+    keys = [
+        (study_id, review_id, key)
+        for study_id, review_id, title, abstract, doi in rows
+        for key in set(study_keys(title, abstract, doi))
+    ]
+    if keys:
+        with connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {StudyDuplicateKey._meta.db_table} (study_id, review_id, key) VALUES (%s, %s, %s)', keys)
+
+
+def _index_rows(rows):
+    rows = list(rows)
+    StudyDuplicateKey.objects.filter(study_id__in=[row[0] for row in rows]).delete()
+    _insert_keys(rows)
+
+
+def index_study(study):
+    _index_rows([(study.id, study.review_id, study.title, study.abstract, study.doi)])
+
+
+def add_studies(studies):
+    '''Indexes new studies from their instances, without reading them back.'''
+    _insert_keys((study.id, study.review_id, study.title, study.abstract, study.doi) for study in studies)
+
+
+def index_studies(study_ids):
+    '''Adds or refreshes the given studies in the index.'''
+    study_ids = list(study_ids)
+    for start in range(0, len(study_ids), BATCH_SIZE):
+        _index_rows(Study.objects.filter(id__in=study_ids[start:start + BATCH_SIZE])
+                    .values_list('id', 'review_id', 'title', 'abstract', 'doi'))
+
+
+def rebuild(review_id):
+    '''Rebuilds the index of a review.'''
+    with transaction.atomic():
+        StudyDuplicateKey.objects.filter(review_id=review_id).delete()
+        rows = Study.objects.filter(review_id=review_id).order_by('id').values_list('id', 'review_id', 'title', 'abstract', 'doi')
+        last_id = 0
+        while True:
+            batch = list(rows.filter(id__gt=last_id)[:BATCH_SIZE * 4])
+            if not batch:
+                break
+            _insert_keys(batch)
+            last_id = batch[-1][0]
+
+
+class _Candidate:
+    __slots__ = ('title', 'numbers', 'abstract', 'doi')
+
+    def __init__(self, title, abstract, doi):
+        self.title = title_shingles(title)
+        self.numbers = set(re.findall(r'\d+', normalize_text(title)))
+        self.abstract = abstract_shingles(abstract)
+        self.doi = normalize_doi(doi)
+
+
+def _jaccard(a, b, at_least=0.0):
+    '''Jaccard similarity of two sets, or 0 when it cannot be above at_least.'''
+    if not a or not b or min(len(a), len(b)) <= at_least * max(len(a), len(b)):
+        return 0.0
+    common = len(a & b)
+    return common / (len(a) + len(b) - common)
+
+
+def similarity(a, b):
+    '''
+    1 for the same DOI, otherwise the larger of the title and abstract similarities.
+    Titles with different numbers ("Part 1" and "Part 2", trial phases) are never similar.
+    '''
+    if a.doi and a.doi == b.doi:
+        return 1.0
+    title = _jaccard(a.title, b.title) if a.numbers == b.numbers else 0.0
+    return max(title, _jaccard(a.abstract, b.abstract, at_least=title))
+
+
+def find_duplicates(review_id, study_ids=None, threshold=DEFAULT_THRESHOLD):
+    '''
+    Clusters of likely duplicate studies of a review, as a list of
+    {'study_ids': [...], 'similarity': lowest similarity of the links of the cluster}.
+    With study_ids, only the duplicates of those studies are looked for.
+
+    Within a bucket of studies sharing a key, each study is compared with the first study of the
+    first MAX_REPRESENTATIVES clusters found in the bucket, which keeps large buckets linear, both
+    of identical studies and of merely similar ones (titles differing by a number); duplicates
+    missed in such a bucket usually share a smaller one too.
+    '''
+    keys = StudyDuplicateKey.objects.filter(review_id=review_id)
+    if study_ids is None:
+        rows = keys.filter(key__in=keys.values('key').annotate(n=Count('id')).filter(n__gt=1).values('key'))
+        batches = [rows.values_list('key', 'study_id')]
+    else:
+        study_ids = sorted(set(study_ids))
+        batches = [
+            keys.filter(key__in=keys.filter(study_id__in=study_ids[start:start + BATCH_SIZE]).values('key'))
+            .values_list('key', 'study_id')
+            for start in range(0, len(study_ids), BATCH_SIZE)
+        ]
+    buckets = defaultdict(set)
+    for batch in batches:
+        for key, study_id in batch:
+            buckets[key].add(study_id)
+    buckets = [sorted(members) for members in buckets.values() if len(members) > 1]
+    if not buckets:
+        return []
+
+    candidate_ids = sorted({study_id for members in buckets for study_id in members})
+    candidates = {}
+    for start in range(0, len(candidate_ids), BATCH_SIZE):
+        for study_id, title, abstract, doi in Study.objects.filter(
+            id__in=candidate_ids[start:start + BATCH_SIZE]
+        ).values_list('id', 'title', 'abstract', 'doi'):
+            candidates[study_id] = _Candidate(title, abstract, doi)
+
+    parent = {}
+    link_similarity = {}
+
+    def find(study_id):
+        root = parent.setdefault(study_id, study_id)
+        while root != parent[root]:
+            root = parent[root]
+        while parent[study_id] != root:
+            parent[study_id], study_id = root, parent[study_id]
+        return root
+
+    compared = {}
+    wanted = set(study_ids) if study_ids is not None else None
+    for members in buckets:
+        representatives = []
+        for study_id in members:
+            for representative in representatives:
+                if wanted is not None and study_id not in wanted and representative not in wanted:
+                    continue
+                pair = (representative, study_id)
+                if pair not in compared:
+                    compared[pair] = similarity(candidates[representative], candidates[study_id])
+                if compared[pair] >= threshold:
+                    a, b = find(representative), find(study_id)
+                    if a != b:
+                        parent[b] = a
+                        link_similarity[a] = min(compared[pair], link_similarity.get(a, 1.0), link_similarity.get(b, 1.0))
+                    break
+            else:
+                if len(representatives) < MAX_REPRESENTATIVES:
+                    representatives.append(study_id)
+
+    clusters = defaultdict(list)
+    for study_id in parent:
+        clusters[find(study_id)].append(study_id)
+    return sorted(
+        ({'study_ids': sorted(members), 'similarity': round(link_similarity[root], 3)}
+         for root, members in clusters.items() if len(members) > 1),
+        key=lambda cluster: (-len(cluster['study_ids']), cluster['study_ids'][0]),
+    )
+
+
+def flag_duplicates(review_id, study_ids, threshold=DEFAULT_THRESHOLD):
+    '''
+    Adds DUPLICATE_FLAG to the given studies that duplicate an older study (one with a lower id).
+    Returns the number of studies flagged.
+    '''
+    duplicate_ids = [
+        study_id
+        for cluster in find_duplicates(review_id, study_ids, threshold)
+        for study_id in cluster['study_ids'][1:]
+    ]
+    wanted = set(study_ids)
+    duplicate_ids = [study_id for study_id in duplicate_ids if study_id in wanted]
+    return sum(
+        Study.objects.filter(id__in=duplicate_ids[start:start + BATCH_SIZE]).add_flags([DUPLICATE_FLAG])
+        for start in range(0, len(duplicate_ids), BATCH_SIZE)
+    )
@@ -0,0 +1,173 @@
+'''
+Streaming review exporters.
+Studies are read with chunked iterator() querysets and written out as they are read,
+so memory use does not depend on the size of the review.
+'''
+import csv
+import json
+import zlib
+from django.db.models import Prefetch
+from .models import Tag, Study, Author
+
+CHUNK_SIZE = 1000
+# size of the pieces handed to the server, in characters
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+def dumps(value):
+    '''JSON encoding matching the output of the DRF JSON renderer.'''
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def export_studies(review_id, tags=True, authors=True, defer=(), progress=None):
+    '''
+    Iterates the studies of a review with their tags and authors prefetched per chunk.
+    progress, if given, is called with the number of studies read after every chunk.
+    '''
+    lookups = []
+    if tags:
+        lookups.append(Prefetch('tags', queryset=_in_added_order(Tag.objects.only('id', 'name'), Study.tags)))
+    if authors:
+        lookups.append(Prefetch('authors', queryset=_in_added_order(Author.objects.only('id', 'name'), Study.authors)))
+    studies = Study.objects.filter(review_id=review_id).order_by('id').defer(*defer)
+    studies = studies.prefetch_related(*lookups).iterator(chunk_size=CHUNK_SIZE)
+    return studies if progress is None else _counted(studies, progress)
+
+
+def _in_added_order(queryset, relation):
+    '''
+    Orders the prefetched tags or authors of a study by the id of their relation row, i.e. in the
+    order they were added, which the import keeps, so an export imports back in the same order.
+    '''
+    return queryset.extra(order_by=[f'{relation.through._meta.db_table}.id'])
+
+
+def _counted(studies, progress):
+    count = 0
+    for study in studies:
+        yield study
+        count += 1
+        if count % CHUNK_SIZE == 0:
+            progress(count)
+    progress(count)
+
+
+def study_to_dict(study):
+    return {
+        "title": study.title,
+        "year": study.year,
+        "summary": study.summary,
+        "abstract": study.abstract,
+        "flags": study.flags,
+        "tags": [tag.name for tag in study.tags.all()],
+        "authors": [author.name for author in study.authors.all()],
+        "doi": study.doi,
+        "url": study.url,
+        "pages": study.pages
+    }
+
+
+def buffered(pieces, size=WRITE_BUFFER_SIZE):
+    '''Joins small string pieces into larger writes.'''
+    buffer = []
+    length = 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _json_pieces(review_id, progress):
+    yield '{"tag_tree":'
+    yield dumps(Tag.build_tree(review_id, with_ids=False))
+
+    yield ',"authors":['
+    authors = Author.objects.filter(review_id=review_id).order_by('id').values('name').iterator(chunk_size=CHUNK_SIZE)
+    for i, author in enumerate(authors):
+        yield (',' if i else '') + dumps(author)
+
+    yield '],"studies":['
+    for i, study in enumerate(export_studies(review_id, progress=progress)):
+        yield (',' if i else '') + dumps(study_to_dict(study))
+    yield ']}'
+
+
+def _ndjson_pieces(review_id, progress):
+    yield dumps({"type": "tag_tree", "tag_tree": Tag.build_tree(review_id, with_ids=False)}) + '\n'
+    authors = Author.objects.filter(review_id=review_id).order_by('id').values('name').iterator(chunk_size=CHUNK_SIZE)
+    for author in authors:
+        yield dumps({"type": "author", **author}) + '\n'
+    for study in export_studies(review_id, progress=progress):
+        yield dumps({"type": "study", **study_to_dict(study)}) + '\n'
+
+
+def iter_review_ndjson(review_id, progress=None):
+    '''The review export as newline delimited JSON, one tag tree, author or study per line.'''
+    return buffered(_ndjson_pieces(review_id, progress))
+
+
+def iter_review_json(review_id, progress=None):
+    '''The review export as JSON text chunks, in the format accepted by ReviewImportView.'''
+    return buffered(_json_pieces(review_id, progress))
+
+
+# CSV columns: key -> (header, value of a study)
+CSV_COLUMNS = {
+    'title': ('Title', lambda study: study.title),
+    'year': ('Year', lambda study: study.year),
+    'summary': ('Summary', lambda study: study.summary),
+    'abstract': ('Abstract', lambda study: study.abstract),
+    'flags': ('Flags', lambda study: ", ".join(study.flags)),
+    'tags': ('Tags', lambda study: ", ".join(tag.name for tag in study.tags.all())),
+    'authors': ('Authors', lambda study: ", ".join(author.name for author in study.authors.all())),
+    'doi': ('DOI', lambda study: study.doi),
+    'url': ('URL', lambda study: study.url),
+    'pages': ('Pages', lambda study: study.pages),
+}
+
+
+class Echo:
+    '''Pseudo-buffer for csv.writer, write() returns the row instead of storing it.'''
+    def write(self, value):
+        return value
+
+
+def gzipped(chunks):
+    '''Gzip-compresses text chunks on the fly.'''
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _csv_pieces(review_id, columns, progress):
+    writer = csv.writer(Echo())
+    yield writer.writerow([CSV_COLUMNS[column][0] for column in columns])
+
+    studies = export_studies(
+        review_id,
+        tags='tags' in columns,
+        authors='authors' in columns,
+        defer=[name for name in ('summary', 'abstract') if name not in columns],
+        progress=progress,
+    )
+    getters = [CSV_COLUMNS[column][1] for column in columns]
+    for study in studies:
+        yield writer.writerow([get(study) for get in getters])
+
+
+def iter_review_csv(review_id, columns=None, compress=False, progress=None):
+    '''
+    The studies of a review as CSV chunks.
+    columns selects and orders the CSV_COLUMNS keys to write (default: all of them),
+    compress=True yields gzip-compressed bytes.
+    '''
+    chunks = buffered(_csv_pieces(review_id, columns or list(CSV_COLUMNS), progress))
+    return gzipped(chunks) if compress else chunks
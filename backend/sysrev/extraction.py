@@ -0,0 +1,119 @@
+'''
+Background extraction of the text of study PDFs.
+
+The text, page count and metadata of a PDF are extracted once per file (PdfBlob, keyed by the
+SHA-256 of its content) in a pool of worker processes, then used to fill in the empty abstract,
+doi, year and pages of every study with that PDF and to add the body text to the search index.
+Attaching a PDF queues a Job.EXTRACT_PDF job, run by the run_jobs worker; the extract_pdfs
+command reprocesses a whole review.
+'''
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from django.db import transaction
+from django.utils.timezone import now
+from . import search, dedupe
+from .blobs import blob_path
+from .cache import bump_review_version
+from .changes import record_changes
+from .models import PdfBlob, Study, Job, ReviewChange
+from .pdftext import extract_file
+
+BATCH_SIZE = 100
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def extract_blobs(blob_ids, workers=None, force=False, progress=None):
+    '''
+    Extracts the PDFs not extracted yet (all of them with force=True) in parallel.
+    progress, if given, is called with the number of files done after every batch.
+    Returns the ids of the blobs processed.
+    '''
+    blobs = PdfBlob.objects.filter(id__in=blob_ids)
+    if not force:
+        blobs = blobs.filter(extracted_at__isnull=True)
+    blobs = list(blobs.only('id', 'sha256').order_by('id'))
+    if not blobs:
+        return []
+
+    workers = min(workers or default_workers(), len(blobs))
+    paths = [str(blob_path(blob.sha256)) for blob in blobs]
+    # spawned workers do not inherit the database connections of this process
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) if workers > 1 else None
+    try:
+        results = pool.map(extract_file, paths, chunksize=4) if pool else map(extract_file, paths)
+        batch = []
+        for done, (blob, result) in enumerate(zip(blobs, results), 1):
+            blob.extracted_at = now()
+            blob.extraction_error = result.get('error', '')
+            blob.text = result.get('text', '')
+            blob.page_count = result.get('page_count')
+            blob.metadata = {name: result.get(name) for name in ('doi', 'year', 'abstract') if result.get(name)}
+            batch.append(blob)
+            if len(batch) == BATCH_SIZE or done == len(blobs):
+                PdfBlob.objects.bulk_update(batch, ['extracted_at', 'extraction_error', 'text', 'page_count', 'metadata'])
+                batch = []
+                if progress is not None:
+                    progress(done)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return [blob.id for blob in blobs]
+
+
+def apply_to_studies(studies):
+    '''
+    Fills in the empty abstract, doi, year and pages of the studies from their extracted PDF,
+    reindexes them and logs the changed ones (bulk_update sends no signals).
+    '''
+    studies = list(
+        studies.filter(pdf__extracted_at__isnull=False)
+        .select_related('pdf').only('id', 'review_id', 'abstract', 'doi', 'year', 'pages', 'pdf__metadata', 'pdf__page_count')
+    )
+    changed = []
+    for study in studies:
+        metadata = study.pdf.metadata
+        updated = False
+        for name in ('abstract', 'doi', 'year'):
+            if not getattr(study, name) and metadata.get(name):
+                setattr(study, name, metadata[name])
+                updated = True
+        if not study.pages and study.pdf.page_count:
+            study.pages = str(study.pdf.page_count)
+            updated = True
+        if updated:
+            changed.append(study)
+
+    with transaction.atomic():
+        Study.objects.bulk_update(changed, ['abstract', 'doi', 'year', 'pages'], batch_size=BATCH_SIZE)
+        search.index_studies([study.id for study in studies])
+        dedupe.index_studies([study.id for study in changed])
+        for review_id in {study.review_id for study in studies}:
+            changed_ids = [study.id for study in changed if study.review_id == review_id]
+            if changed_ids:
+                record_changes(review_id, ReviewChange.STUDY, changed_ids, ReviewChange.UPDATE)
+            else:
+                # the body text still changes the search results
+                bump_review_version(review_id)
+    return len(changed)
+
+
+def process_studies(studies, workers=None, force=False, progress=None):
+    '''Extracts the PDFs of the studies and applies the results, also to other studies sharing the files.'''
+    blob_ids = extract_blobs(
+        studies.exclude(pdf=None).values_list('pdf_id', flat=True).distinct(),
+        workers=workers, force=force, progress=progress,
+    )
+    apply_to_studies(studies.exclude(pdf=None) | Study.objects.filter(pdf_id__in=blob_ids))
+    return len(blob_ids)
+
+
+def enqueue_extraction(study):
+    '''Queues the extraction of a study's PDF, or applies the cached result right away.'''
+    if study.pdf.extracted_at is not None:
+        apply_to_studies(Study.objects.filter(id=study.id))
+        return None
+    return Job.objects.create(kind=Job.EXTRACT_PDF, review_id=study.review_id, options={'study_ids': [study.id]})
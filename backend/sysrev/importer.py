@@ -0,0 +1,304 @@
+'''
+Bulk import of review exports (the format produced by ReviewExportView).
+
+Tags and authors are matched by name, studies by (title, year) like the previous get_or_create
+based import, but every phase runs a constant number of bulk queries per batch.
+Imported studies that are near-duplicates of studies already in the review (same DOI, or a
+similar title or abstract, see sysrev/dedupe.py) are kept and flagged as 'Possible Duplicate'.
+'''
+import time
+from collections import Counter
+from contextlib import contextmanager
+from django.db import transaction
+from . import search, dedupe
+from . import changes
+from .models import Tag, TagClosure, Study, Author, ReviewChange
+
+BATCH_SIZE = 500
+
+# study fields that can be set from an imported study
+STUDY_FIELDS = ['title', 'year', 'summary', 'abstract', 'flags', 'doi', 'url', 'pages', 'pathto_pdf']
+
+
+class ReviewImportError(ValueError):
+    '''Raised when the imported data is malformed.'''
+
+
+def _clean_name(value, what):
+    if not isinstance(value, str):
+        raise ReviewImportError(f'{what} name must be a string')
+    return value.strip()
+
+
+def _clean_year(value):
+    '''The year as an integer, so "2020" matches the study of 2020 instead of creating another one.'''
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ReviewImportError('Study year must be an integer')
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        raise ReviewImportError('Study year must be an integer')
+
+
+class ReviewImporter:
+    '''
+    Imports tag trees, authors and studies into a review.
+    Each import_* method can be called several times, e.g. once per batch of studies.
+    Timings (ms) and row counts per phase are collected in report().
+    progress, if given, is called with (phase, studies imported so far) whenever a phase starts.
+    '''
+    def __init__(self, review_id, progress=None):
+        self.review_id = int(review_id)
+        self.progress = progress
+        self.timings = Counter()
+        self.counts = Counter()
+        self.imported_study_ids = set()
+        self.created_study_ids = set()
+        self.created_author_ids = set()
+        self._tag_index = None
+        self._author_index = None
+
+    @contextmanager
+    def phase(self, name):
+        if self.progress is not None:
+            self.progress(name, self.counts['studies_created'] + self.counts['studies_updated'])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += (time.perf_counter() - start) * 1000
+
+    def report(self):
+        return {
+            'timings': {name: round(ms, 2) for name, ms in self.timings.items()},
+            'counts': dict(self.counts),
+        }
+
+    # Tags
+
+    def import_tag_tree(self, tree):
+        '''Creates the missing tags of a tag tree, one bulk insert per tree level.'''
+        with self.phase('tags'):
+            existing = {
+                (name, parent_id): tag_id
+                for tag_id, name, parent_id in Tag.objects.filter(review_id=self.review_id)
+                .order_by('id').values_list('id', 'name', 'parent_tag_id')
+            }
+
+            level = [(node, None) for node in tree]
+            created_tag_ids = []
+            while level:
+                new_tags = []
+                resolved = []
+                for node, parent_id in level:
+                    if not isinstance(node, dict):
+                        raise ReviewImportError('tag_tree nodes must be objects')
+                    name = _clean_name(node.get('name'), 'Tag')
+                    key = (name, parent_id)
+                    if key not in existing:
+                        tag = Tag(
+                            name=name,
+                            description=(node.get('description') or '').strip(),
+                            parent_tag_id=parent_id,
+                            review_id=self.review_id,
+                        )
+                        new_tags.append(tag)
+                        existing[key] = tag
+                    resolved.append((node, key))
+
+                Tag.objects.bulk_create(new_tags, batch_size=BATCH_SIZE)
+                TagClosure.add_tags(tag.id for tag in new_tags)
+                created_tag_ids.extend(tag.id for tag in new_tags)
+                self.counts['tags_created'] += len(new_tags)
+                for tag in new_tags:
+                    existing[(tag.name, tag.parent_tag_id)] = tag.id
+
+                level = [
+                    (child, existing[key])
+                    for node, key in resolved
+                    for child in node.get('children') or []
+                ]
+            changes.record_changes(self.review_id, ReviewChange.TAG, created_tag_ids, ReviewChange.CREATE)
+            self._tag_index = None
+
+    @property
+    def tag_index(self):
+        '''Tag name -> id of the first tag with that name in the review.'''
+        if self._tag_index is None:
+            self._tag_index = {}
+            for tag_id, name in Tag.objects.filter(review_id=self.review_id).order_by('id').values_list('id', 'name'):
+                self._tag_index.setdefault(name, tag_id)
+        return self._tag_index
+
+    # Authors
+
+    def import_authors(self, authors):
+        '''Creates the authors that do not exist in the review yet.'''
+        with self.phase('authors'):
+            if any(not isinstance(author, dict) for author in authors):
+                raise ReviewImportError('authors must be objects')
+            # dict keeps the order of the import, the ids of the new authors follow it
+            names = dict.fromkeys(_clean_name(author.get('name'), 'Author') for author in authors)
+            missing = [name for name in names if name not in self.author_index]
+            Author.objects.bulk_create(
+                [Author(name=name, review_id=self.review_id) for name in missing],
+                batch_size=BATCH_SIZE,
+                ignore_conflicts=True,
+            )
+            self.counts['authors_created'] += len(missing)
+            if missing:
+                # ignore_conflicts leaves the ids of the new authors unset, they are read back with the index
+                self._author_index = None
+                self.created_author_ids.update(self.author_index[name] for name in missing)
+
+    @property
+    def author_index(self):
+        '''Author name -> id.'''
+        if self._author_index is None:
+            self._author_index = dict(
+                Author.objects.filter(review_id=self.review_id).values_list('name', 'id')
+            )
+        return self._author_index
+
+    # Studies
+
+    def import_studies(self, studies):
+        '''
+        Creates or updates studies and replaces their tags and authors.
+        Studies are matched by (title, year), a later study with the same key overrides an earlier one.
+        '''
+        studies = list(studies)
+        for start in range(0, len(studies), BATCH_SIZE):
+            self._import_study_batch(studies[start:start + BATCH_SIZE])
+
+    def _import_study_batch(self, studies):
+        with self.phase('studies'):
+            by_key = {}
+            for data in studies:
+                if not isinstance(data, dict):
+                    raise ReviewImportError('studies must be objects')
+                fields = {name: data[name] for name in STUDY_FIELDS if name in data}
+                fields['title'] = _clean_name(data.get('title', ''), 'Study')
+                if 'year' in fields:
+                    fields['year'] = _clean_year(fields['year'])
+                by_key[(fields['title'], fields.get('year'))] = (fields, data.get('tags') or [], data.get('authors') or [])
+
+            existing = {
+                (study.title, study.year): study
+                for study in Study.objects.filter(review_id=self.review_id, title__in={title for title, _ in by_key})
+            }
+            new_studies, updated_studies = [], []
+            updated_fields = set()
+            for key, (fields, _, _) in by_key.items():
+                study = existing.get(key)
+                if study is None:
+                    study = existing[key] = Study(review_id=self.review_id, **fields)
+                    new_studies.append(study)
+                else:
+                    for name, value in fields.items():
+                        setattr(study, name, value)
+                    updated_studies.append(study)
+                    updated_fields.update(fields)
+
+            Study.objects.bulk_create(new_studies)
+            if updated_studies:
+                Study.objects.bulk_update(updated_studies, sorted(updated_fields))
+            self.counts['studies_created'] += len(new_studies)
+            self.counts['studies_updated'] += len(updated_studies)
+
+        with self.phase('relations'):
+            tag_rows, author_rows = [], []
+            for key, (_, tag_names, author_names) in by_key.items():
+                study_id = existing[key].id
+                # dicts keep the order of the import, the export lists relations in insertion order
+                tag_ids = dict.fromkeys(self.tag_index.get(_clean_name(name, 'Tag')) for name in tag_names)
+                author_ids = dict.fromkeys(self.author_index.get(_clean_name(name, 'Author')) for name in author_names)
+                tag_ids.pop(None, None)
+                author_ids.pop(None, None)
+                tag_rows.extend(Study.tags.through(study_id=study_id, tag_id=tag_id) for tag_id in tag_ids)
+                author_rows.extend(Study.authors.through(study_id=study_id, author_id=author_id) for author_id in author_ids)
+
+            # relations are replaced, like the previous tags.set() / authors.set()
+            if updated_studies:
+                updated_ids = [study.id for study in updated_studies]
+                Study.tags.through.objects.filter(study_id__in=updated_ids).delete()
+                Study.authors.through.objects.filter(study_id__in=updated_ids).delete()
+            Study.tags.through.objects.bulk_create(tag_rows, batch_size=BATCH_SIZE)
+            Study.authors.through.objects.bulk_create(author_rows, batch_size=BATCH_SIZE)
+            self.counts['study_tags'] += len(tag_rows)
+            self.counts['study_authors'] += len(author_rows)
+
+        self.imported_study_ids.update(existing[key].id for key in by_key)
+        self.created_study_ids.update(study.id for study in new_studies)
+
+    def finish(self):
+        '''
+        Updates the data derived from the studies imported since the last call and logs them and the
+        new authors in the change feed, bulk inserts send no signals, and flags the studies that are
+        likely duplicates of studies already in the review (see sysrev/dedupe.py).
+        '''
+        with self.phase('search_index'):
+            search.index_studies(self.imported_study_ids)
+        with self.phase('duplicates'):
+            dedupe.index_studies(self.imported_study_ids)
+            self.counts['possible_duplicates'] += dedupe.flag_duplicates(self.review_id, self.imported_study_ids)
+        changes.record(self.review_id, [
+            *((ReviewChange.AUTHOR, author_id, ReviewChange.CREATE) for author_id in sorted(self.created_author_ids)),
+            *((ReviewChange.STUDY, study_id, ReviewChange.CREATE) for study_id in sorted(self.created_study_ids)),
+            *((ReviewChange.STUDY, study_id, ReviewChange.UPDATE) for study_id in sorted(self.imported_study_ids - self.created_study_ids)),
+        ])
+        self.imported_study_ids = set()
+        self.created_study_ids = set()
+        self.created_author_ids = set()
+
+    def run(self, data):
+        '''Imports a whole export in one transaction and returns the report.'''
+        if not isinstance(data, dict):
+            raise ReviewImportError('The import must be a JSON object')
+        with transaction.atomic():
+            self.import_tag_tree(data.get('tag_tree') or [])
+            self.import_authors(data.get('authors') or [])
+            self.import_studies(data.get('studies') or [])
+            self.finish()
+        return self.report()
+
+    def run_stream(self, records, batch_size=BATCH_SIZE):
+        '''
+        Imports a stream of (kind, value) records, as produced by iter_review_records and iter_ndjson_records.
+        kind is 'tag_tree' (a list of root nodes), 'author' (an author object) or 'study' (a study object).
+        Authors and studies are committed in batches of batch_size, tag trees as they arrive,
+        so an interrupted import keeps the batches committed so far.
+        Tags and authors must come before the studies that reference them.
+        '''
+        authors, studies = [], []
+
+        def flush():
+            with transaction.atomic():
+                if authors:
+                    self.import_authors(authors)
+                if studies:
+                    self.import_studies(studies)
+                self.finish()
+            authors.clear()
+            studies.clear()
+            self.counts['batches'] += 1
+
+        for kind, value in records:
+            if kind == 'tag_tree':
+                if authors or studies:
+                    flush()
+                if not isinstance(value, list):
+                    raise ReviewImportError('tag_tree must be a list')
+                with transaction.atomic():
+                    self.import_tag_tree(value)
+            elif kind == 'author':
+                authors.append(value)
+            elif kind == 'study':
+                studies.append(value)
+            if len(authors) + len(studies) >= batch_size:
+                flush()
+        if authors or studies:
+            flush()
+        return self.report()
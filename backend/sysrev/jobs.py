@@ -0,0 +1,207 @@
+'''
+Database backed job queue for imports, exports and PDF text extraction.
+Views enqueue jobs, the run_jobs management command claims and runs them, no broker is needed.
+Job inputs and results are files under settings.JOB_FILES_ROOT, removed with the job by prune_jobs.
+'''
+import logging
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils.timezone import now
+from .models import Job, Study
+from .importer import ReviewImporter
+from .exporters import iter_review_json, iter_review_ndjson, iter_review_csv
+from .jsonstream import iter_review_records, iter_ndjson_records
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# uploads are stored here before their import job exists
+UPLOADS_DIR = 'uploads'
+
+
+def job_dir(job):
+    path = Path(settings.JOB_FILES_ROOT) / str(job.id)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def enqueue_import(review_id, stream, ndjson=False, batch_size=None):
+    '''
+    Saves the upload to disk in chunks and queues its import.
+    The job is only created once the upload is complete, a failed upload leaves neither a job nor a file.
+    '''
+    uploads = Path(settings.JOB_FILES_ROOT) / UPLOADS_DIR
+    uploads.mkdir(parents=True, exist_ok=True)
+    path = uploads / f"{uuid.uuid4().hex}.{'ndjson' if ndjson else 'json'}"
+    try:
+        with open(path, 'wb') as file:
+            shutil.copyfileobj(stream, file, UPLOAD_CHUNK_SIZE)
+        return Job.objects.create(
+            kind=Job.IMPORT, review_id=int(review_id), status=Job.QUEUED, input_path=str(path),
+            options={'ndjson': ndjson, 'batch_size': batch_size},
+        )
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+
+def enqueue_export(kind, review_id, **options):
+    return Job.objects.create(kind=kind, review_id=int(review_id), options=options)
+
+
+def update_progress(job, phase=None, rows=None):
+    fields = {'heartbeat_at': now()}
+    if phase is not None:
+        fields['phase'] = job.phase = phase
+    if rows is not None:
+        fields['rows_processed'] = job.rows_processed = rows
+    Job.objects.filter(id=job.id).update(**fields)
+
+
+def claim_next_job():
+    '''
+    Marks the oldest queued job as running and returns it, or None if the queue is empty.
+    The conditional update makes the claim safe with several workers.
+    '''
+    ready = Job.objects.filter(status=Job.QUEUED)
+    for job_id in ready.order_by('id').values_list('id', flat=True)[:10]:
+        if Job.objects.filter(id=job_id, status=Job.QUEUED).update(status=Job.RUNNING, started_at=now(), heartbeat_at=now()):
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def fail_stale_jobs():
+    '''
+    Marks as failed the running jobs without progress for settings.JOB_STALE_AFTER, whose worker
+    most likely died, so they do not look running forever. Returns the number of jobs failed.
+    '''
+    cutoff = now() - settings.JOB_STALE_AFTER
+    stale = Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at=None, started_at__lt=cutoff)
+    return Job.objects.filter(stale, status=Job.RUNNING).update(
+        status=Job.FAILED, error='The worker stopped while running the job', finished_at=now(),
+    )
+
+
+def _write_result(job, chunks, name, content_type):
+    path = job_dir(job) / name
+    with open(path, 'wb') as file:
+        for chunk in chunks:
+            file.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+    job.result_path = str(path)
+    job.result_name = name
+    job.result_content_type = content_type
+
+
+def _run_import(job):
+    importer = ReviewImporter(job.review_id, progress=lambda phase, rows: update_progress(job, phase, rows))
+    with open(job.input_path, 'rb') as file:
+        if job.options.get('ndjson'):
+            records = iter_ndjson_records(file)
+        else:
+            records = iter_review_records(file)
+        batch_size = job.options.get('batch_size')
+        job.report = importer.run_stream(records, **({'batch_size': batch_size} if batch_size else {}))
+    job.rows_processed = job.report['counts'].get('studies_created', 0) + job.report['counts'].get('studies_updated', 0)
+
+
+def _run_export(job):
+    progress = lambda rows: update_progress(job, rows=rows)
+    update_progress(job, phase='studies')
+    review_id = job.review_id
+    if job.kind == Job.EXPORT_CSV:
+        compress = job.options.get('compress', False)
+        chunks = iter_review_csv(review_id, columns=job.options.get('columns'), compress=compress, progress=progress)
+        if compress:
+            _write_result(job, chunks, f'review_{review_id}_export.csv.gz', 'application/gzip')
+        else:
+            _write_result(job, chunks, f'review_{review_id}_export.csv', 'text/csv')
+    elif job.options.get('ndjson'):
+        _write_result(job, iter_review_ndjson(review_id, progress=progress), f'review_{review_id}_export.ndjson', 'application/x-ndjson')
+    else:
+        _write_result(job, iter_review_json(review_id, progress=progress), f'review_{review_id}_export.json', 'application/json')
+
+
+def _run_extraction(job):
+    from .extraction import process_studies
+
+    studies = Study.objects.filter(review_id=job.review_id)
+    if job.options.get('study_ids') is not None:
+        studies = studies.filter(id__in=job.options['study_ids'])
+    update_progress(job, phase='extracting')
+    extracted = process_studies(
+        studies, workers=job.options.get('workers'), force=job.options.get('force', False),
+        progress=lambda rows: update_progress(job, rows=rows),
+    )
+    job.rows_processed = extracted
+    job.report = {'counts': {'pdfs_extracted': extracted}}
+
+
+def run_job(job):
+    '''Runs a claimed job and records its outcome.'''
+    try:
+        if job.kind == Job.IMPORT:
+            _run_import(job)
+        elif job.kind == Job.EXTRACT_PDF:
+            _run_extraction(job)
+        else:
+            _run_export(job)
+    except Exception as e:
+        logger.exception('Job %s failed', job.id)
+        job.status = Job.FAILED
+        job.error = f'{e.__class__.__name__}: {e}'
+    else:
+        job.status = Job.DONE
+        job.phase = 'done'
+    job.finished_at = now()
+    job.save()
+
+    # the upload is not needed anymore once the import has run
+    if job.kind == Job.IMPORT and job.input_path and os.path.exists(job.input_path):
+        os.remove(job.input_path)
+    return job
+
+
+def prune_jobs(before=None):
+    '''
+    Deletes the jobs that finished before the given time, by default settings.JOB_RETENTION ago, with their
+    results, and the uploads older than that no job uses. Returns the number of jobs deleted.
+    '''
+    if before is None:
+        before = now() - settings.JOB_RETENTION
+    root = Path(settings.JOB_FILES_ROOT)
+    job_ids = list(
+        Job.objects.filter(status__in=[Job.DONE, Job.FAILED], finished_at__lt=before).values_list('id', flat=True)
+    )
+    # the rows go first, so a job is never left pointing at a removed result
+    Job.objects.filter(id__in=job_ids).delete()
+    for job_id in job_ids:
+        shutil.rmtree(root / str(job_id), ignore_errors=True)
+
+    uploads = root / UPLOADS_DIR
+    if uploads.is_dir():
+        stale = {str(path) for path in uploads.iterdir() if path.stat().st_mtime < before.timestamp()}
+        stale -= set(Job.objects.filter(input_path__in=stale).values_list('input_path', flat=True))
+        for path in stale:
+            os.remove(path)
+    return len(job_ids)
+
+
+def work(poll_interval=1.0, once=False):
+    '''Runs queued jobs forever, or until the queue is empty when once=True.'''
+    while True:
+        close_old_connections()
+        fail_stale_jobs()
+        job = claim_next_job()
+        if job is not None:
+            logger.info('Running job %s', job)
+            run_job(job)
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
@@ -0,0 +1,158 @@
+'''
+Incremental readers for review exports, used to import files without loading them in memory.
+Both yield (kind, value) records for ReviewImporter.run_stream:
+('tag_tree', [root nodes]), ('author', {...}) and ('study', {...}).
+'''
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+# a value cut at the end of the buffer can fail to decode up to this many characters before the end,
+# e.g. at the start of -Infinity or of a \uXXXX escape, so only errors further back are final
+CUT_TOKEN_LENGTH = 16
+
+
+class JSONStreamError(ValueError):
+    '''Raised when the stream is not valid JSON in the expected layout.'''
+
+
+class _Reader:
+    '''Reads JSON tokens and values from a binary stream, keeping only the unread part in memory.'''
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        if self.eof:
+            return False
+        data = self.stream.read(max(size or 0, self.chunk_size))
+        if isinstance(data, str):
+            data = data.encode()
+        try:
+            text = self.decoder.decode(data, final=not data)
+        except UnicodeDecodeError as e:
+            raise JSONStreamError(f'Invalid UTF-8: {e.reason}')
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        self.eof = not data
+        return True
+
+    def peek(self):
+        '''Next non-whitespace character, without consuming it ('' at the end of the stream).'''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def next_char(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def expect(self, expected):
+        char = self.next_char()
+        if not char or char not in expected:  # '' (the end of the stream) is in every string
+            raise JSONStreamError(f"Expected one of {expected!r} but found {char or 'end of file'!r}")
+        return char
+
+    def value(self):
+        '''Decodes the next JSON value, reading more of the stream until it is complete.'''
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # a syntax error inside the buffered text is final, the rest of the stream is not read
+                if e.pos < len(self.buffer) - CUT_TOKEN_LENGTH and not e.msg.startswith('Unterminated string'):
+                    raise JSONStreamError(f'Invalid JSON: {e.msg}')
+                # reads at least as much as is buffered, so large values are not re-parsed too often
+                if not self._fill(len(self.buffer) - self.pos):
+                    if not self.buffer[self.pos:].strip() or e.pos >= len(self.buffer):
+                        raise JSONStreamError('Unexpected end of file')
+                    raise JSONStreamError(f'Invalid JSON: {e.msg}')
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_review_records(stream, chunk_size=CHUNK_SIZE):
+    '''
+    Reads a nested review export ({"tag_tree": [...], "authors": [...], "studies": [...]})
+    one study at a time.
+    '''
+    reader = _Reader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise JSONStreamError('Object keys must be strings')
+        reader.expect(':')
+        if key in ('authors', 'studies'):
+            kind = 'author' if key == 'authors' else 'study'
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.next_char()
+            else:
+                while True:
+                    yield kind, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        elif key == 'tag_tree':
+            yield 'tag_tree', reader.value()
+        else:
+            reader.value()
+        if reader.expect(',}') == '}':
+            break
+    if reader.peek():
+        raise JSONStreamError('Unexpected data after the end of the export')
+
+
+def iter_ndjson_records(stream, chunk_size=CHUNK_SIZE):
+    '''
+    Reads a newline delimited export, one JSON object per line.
+    The "type" of a line is "tag_tree" ({"type": "tag_tree", "tag_tree": [...]}),
+    "author" or "study" (the default for lines without a type).
+    '''
+    pending = b''
+    line_number = 0
+    while True:
+        data = stream.read(chunk_size)
+        if isinstance(data, str):
+            data = data.encode()
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop() if data else b''
+        for line in lines:
+            line_number += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise JSONStreamError(f'Line {line_number}: {e}')
+            if not isinstance(record, dict):
+                raise JSONStreamError(f'Line {line_number}: records must be objects')
+            kind = record.pop('type', 'study')
+            if kind == 'tag_tree':
+                yield 'tag_tree', record.get('tag_tree') or []
+            elif kind in ('author', 'study'):
+                yield kind, record
+            else:
+                raise JSONStreamError(f'Line {line_number}: unknown record type {kind!r}')
+        if not data:
+            break
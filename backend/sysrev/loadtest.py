@@ -0,0 +1,81 @@
+'''
+Concurrent write load test for SQLite connection profiles.
+Every writer runs short read-then-write transactions, the pattern of the API views
+(get the study, then save it), against a scratch database file.
+
+SQLITE_PRAGMAS and SQLITE_TRANSACTION_MODE are the connection profile of backend.settings_production,
+kept here so the load test and the tests use them without importing (and applying) those settings.
+'''
+import sqlite3
+import threading
+import time
+
+# Pragmas run on every new connection (Django executes init_command when it connects)
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',  # ms
+    'PRAGMA cache_size=-65536',  # KiB, i.e. 64 MiB
+    'PRAGMA mmap_size=268435456',  # 256 MiB
+    'PRAGMA temp_store=MEMORY',
+]
+SQLITE_TRANSACTION_MODE = 'IMMEDIATE'
+
+
+def _connect(path, init_commands, timeout):
+    # isolation_level=None leaves transaction control to the explicit BEGIN, like Django does
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+    for command in init_commands:
+        conn.execute(command)
+    return conn
+
+
+def run_write_load(path, writers=8, writes_per_writer=200, init_commands=(), transaction_mode=None, timeout=5.0):
+    '''
+    Runs writers threads doing writes_per_writer transactions each.
+    Returns the number of committed writes, the number of "database is locked" failures,
+    the elapsed seconds and the committed writes per second.
+    '''
+    setup = _connect(path, init_commands, timeout)
+    setup.execute('CREATE TABLE IF NOT EXISTS load_counter (writer INTEGER PRIMARY KEY, value INTEGER NOT NULL)')
+    setup.execute('DELETE FROM load_counter')
+    setup.executemany('INSERT INTO load_counter (writer, value) VALUES (?, 0)', [(i,) for i in range(writers)])
+    setup.close()
+
+    begin = f'BEGIN {transaction_mode}' if transaction_mode else 'BEGIN'
+    committed = [0] * writers
+    errors = [0] * writers
+    start_barrier = threading.Barrier(writers)
+
+    def writer(index):
+        conn = _connect(path, init_commands, timeout)
+        start_barrier.wait()
+        for _ in range(writes_per_writer):
+            try:
+                conn.execute(begin)
+                value = conn.execute('SELECT value FROM load_counter WHERE writer = ?', (index,)).fetchone()[0]
+                conn.execute('UPDATE load_counter SET value = ? WHERE writer = ?', (value + 1, index))
+                conn.execute('COMMIT')
+                committed[index] += 1
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                errors[index] += 1
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+        conn.close()
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'writes': sum(committed),
+        'errors': sum(errors),
+        'seconds': round(elapsed, 3),
+        'writes_per_second': round(sum(committed) / elapsed, 1) if elapsed else None,
+    }
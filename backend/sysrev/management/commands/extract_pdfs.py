@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from sysrev.extraction import process_studies, default_workers
+from sysrev.models import Review, Study
+
+
+class Command(BaseCommand):
+    help = 'Extracts the text of the PDFs of a review, filling in missing metadata and indexing it for search.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--review', type=int, required=True, help='Id of the review')
+        parser.add_argument('--workers', type=int, help=f'Worker processes (default: {default_workers()}, the CPU count)')
+        parser.add_argument('--force', action='store_true', help='Extract again the PDFs that were already extracted')
+
+    def handle(self, *args, **options):
+        if not Review.objects.filter(id=options['review']).exists():
+            raise CommandError(f"Review {options['review']} does not exist.")
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be positive.')
+
+        start = time.perf_counter()
+        extracted = process_studies(
+            Study.objects.filter(review_id=options['review']), workers=options['workers'], force=options['force'],
+            progress=lambda done: self.stdout.write(f'{done} PDFs extracted'),
+        )
+        self.stdout.write(self.style.SUCCESS(f'Extracted {extracted} PDFs in {time.perf_counter() - start:.1f} s.'))
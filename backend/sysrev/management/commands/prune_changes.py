@@ -0,0 +1,17 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from sysrev.changes import prune
+
+
+class Command(BaseCommand):
+    help = 'Removes old entries of the review change feeds. Clients behind them load their review again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Keep the changes of the last DAYS days (default: settings.CHANGE_FEED_RETENTION)')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError('--days must not be negative.')
+        before = now() - timedelta(days=options['days']) if options['days'] is not None else None
+        self.stdout.write(self.style.SUCCESS(f'Removed {prune(before)} changes.'))
@@ -0,0 +1,17 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from sysrev.jobs import prune_jobs
+
+
+class Command(BaseCommand):
+    help = 'Removes finished background jobs with their result files, and uploads no job was created for.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Keep the jobs that finished in the last DAYS days (default: settings.JOB_RETENTION)')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError('--days must not be negative.')
+        before = now() - timedelta(days=options['days']) if options['days'] is not None else None
+        self.stdout.write(self.style.SUCCESS(f'Removed {prune_jobs(before)} jobs.'))
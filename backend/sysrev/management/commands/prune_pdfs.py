@@ -0,0 +1,17 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from sysrev.blobs import prune_blobs
+
+
+class Command(BaseCommand):
+    help = 'Removes the stored PDFs no study uses any more, after study deletes and PDF replacements.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, help='Keep the PDFs stored in the last HOURS hours (default: settings.PDF_BLOB_GRACE)')
+
+    def handle(self, *args, **options):
+        if options['hours'] is not None and options['hours'] < 0:
+            raise CommandError('--hours must not be negative.')
+        before = now() - timedelta(hours=options['hours']) if options['hours'] is not None else None
+        self.stdout.write(self.style.SUCCESS(f'Removed {prune_blobs(before)} PDFs.'))
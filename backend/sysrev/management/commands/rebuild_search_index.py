@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from sysrev import search
+from sysrev.models import Review
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the study full-text search index for one review, or for every review.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--review', type=int, help='ID of the review to reindex (default: all reviews)')
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            raise CommandError('The database backend has no full-text index support.')
+
+        review_id = options['review']
+        if review_id is not None and not Review.objects.filter(id=review_id).exists():
+            raise CommandError(f'Review {review_id} does not exist.')
+
+        search.rebuild(review_id)
+        target = f'review {review_id}' if review_id is not None else 'all reviews'
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the search index for {target}.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from sysrev import jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs queued import, export and PDF extraction jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty instead of waiting for new jobs')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between queue checks when idle')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Waiting for jobs...' if not options['once'] else 'Running queued jobs...')
+        jobs.work(poll_interval=options['poll_interval'], once=options['once'])
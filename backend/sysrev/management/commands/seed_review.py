@@ -0,0 +1,60 @@
+from collections import Counter
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from sysrev.seeding import seed_review, default_fanout
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic review with bulk inserts, deterministic for a given --seed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', default='seed', help='Username of the owner, created if missing')
+        parser.add_argument('--name', help='Review name (default: "Synthetic review <seed>")')
+        parser.add_argument('--studies', type=int, default=100_000)
+        parser.add_argument('--tags', type=int, default=5_000, help='Number of tags in the tree')
+        parser.add_argument('--tag-depth', type=int, default=4, help='Levels of the tag tree')
+        parser.add_argument('--tag-fanout', type=int, help='Children per tag (default: enough to reach --tags)')
+        parser.add_argument('--authors', type=int, default=50_000)
+        parser.add_argument('--tags-per-study', type=int, default=3, help='Average tags per study')
+        parser.add_argument('--authors-per-study', type=int, default=4, help='Average authors per study')
+        parser.add_argument('--abstract-words', type=int, default=250)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--build-indexes', action='store_true',
+                            help='Also build the search and duplicate indexes of the review, which takes most of the time')
+
+    def handle(self, *args, **options):
+        for name in ('studies', 'tags', 'tag_depth', 'authors', 'tags_per_study', 'authors_per_study', 'abstract_words'):
+            if options[name] < 0:
+                raise CommandError(f"--{name.replace('_', '-')} must not be negative.")
+        fanout = options['tag_fanout'] or default_fanout(options['tags'], options['tag_depth'])
+        if fanout < 1:
+            raise CommandError('--tag-fanout must be positive.')
+
+        owner, _ = User.objects.get_or_create(username=options['owner'])
+        timings = Counter()
+
+        def progress(phase, seconds):
+            timings[phase] += seconds
+
+        review = seed_review(
+            owner,
+            name=options['name'] or f"Synthetic review {options['seed']}",
+            studies=options['studies'],
+            tags=options['tags'],
+            tag_depth=options['tag_depth'],
+            tag_fanout=fanout,
+            authors=options['authors'],
+            tags_per_study=options['tags_per_study'],
+            authors_per_study=options['authors_per_study'],
+            abstract_words=options['abstract_words'],
+            seed=options['seed'],
+            build_indexes=options['build_indexes'],
+            progress=progress,
+        )
+
+        for phase, seconds in timings.items():
+            self.stdout.write(f'{phase:>12}: {seconds:.2f} s')
+        self.stdout.write(self.style.SUCCESS(
+            f"Created review {review.id} with {review.studies.count()} studies, {review.tags.count()} tags "
+            f"(fan-out {fanout}) and {review.authors.count()} authors in {sum(timings.values()):.1f} s."
+        ))
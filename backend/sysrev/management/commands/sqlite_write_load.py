@@ -0,0 +1,34 @@
+import os
+import tempfile
+from django.core.management.base import BaseCommand
+from sysrev.loadtest import SQLITE_PRAGMAS, SQLITE_TRANSACTION_MODE, run_write_load
+
+PROFILES = {
+    # what Django does without OPTIONS: rollback journal, deferred transactions, 5 s busy handler
+    'default': {'init_commands': [], 'transaction_mode': None},
+    'production': {'init_commands': SQLITE_PRAGMAS, 'transaction_mode': SQLITE_TRANSACTION_MODE},
+}
+
+
+class Command(BaseCommand):
+    help = 'Measures SQLite write throughput and lock errors with concurrent writers, per connection profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--writes', type=int, default=200, help='Transactions per writer')
+        parser.add_argument('--profile', choices=[*PROFILES, 'all'], default='all')
+
+    def handle(self, *args, **options):
+        profiles = list(PROFILES) if options['profile'] == 'all' else [options['profile']]
+        for name in profiles:
+            with tempfile.TemporaryDirectory() as directory:
+                result = run_write_load(
+                    os.path.join(directory, 'load.sqlite3'),
+                    writers=options['writers'],
+                    writes_per_writer=options['writes'],
+                    **PROFILES[name],
+                )
+            self.stdout.write(
+                f"{name:>10}: {result['writes']} writes, {result['errors']} lock errors, "
+                f"{result['seconds']} s, {result['writes_per_second']} writes/s"
+            )
@@ -0,0 +1,86 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:02
+
+from django.db import migrations
+
+# Copies of the sysrev.search helpers this migration called when it was written, which have changed
+# since. Later changes of the index are made by later migrations (0008 adds the PDF body, 0012 fills
+# the index on every database).
+FTS_TABLE = 'sysrev_study_fts'
+PG_TABLE = 'sysrev_study_search'
+
+
+def _create_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            "title, abstract, summary, authors, review_id UNINDEXED, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            f'CREATE TABLE IF NOT EXISTS {PG_TABLE} ('
+            'study_id integer PRIMARY KEY REFERENCES sysrev_study(id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+            'review_id bigint NOT NULL, '
+            'document tsvector NOT NULL)'
+        )
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {PG_TABLE}_document_gin ON {PG_TABLE} USING GIN (document)')
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {PG_TABLE}_review_id ON {PG_TABLE} (review_id)')
+
+
+def _drop_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    elif vendor == 'postgresql':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {PG_TABLE}')
+
+
+def _rebuild(apps, schema_editor):
+    Study = apps.get_model('sysrev', 'Study')
+    Author = apps.get_model('sysrev', 'Author')
+    study, study_authors, author = Study._meta.db_table, Study.authors.through._meta.db_table, Author._meta.db_table
+    vendor = schema_editor.connection.vendor
+    agg = "group_concat(a.name, ' ')" if vendor == 'sqlite' else "string_agg(a.name, ' ')"
+    authors = (
+        f'COALESCE((SELECT {agg} FROM {study_authors} sa JOIN {author} a ON a.id = sa.author_id '
+        "WHERE sa.study_id = s.id), '')"
+    )
+    if vendor == 'sqlite':
+        schema_editor.execute(f'DELETE FROM {FTS_TABLE}')
+        schema_editor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, abstract, summary, authors, review_id) '
+            f'SELECT s.id, s.title, s.abstract, s.summary, {authors}, s.review_id FROM {study} s'
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(f'DELETE FROM {PG_TABLE}')
+        schema_editor.execute(
+            f'INSERT INTO {PG_TABLE} (study_id, review_id, document) '
+            "SELECT s.id, s.review_id, "
+            "setweight(to_tsvector('simple', s.title), 'A') || "
+            f"setweight(to_tsvector('simple', {authors}), 'B') || "
+            "setweight(to_tsvector('simple', s.abstract), 'C') || "
+            "setweight(to_tsvector('simple', s.summary), 'D') "
+            f'FROM {study} s'
+        )
+
+
+def create_search_index(apps, schema_editor):
+    _create_index(schema_editor)
+    if schema_editor.connection.alias == 'default':
+        _rebuild(apps, schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    _drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0002_study_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='review',
+            name='start_date',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('import', 'Import'), ('export_json', 'JSON export'), ('export_csv', 'CSV export')], max_length=20)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('options', models.JSONField(blank=True, default=dict)),
+                ('phase', models.CharField(blank=True, max_length=50)),
+                ('rows_processed', models.IntegerField(default=0)),
+                ('input_path', models.CharField(blank=True, max_length=255)),
+                ('result_path', models.CharField(blank=True, max_length=255)),
+                ('result_name', models.CharField(blank=True, max_length=255)),
+                ('result_content_type', models.CharField(blank=True, max_length=100)),
+                ('report', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('review', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='sysrev.review')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='job_queue_idx')],
+            },
+        ),
+    ]
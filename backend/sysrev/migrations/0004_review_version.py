@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0003_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Fills the closure table from the existing parent_tag links. The recursion is bounded by the
+# number of tags so that parent cycles terminate, and only the shortest path of a pair is kept.
+POPULATE_TAG_CLOSURE = '''
+WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+    SELECT id, id, 0 FROM sysrev_tag
+    UNION ALL
+    SELECT closure.ancestor_id, t.id, closure.depth + 1
+    FROM closure JOIN sysrev_tag t ON t.parent_tag_id = closure.descendant_id
+    WHERE closure.depth < (SELECT COUNT(*) FROM sysrev_tag)
+)
+INSERT INTO sysrev_tagclosure (ancestor_id, descendant_id, depth)
+SELECT ancestor_id, descendant_id, MIN(depth) FROM closure GROUP BY ancestor_id, descendant_id
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0004_review_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='sysrev.tag')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='sysrev.tag')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'depth'], name='tag_closure_descendant_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_tag_closure_pair')],
+            },
+        ),
+        migrations.RunSQL(POPULATE_TAG_CLOSURE, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0005_tag_closure'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='study',
+            index=models.Index(fields=['review', 'title', 'year'], name='study_review_title_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['review', 'parent_tag', 'name'], name='tag_review_parent_name_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:26
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0006_review_scoped_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='study',
+            name='pdf',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='studies', to='sysrev.pdfblob'),
+        ),
+    ]
@@ -0,0 +1,107 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:29
+
+from django.db import migrations, models
+
+# The index as it is from this migration on, frozen here like in 0002: on SQLite the FTS5 table
+# cannot gain a column, so it is recreated with the PDF body; on PostgreSQL the body is added to
+# the tsvector of every study.
+FTS_TABLE = 'sysrev_study_fts'
+PG_TABLE = 'sysrev_study_search'
+FTS_COLUMNS = ('title', 'abstract', 'summary', 'authors', 'body')
+
+
+def _fill_sql(apps, vendor, with_body):
+    Study = apps.get_model('sysrev', 'Study')
+    Author = apps.get_model('sysrev', 'Author')
+    PdfBlob = apps.get_model('sysrev', 'PdfBlob')
+    study, study_authors, author = Study._meta.db_table, Study.authors.through._meta.db_table, Author._meta.db_table
+    agg = "group_concat(a.name, ' ')" if vendor == 'sqlite' else "string_agg(a.name, ' ')"
+    authors = (
+        f'COALESCE((SELECT {agg} FROM {study_authors} sa JOIN {author} a ON a.id = sa.author_id '
+        "WHERE sa.study_id = s.id), '')"
+    )
+    body = f"COALESCE((SELECT b.text FROM {PdfBlob._meta.db_table} b WHERE b.id = s.pdf_id), '')"
+    if vendor == 'sqlite':
+        columns = FTS_COLUMNS if with_body else FTS_COLUMNS[:-1]
+        values = ['s.title', 's.abstract', 's.summary', authors] + ([body] if with_body else [])
+        return (
+            f'INSERT INTO {FTS_TABLE} (rowid, {", ".join(columns)}, review_id) '
+            f'SELECT s.id, {", ".join(values)}, s.review_id FROM {study} s'
+        )
+    document = (
+        "setweight(to_tsvector('simple', s.title), 'A') || "
+        f"setweight(to_tsvector('simple', {authors}), 'B') || "
+        "setweight(to_tsvector('simple', s.abstract), 'C') || "
+        "setweight(to_tsvector('simple', s.summary), 'D')"
+    )
+    if with_body:
+        document += f" || setweight(to_tsvector('simple', {body}), 'D')"
+    return (
+        f'INSERT INTO {PG_TABLE} (study_id, review_id, document) '
+        f'SELECT s.id, s.review_id, {document} FROM {study} s '
+        'ON CONFLICT (study_id) DO UPDATE SET review_id = EXCLUDED.review_id, document = EXCLUDED.document'
+    )
+
+
+def _recreate_search_index(apps, schema_editor, with_body):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        columns = FTS_COLUMNS if with_body else FTS_COLUMNS[:-1]
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            f"{', '.join(columns)}, review_id UNINDEXED, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    elif vendor != 'postgresql':
+        return
+    schema_editor.execute(_fill_sql(apps, vendor, with_body))
+
+
+def add_body_to_search_index(apps, schema_editor):
+    _recreate_search_index(apps, schema_editor, with_body=True)
+
+
+def remove_body_from_search_index(apps, schema_editor):
+    _recreate_search_index(apps, schema_editor, with_body=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0007_pdf_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfblob',
+            name='extracted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pdfblob',
+            name='extraction_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='pdfblob',
+            name='metadata',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='pdfblob',
+            name='page_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pdfblob',
+            name='text',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('import', 'Import'), ('export_json', 'JSON export'), ('export_csv', 'CSV export'), ('extract_pdf', 'PDF text extraction')], max_length=20),
+        ),
+        migrations.RunPython(add_body_to_search_index, remove_body_from_search_index),
+    ]
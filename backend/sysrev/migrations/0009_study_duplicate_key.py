@@ -0,0 +1,36 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from sysrev import dedupe
+
+
+def build_duplicate_index(apps, schema_editor):
+    if schema_editor.connection.alias != 'default':
+        return
+    for review_id in apps.get_model('sysrev', 'Review').objects.values_list('id', flat=True):
+        dedupe.rebuild(review_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0008_pdf_text_extraction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudyDuplicateKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField()),
+                ('review', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='sysrev.review')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='duplicate_keys', to='sysrev.study')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['review', 'key'], name='duplicate_key_review_key_idx')],
+            },
+        ),
+        migrations.RunPython(build_duplicate_index, migrations.RunPython.noop),
+    ]
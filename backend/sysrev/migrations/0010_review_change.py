@@ -0,0 +1,34 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:55
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0009_study_duplicate_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='changes_pruned_through',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ReviewChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('entity', models.CharField(choices=[('study', 'Study'), ('tag', 'Tag'), ('author', 'Author')], max_length=10)),
+                ('object_id', models.IntegerField()),
+                ('op', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('review', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='sysrev.review')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['review', 'id'], name='review_change_review_seq_idx')],
+            },
+        ),
+    ]
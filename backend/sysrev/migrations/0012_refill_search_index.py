@@ -0,0 +1,54 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:05
+
+from django.db import migrations
+
+# The search index as of 0008, frozen here like in 0002 and 0008. Earlier versions of 0002 and 0008
+# filled it on the default database only, or left it to a later migration, so it is filled again
+# here on every database.
+FTS_TABLE = 'sysrev_study_fts'
+PG_TABLE = 'sysrev_study_search'
+
+
+def refill_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in ('sqlite', 'postgresql'):
+        return
+    Study = apps.get_model('sysrev', 'Study')
+    Author = apps.get_model('sysrev', 'Author')
+    PdfBlob = apps.get_model('sysrev', 'PdfBlob')
+    study, study_authors, author = Study._meta.db_table, Study.authors.through._meta.db_table, Author._meta.db_table
+    agg = "group_concat(a.name, ' ')" if vendor == 'sqlite' else "string_agg(a.name, ' ')"
+    authors = (
+        f'COALESCE((SELECT {agg} FROM {study_authors} sa JOIN {author} a ON a.id = sa.author_id '
+        "WHERE sa.study_id = s.id), '')"
+    )
+    body = f"COALESCE((SELECT b.text FROM {PdfBlob._meta.db_table} b WHERE b.id = s.pdf_id), '')"
+    if vendor == 'sqlite':
+        schema_editor.execute(f'DELETE FROM {FTS_TABLE}')
+        schema_editor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, abstract, summary, authors, body, review_id) '
+            f'SELECT s.id, s.title, s.abstract, s.summary, {authors}, {body}, s.review_id FROM {study} s'
+        )
+    else:
+        schema_editor.execute(f'DELETE FROM {PG_TABLE}')
+        schema_editor.execute(
+            f'INSERT INTO {PG_TABLE} (study_id, review_id, document) '
+            "SELECT s.id, s.review_id, "
+            "setweight(to_tsvector('simple', s.title), 'A') || "
+            f"setweight(to_tsvector('simple', {authors}), 'B') || "
+            "setweight(to_tsvector('simple', s.abstract), 'C') || "
+            "setweight(to_tsvector('simple', s.summary), 'D') || "
+            f"setweight(to_tsvector('simple', {body}), 'D') "
+            f'FROM {study} s'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sysrev', '0011_job_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(refill_search_index, migrations.RunPython.noop),
+    ]
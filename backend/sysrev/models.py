@@ -1,6 +1,8 @@
-from django.db import models
+import json
+from django.db import models, connection
 from django.contrib.auth.models import User
 from django.utils.timezone import now
+from collections import defaultdict, Counter
 
 
 class Review(models.Model):
@@ -9,6 +11,181 @@ class Review(models.Model):
     start_date = models.DateTimeField(default=now, null=True, blank=True)
     end_date = models.DateTimeField(blank=True, null=True)
     status = models.BooleanField(default=False)  # True for completed, False for ongoing
+    version = models.PositiveIntegerField(default=0)  # bumped on every change to the review's data, see sysrev/cache.py
+    changes_pruned_through = models.BigIntegerField(default=0)  # last change feed entry removed by pruning, see sysrev/changes.py
+
+
+class StudyQuerySet(models.QuerySet):
+    def with_flag(self, flag):
+        'Studies whose flags list contains the given flag.'
+        if connection.vendor == 'postgresql':
+            return self.filter(flags__contains=[flag])
+        return self.extra(
+            where=['EXISTS (SELECT 1 FROM json_each(sysrev_study.flags) WHERE json_each.value = %s)'],
+            params=[flag],
+        )
+
+    def _flag_elements(self):
+        'The flags of every study as a table f(value): json_each on SQLite, jsonb_array_elements_text on PostgreSQL.'
+        if connection.vendor == 'sqlite':
+            return 'json_each(s.flags) AS f'
+        if connection.vendor == 'postgresql':
+            return 'jsonb_array_elements_text(s.flags) AS f(value)'
+        return None
+
+    def flag_counts(self):
+        'Number of studies per flag, counted by the database over the flags column only. A flag listed twice counts once.'
+        elements = self._flag_elements()
+        if elements is None:
+            counts = Counter()
+            for flags in self.values_list('flags', flat=True):
+                counts.update(set(flags))
+            return dict(counts)
+
+        ids_sql, params = self.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT f.value, COUNT(DISTINCT s.id) FROM sysrev_study s, {elements} '
+                f'WHERE s.id IN ({ids_sql}) GROUP BY f.value',
+                params,
+            )
+            return dict(cursor.fetchall())
+
+    def flag_rows(self):
+        'A (study id, flag) pair for every distinct flag of the studies, expanded by the database like flag_counts.'
+        elements = self._flag_elements()
+        if elements is None:
+            return [(study_id, flag) for study_id, flags in self.values_list('id', 'flags') for flag in dict.fromkeys(flags)]
+
+        ids_sql, params = self.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT DISTINCT s.id, f.value FROM sysrev_study s, {elements} WHERE s.id IN ({ids_sql})', params)
+            return cursor.fetchall()
+
+    def with_tags(self, tag_ids):
+        'Studies tagged with any of the given tags.'
+        return self.filter(id__in=Study.tags.through.objects.filter(tag_id__in=tag_ids).values('study_id'))
+
+    def with_authors(self, author_ids):
+        'Studies written by any of the given authors.'
+        return self.filter(id__in=Study.authors.through.objects.filter(author_id__in=author_ids).values('study_id'))
+
+    # Set based updates, one statement for the whole queryset. They send no signals.
+
+    def add_tags(self, tag_ids):
+        'Tags every study with the given tags it does not have yet. Returns the number of links added.'
+        tag_ids = list(tag_ids)
+        if not tag_ids:
+            return 0
+        through = Study.tags.through._meta.db_table
+        ids_sql, params = self.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {through} (study_id, tag_id) '
+                f'SELECT s.id, t.id FROM sysrev_study s, sysrev_tag t '
+                f'WHERE s.id IN ({ids_sql}) AND t.id IN ({", ".join(["%s"] * len(tag_ids))}) '
+                f'AND NOT EXISTS (SELECT 1 FROM {through} x WHERE x.study_id = s.id AND x.tag_id = t.id)',
+                [*params, *tag_ids],
+            )
+            return cursor.rowcount
+
+    def remove_tags(self, tag_ids):
+        'Removes the given tags from every study. Returns the number of links removed.'
+        return Study.tags.through.objects.filter(study_id__in=self.values('id'), tag_id__in=tag_ids).delete()[0]
+
+    def add_flags(self, flags):
+        'Adds the given flags to the studies missing any of them. Returns the number of studies changed.'
+        return self._update_flags(flags, add=True)
+
+    def remove_flags(self, flags=None):
+        'Removes the given flags, or every flag when None. Returns the number of studies changed.'
+        if flags is None:
+            return self.exclude(flags=[]).update(flags=[])
+        return self._update_flags(flags, add=False)
+
+    # The studies a set based update would change, to log them without listing every matched study.
+
+    def missing_tags(self, tag_ids):
+        'Studies missing any of the given tags, the ones add_tags changes.'
+        tag_ids = set(tag_ids)
+        return self.annotate(
+            present_tags=models.Count('tags', filter=models.Q(tags__in=tag_ids))
+        ).filter(present_tags__lt=len(tag_ids))
+
+    def flags_changed_by(self, flags, add):
+        '''
+        Studies add_flags (add=True) or remove_flags (add=False) changes: the ones missing any of the flags,
+        or having any of them (any flag at all when flags is None).
+        '''
+        if flags is None:
+            return self.exclude(flags=[])
+        flags = list(dict.fromkeys(flags))
+        if not flags:
+            return self.none()
+        changed = self._flag_update_sql(add)[1]
+        if changed is None:
+            return self.filter(id__in=[
+                study_id for study_id, study_flags in self.values_list('id', 'flags')
+                if (add and not set(flags) <= set(study_flags)) or (not add and set(flags) & set(study_flags))
+            ])
+        return self.extra(where=[changed], params=[json.dumps(flags)])
+
+    def bulk_delete(self):
+        'Deletes the studies, their tag and author links and duplicate keys without loading them. Returns the number of studies deleted.'
+        ids_sql, params = self.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            for related in (Study.tags.through, Study.authors.through, StudyDuplicateKey):
+                cursor.execute(f'DELETE FROM {related._meta.db_table} WHERE study_id IN ({ids_sql})', params)
+            cursor.execute(f'DELETE FROM sysrev_study WHERE id IN ({ids_sql})', params)
+            return cursor.rowcount
+
+    @staticmethod
+    def _flag_update_sql(add):
+        '''
+        (new flags, changed condition) SQL of adding or removing the JSON list of flags passed as parameter,
+        both over the flags column of sysrev_study. (None, None) on database backends without JSON functions.
+        '''
+        if connection.vendor == 'sqlite':
+            missing = 'SELECT n.value FROM json_each(%s) n WHERE n.value NOT IN (SELECT value FROM json_each(sysrev_study.flags))'
+            present = 'SELECT value FROM json_each(sysrev_study.flags) WHERE value IN (SELECT value FROM json_each(%s))'
+            if add:
+                return (f'(SELECT json_group_array(value) FROM (SELECT value FROM json_each(sysrev_study.flags) UNION ALL {missing}))',
+                        f'EXISTS ({missing})')
+            return ('(SELECT json_group_array(value) FROM json_each(sysrev_study.flags) WHERE value NOT IN (SELECT value FROM json_each(%s)))',
+                    f'EXISTS ({present})')
+        if connection.vendor == 'postgresql':
+            if add:
+                return ("flags || (SELECT coalesce(jsonb_agg(n), '[]'::jsonb) FROM jsonb_array_elements_text(%s::jsonb) n "
+                        'WHERE NOT flags @> jsonb_build_array(n))',
+                        'NOT flags @> %s::jsonb')
+            return ("(SELECT coalesce(jsonb_agg(v), '[]'::jsonb) FROM jsonb_array_elements_text(flags) v "
+                    'WHERE NOT %s::jsonb @> jsonb_build_array(v))',
+                    'EXISTS (SELECT 1 FROM jsonb_array_elements_text(flags) v WHERE %s::jsonb @> jsonb_build_array(v))')
+        return None, None
+
+    def _update_flags(self, flags, add):
+        flags = list(dict.fromkeys(flags))
+        if not flags:
+            return 0
+        new_flags, changed = self._flag_update_sql(add)
+        if new_flags is None:
+            studies = []
+            for study in self.only('id', 'flags'):
+                updated = study.flags + [f for f in flags if f not in study.flags] if add else [f for f in study.flags if f not in flags]
+                if updated != study.flags:
+                    study.flags = updated
+                    studies.append(study)
+            Study.objects.bulk_update(studies, ['flags'])
+            return len(studies)
+
+        encoded = json.dumps(flags)
+        ids_sql, params = self.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE sysrev_study SET flags = {new_flags} WHERE id IN ({ids_sql}) AND {changed}',
+                [encoded, *params, encoded],
+            )
+            return cursor.rowcount
 
 
 class Study(models.Model):
@@ -24,12 +201,78 @@ class Study(models.Model):
     url = models.URLField(blank=True)
     pages = models.CharField(max_length=255, blank=True)
     pathto_pdf = models.CharField(max_length=255, blank=True)
+    pdf = models.ForeignKey('PdfBlob', on_delete=models.PROTECT, null=True, blank=True, related_name='studies')
     review = models.ForeignKey('Review', on_delete=models.CASCADE, related_name='studies')
     # timescited = models.IntegerField(default=0) # May not be too useful to consider
 
+    objects = StudyQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # import matching by (title, year) within a review
+            models.Index(fields=['review', 'title', 'year'], name='study_review_title_year_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
+class StudyDuplicateKey(models.Model):
+    '''
+    Key of the near-duplicate index (sysrev/dedupe.py): a MinHash LSH band of a study's title or
+    abstract, or its normalized DOI. Studies of a review sharing a key are duplicate candidates.
+    Kept in sync by the Study signals in sysrev/signals.py, bulk study inserts and updates must
+    call dedupe.index_studies themselves.
+    '''
+    review = models.ForeignKey('Review', on_delete=models.CASCADE, related_name='+')
+    study = models.ForeignKey('Study', on_delete=models.CASCADE, related_name='duplicate_keys')
+    key = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['review', 'key'], name='duplicate_key_review_key_idx')]
+
+class ReviewChange(models.Model):
+    '''
+    An entry of a review's change feed (sysrev/changes.py): a study, tag or author that was created,
+    updated or deleted. The id is the sequence number of the feed. Logged by the signals in
+    sysrev/signals.py, bulk code paths must call changes.record_changes themselves.
+    '''
+    STUDY = 'study'
+    TAG = 'tag'
+    AUTHOR = 'author'
+    ENTITY_CHOICES = [(STUDY, 'Study'), (TAG, 'Tag'), (AUTHOR, 'Author')]
+
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    OP_CHOICES = [(CREATE, 'Create'), (UPDATE, 'Update'), (DELETE, 'Delete')]
+
+    id = models.BigAutoField(primary_key=True)
+    review = models.ForeignKey('Review', on_delete=models.CASCADE, related_name='+')
+    entity = models.CharField(max_length=10, choices=ENTITY_CHOICES)
+    object_id = models.IntegerField()
+    op = models.CharField(max_length=10, choices=OP_CHOICES)
+    created_at = models.DateTimeField(default=now)
+
+    class Meta:
+        indexes = [models.Index(fields=['review', 'id'], name='review_change_review_seq_idx')]
+
+class PdfBlob(models.Model):
+    '''
+    A PDF in the content-addressed store (sysrev/blobs.py), shared by every study with the same file.
+    The extracted text and metadata (sysrev/extraction.py) are kept here, so each file is only processed once.
+    '''
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(default=now)
+    text = models.TextField(blank=True)
+    page_count = models.PositiveIntegerField(null=True, blank=True)
+    metadata = models.JSONField(default=dict, blank=True)  # doi, year and abstract found in the text
+    extracted_at = models.DateTimeField(null=True, blank=True)
+    extraction_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return self.sha256
+
 class Author(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=255)
@@ -56,18 +299,189 @@ class Tag(models.Model):
         related_name='child_tags'
     )
 
+    class Meta:
+        indexes = [
+            # roots and children of a review's tree, and import matching by (name, parent)
+            models.Index(fields=['review', 'parent_tag', 'name'], name='tag_review_parent_name_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
     def get_tree(self):
-        'Recursively builds the tree structure.'
-        return {
-            'id': str(self.id),
-            'name': self.name,
-            'description': self.description,
-            'children': [child.get_tree() for child in self.child_tags.all()]
-        }
-    
+        'Builds the tree structure rooted at this tag.'
+        return Tag.build_tree(self.review_id, root_id=self.id)
+
+    @classmethod
+    def build_tree(cls, review_id, root_id=None, with_ids=True, depth=None):
+        '''
+        Builds the tag tree of a review from a single query.
+        Returns the list of root nodes, or the node for root_id (None if it is not in the review).
+        with_ids=False leaves out the ids, as used by the export.
+        depth limits the levels below the roots (0 = only the roots).
+        '''
+        rows = cls.objects.filter(review_id=review_id)
+        if root_id is not None:
+            subtree = {'ancestor_links__ancestor_id': root_id}
+            if depth is not None:
+                subtree['ancestor_links__depth__lte'] = depth
+            rows = rows.filter(**subtree)
+        elif depth is not None:
+            rows = rows.annotate(level=models.Count('ancestor_links')).filter(level__lte=depth + 1)
+        rows = rows.order_by('id').values_list('id', 'name', 'description', 'parent_tag_id')
+
+        nodes = {}
+        children = defaultdict(list)
+        for tag_id, name, description, parent_id in rows:
+            node = {'id': str(tag_id), 'name': name, 'description': description, 'children': children[tag_id]}
+            if not with_ids:
+                del node['id']
+            nodes[tag_id] = node
+            children[parent_id].append(node)
+
+        if root_id is not None:
+            return nodes.get(int(root_id))
+        return children[None]
+
+    @classmethod
+    def study_counts(cls, review_id):
+        '''
+        Distinct study counts for every tag of a review, in one query over the closure table:
+        {tag_id: (studies tagged with the tag, studies tagged with the tag or any of its descendants)}.
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                '''
+                SELECT c.ancestor_id,
+                       COUNT(DISTINCT CASE WHEN c.depth = 0 THEN st.study_id END),
+                       COUNT(DISTINCT st.study_id)
+                FROM sysrev_tag t
+                JOIN sysrev_tagclosure c ON c.ancestor_id = t.id
+                JOIN sysrev_study_tags st ON st.tag_id = c.descendant_id
+                WHERE t.review_id = %s
+                GROUP BY c.ancestor_id
+                ''',
+                [review_id],
+            )
+            return {tag_id: (direct, total) for tag_id, direct, total in cursor.fetchall()}
+
+    @classmethod
+    def build_count_tree(cls, review_id):
+        '''The tag tree of build_tree with direct_count and total_count on every node.'''
+        counts = cls.study_counts(review_id)
+        tree = cls.build_tree(review_id)
+        pending = list(tree)
+        while pending:
+            node = pending.pop()
+            node['direct_count'], node['total_count'] = counts.get(int(node['id']), (0, 0))
+            pending.extend(node['children'])
+        return tree
+
+    @classmethod
+    def subtree_ids(cls, review_id, tag_ids):
+        '''The given tags and all their descendants, as an id subquery over the closure table.'''
+        return TagClosure.objects.filter(
+            ancestor_id__in=tag_ids, ancestor__review_id=review_id
+        ).values('descendant_id')
 
+    def is_ancestor_of(self, tag_id):
+        '''True if tag_id is this tag or one of its descendants.'''
+        return TagClosure.objects.filter(ancestor_id=self.id, descendant_id=tag_id).exists()
 
 
+class TagClosure(models.Model):
+    '''
+    Closure table of the tag hierarchy: one row per (ancestor, descendant) pair, including
+    (tag, tag) at depth 0. Kept in sync by the Tag signals in sysrev/signals.py, bulk tag
+    inserts must call add_tags themselves.
+    '''
+    ancestor = models.ForeignKey('Tag', on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey('Tag', on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_tag_closure_pair')
+        ]
+        indexes = [models.Index(fields=['descendant', 'depth'], name='tag_closure_descendant_idx')]
+
+    @classmethod
+    def add_tags(cls, tag_ids):
+        '''Adds new tags whose parents are already in the closure table.'''
+        tag_ids = list(tag_ids)
+        if not tag_ids:
+            return
+        cls.objects.bulk_create([cls(ancestor_id=tag_id, descendant_id=tag_id, depth=0) for tag_id in tag_ids])
+        placeholders = ', '.join(['%s'] * len(tag_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO sysrev_tagclosure (ancestor_id, descendant_id, depth)
+                SELECT c.ancestor_id, t.id, c.depth + 1
+                FROM sysrev_tag t JOIN sysrev_tagclosure c ON c.descendant_id = t.parent_tag_id
+                WHERE t.id IN ({placeholders})
+                ''',
+                tag_ids,
+            )
+
+    @classmethod
+    def move_subtree(cls, tag_id, new_parent_id):
+        '''Re-links the subtree of tag_id under new_parent_id (None for a root).'''
+        with connection.cursor() as cursor:
+            # paths from outside the subtree into it
+            cursor.execute(
+                '''
+                DELETE FROM sysrev_tagclosure
+                WHERE descendant_id IN (SELECT descendant_id FROM sysrev_tagclosure WHERE ancestor_id = %s)
+                  AND ancestor_id NOT IN (SELECT descendant_id FROM sysrev_tagclosure WHERE ancestor_id = %s)
+                ''',
+                [tag_id, tag_id],
+            )
+            if new_parent_id is not None:
+                cursor.execute(
+                    '''
+                    INSERT INTO sysrev_tagclosure (ancestor_id, descendant_id, depth)
+                    SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+                    FROM sysrev_tagclosure above, sysrev_tagclosure below
+                    WHERE above.descendant_id = %s AND below.ancestor_id = %s
+                    ''',
+                    [new_parent_id, tag_id],
+                )
+
+
+class Job(models.Model):
+    '''A background import, export or PDF text extraction, run by the run_jobs worker.'''
+    IMPORT = 'import'
+    EXPORT_JSON = 'export_json'
+    EXPORT_CSV = 'export_csv'
+    EXTRACT_PDF = 'extract_pdf'
+    KIND_CHOICES = [(IMPORT, 'Import'), (EXPORT_JSON, 'JSON export'), (EXPORT_CSV, 'CSV export'), (EXTRACT_PDF, 'PDF text extraction')]
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    review = models.ForeignKey('Review', on_delete=models.CASCADE, related_name='jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    options = models.JSONField(default=dict, blank=True)
+    phase = models.CharField(max_length=50, blank=True)
+    rows_processed = models.IntegerField(default=0)
+    input_path = models.CharField(max_length=255, blank=True)
+    result_path = models.CharField(max_length=255, blank=True)
+    result_name = models.CharField(max_length=255, blank=True)
+    result_content_type = models.CharField(max_length=100, blank=True)
+    report = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=now)
+    started_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)  # last progress of a running job, see jobs.fail_stale_jobs
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'id'], name='job_queue_idx')]
+
+    def __str__(self):
+        return f'{self.kind} #{self.id} ({self.status})'
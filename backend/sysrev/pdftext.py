@@ -0,0 +1,174 @@
+'''
+Text and metadata extraction from PDF files.
+
+Uses pypdf when it is installed. Otherwise a small built-in reader collects the text shown by
+the content streams (uncompressed or FlateDecode, simple fonts), which covers most
+text-based papers. Scanned PDFs have no text either way. The built-in reader decodes at most
+MAX_DECODED_SIZE bytes of streams per document and the pypdf text is cut at MAX_DECODED_SIZE
+characters, so a small crafted upload cannot expand into gigabytes in the worker.
+
+This module does not use Django, so extract_file can run in worker processes
+(see sysrev/extraction.py).
+'''
+import re
+import zlib
+
+try:
+    import pypdf
+except ImportError:  # optional dependency
+    pypdf = None
+
+DOI_RE = re.compile(r'\b(10\.\d{4,9}/[-._;()/:A-Za-z0-9]+[A-Za-z0-9])')
+YEAR_RE = re.compile(r'\b(19[5-9]\d|20\d\d)\b')
+ABSTRACT_RE = re.compile(
+    r'\babstract\b[\s:.\-—]*(.+?)(?:\n\s*\n|\b(?:keywords|key words|index terms|introduction)\b|$)',
+    re.IGNORECASE | re.DOTALL,
+)
+MAX_ABSTRACT_LENGTH = 5000
+MAX_DECODED_SIZE = 64 * 1024 * 1024
+
+# text showing and positioning operators of content streams
+_TOKEN_RE = re.compile(rb'\((?:\\.|[^\\()])*\)|<[0-9A-Fa-f\s]*>|\[|\]|-?\d*\.?\d+|/[^\s/<>\[\]()]+|[A-Za-z\'"*]+', re.S)
+_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f', b'(': b'(', b')': b')', b'\\': b'\\'}
+_NEWLINE_OPERATORS = {b'Td', b'TD', b'T*', b"'", b'"', b'ET'}
+# a TJ adjustment below this (thousandths of an em) is a word gap
+_WORD_GAP = -200
+
+
+def extract_file(path):
+    '''
+    Extracts {text, page_count, doi, year, abstract} from a PDF file.
+    Never raises: a file that cannot be read gives {'error': message}.
+    '''
+    try:
+        if pypdf is not None:
+            text, page_count, info_year = _extract_pypdf(path)
+        else:
+            with open(path, 'rb') as file:
+                data = file.read()
+            text, page_count, info_year = _extract_builtin(data)
+    except Exception as e:
+        return {'error': f'{e.__class__.__name__}: {e}'}
+
+    text = _clean(text)
+    return {'text': text, 'page_count': page_count, **extract_metadata(text, info_year)}
+
+
+def extract_metadata(text, info_year=None):
+    '''Guesses the DOI, year and abstract of a paper from its text.'''
+    head = text[:20000]
+    doi = DOI_RE.search(head)
+    year = YEAR_RE.search(head[:3000])
+    abstract = ABSTRACT_RE.search(head)
+    return {
+        'doi': doi.group(1).rstrip('.') if doi else None,
+        'year': int(year.group(1)) if year else info_year,
+        'abstract': ' '.join(abstract.group(1).split())[:MAX_ABSTRACT_LENGTH] or None if abstract else None,
+    }
+
+
+def _clean(text):
+    lines = (' '.join(line.split()) for line in text.splitlines())
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def _extract_pypdf(path, max_text=MAX_DECODED_SIZE):
+    reader = pypdf.PdfReader(path)
+    texts, size = [], 0
+    for page in reader.pages:
+        texts.append(page.extract_text() or '')
+        size += len(texts[-1]) + 2
+        if size >= max_text:
+            break  # the text is cut at max_text, the following pages are skipped
+    text = '\n\n'.join(texts)[:max_text]
+    created = reader.metadata.creation_date if reader.metadata else None
+    return text, len(reader.pages), created.year if created else None
+
+
+def _extract_builtin(data, max_decoded=MAX_DECODED_SIZE):
+    if not data.startswith(b'%PDF-'):
+        raise ValueError('Not a PDF file')
+    page_count = len(re.findall(rb'/Type\s*/Page(?![a-zA-Z])', data))
+    created = re.search(rb'/CreationDate\s*\(D:(\d{4})', data)
+    texts = [_content_text(stream) for stream in _streams(data, max_decoded)]
+    return '\n'.join(text for text in texts if text.strip()), page_count, int(created.group(1)) if created else None
+
+
+def _streams(data, max_decoded):
+    '''
+    Decoded content of the streams that are uncompressed or FlateDecode, until max_decoded bytes
+    were decoded: a stream reaching the limit is cut there and the following ones are skipped.
+    '''
+    for match in re.finditer(rb'(?<!end)stream\r?\n', data):
+        header = data[data.rfind(b'obj', 0, match.start()):match.start()]
+        end = data.find(b'endstream', match.end())
+        if end < 0:
+            break
+        raw = data[match.end():end]
+        if b'/Subtype/Image' in header.replace(b' ', b'') or b'/Length1' in header:
+            continue  # images and embedded fonts
+        if b'/FlateDecode' in header:
+            try:
+                raw = zlib.decompressobj().decompress(raw, max_decoded)
+            except zlib.error:
+                continue
+        elif b'/Filter' in header:
+            continue
+        else:
+            raw = raw[:max_decoded]
+        max_decoded -= len(raw)
+        if b'BT' in raw:
+            yield raw
+        if max_decoded <= 0:
+            break
+
+
+def _unescape(literal):
+    out = bytearray()
+    i, body = 0, literal[1:-1]
+    while i < len(body):
+        char = body[i:i + 1]
+        if char != b'\\':
+            out += char
+            i += 1
+            continue
+        following = body[i + 1:i + 2]
+        octal = re.match(rb'[0-7]{1,3}', body[i + 1:i + 4])
+        if octal:
+            out.append(int(octal.group(), 8) & 0xFF)
+            i += 1 + len(octal.group())
+        elif following in (b'\n', b'\r'):
+            i += 2  # line continuation
+        else:
+            out += _ESCAPES.get(following, following)
+            i += 2
+    return out.decode('latin-1')
+
+
+def _content_text(content):
+    parts = []
+    operands = []
+    in_array = False
+    for token in _TOKEN_RE.findall(content):
+        if token.startswith(b'('):
+            operands.append(_unescape(token))
+        elif token.startswith(b'<'):
+            operands.append(None)  # hex strings need the font encoding, they are skipped
+        elif token == b'[':
+            in_array = True
+        elif token == b']':
+            in_array = False
+        elif token[:1].isdigit() or token[:1] in b'-.':
+            if in_array and float(token) < _WORD_GAP:
+                operands.append(' ')
+        elif token.startswith(b'/') or in_array:
+            continue
+        else:
+            if token in (b'Tj', b'TJ', b"'", b'"'):
+                if token in (b"'", b'"'):
+                    parts.append('\n')
+                parts.append(''.join(text for text in operands if text))
+            elif token in _NEWLINE_OPERATORS:
+                parts.append('\n')
+            operands = []
+    return ''.join(parts)
@@ -0,0 +1,230 @@
+'''
+Opt-in request profiling, enabled with SYSREV_PROFILING = True in the settings.
+
+ProfilingMiddleware records for every request the wall time, the time spent in the database,
+the number of queries, the queries repeated with the same SQL (the signature of an N+1), the
+time spent in serializers and the response size. The numbers of a request are sent back in a
+Server-Timing header, which browsers show in the network panel:
+
+    Server-Timing: total;dur=41.2, db;dur=30.5;desc="23 queries, 20 repeated", serialize;dur=8.1;desc="TagSerializer"
+
+and aggregated per route in /api/_metrics, in the Prometheus text format.
+The metrics are kept in memory, per process.
+
+For streaming responses the header only covers the time until the response starts,
+the metrics are recorded once the stream has been sent and include it. File responses are
+the exception: wrapping their content would stop the server from sending the file with
+wsgi.file_wrapper (sendfile), so they are measured until the response starts and their size
+is read from the Content-Length header.
+'''
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import FileResponse, HttpResponse, Http404
+from rest_framework import serializers
+
+# requests slower than these bounds (seconds) are counted in the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# a query repeated at least this many times within a request is reported as repeated
+REPEATED_QUERY_THRESHOLD = 3
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_current = ContextVar('sysrev_profile', default=None)
+
+
+def is_enabled():
+    return getattr(settings, 'SYSREV_PROFILING', False)
+
+
+class RequestProfile:
+    '''Measurements of one request.'''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = Counter()  # SQL (with placeholders) -> executions
+        self.db_seconds = 0.0
+        self.serializer_seconds = defaultdict(float)
+        self._serializer_depth = 0
+        self.response_bytes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        '''Database execute wrapper.'''
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.queries[sql] += 1
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def repeated_queries(self):
+        '''Executions of the queries that ran REPEATED_QUERY_THRESHOLD times or more.'''
+        return sum(count for count in self.queries.values() if count >= REPEATED_QUERY_THRESHOLD)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        db = f'db;dur={self.db_seconds * 1000:.1f};desc="{self.query_count} queries'
+        if self.repeated_queries:
+            db += f', {self.repeated_queries} repeated'
+        parts = [f'total;dur={self.elapsed() * 1000:.1f}', db + '"']
+        if self.serializer_seconds:
+            names = ' '.join(sorted(self.serializer_seconds, key=self.serializer_seconds.get, reverse=True))
+            parts.append(f'serialize;dur={sum(self.serializer_seconds.values()) * 1000:.1f};desc="{names}"')
+        return ', '.join(parts)
+
+
+def _profiled_to_representation(to_representation):
+    '''Times the outermost serializer call of a request, nested serializers are part of it.'''
+    def wrapper(self, instance):
+        profile = _current.get()
+        if profile is None or profile._serializer_depth:
+            return to_representation(self, instance)
+        profile._serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return to_representation(self, instance)
+        finally:
+            profile._serializer_depth -= 1
+            name = type(self.child if isinstance(self, serializers.ListSerializer) else self).__name__
+            profile.serializer_seconds[name] += time.perf_counter() - start
+    wrapper.profiled = True
+    return wrapper
+
+
+def instrument_serializers():
+    for cls in (serializers.Serializer, serializers.ListSerializer):
+        if not getattr(cls.to_representation, 'profiled', False):
+            cls.to_representation = _profiled_to_representation(cls.to_representation)
+
+
+class Metrics:
+    '''Per route counters, rendered in the Prometheus text format.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = Counter()
+        self.buckets = Counter()
+        self.sums = defaultdict(Counter)
+
+    def record(self, route, method, status, profile):
+        key = (route, method, str(status))
+        duration = profile.elapsed()
+        with self.lock:
+            self.requests[key] += 1
+            for bound in DURATION_BUCKETS:
+                if duration <= bound:
+                    self.buckets[key + (bound,)] += 1
+            sums = self.sums[key]
+            sums['request_seconds'] += duration
+            sums['db_seconds'] += profile.db_seconds
+            sums['queries'] += profile.query_count
+            sums['repeated_queries'] += profile.repeated_queries
+            sums['serializer_seconds'] += sum(profile.serializer_seconds.values())
+            sums['response_bytes'] += profile.response_bytes
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP sysrev_{name} {help_text}')
+            lines.append(f'# TYPE sysrev_{name} {kind}')
+
+        def labels(key, **extra):
+            pairs = dict(zip(('route', 'method', 'status'), key), **extra)
+            return ','.join(f'{name}="{value}"' for name, value in pairs.items())
+
+        with self.lock:
+            keys = sorted(self.requests)
+            family('request_duration_seconds', 'histogram', 'Wall time of the requests.')
+            for key in keys:
+                for bound in DURATION_BUCKETS:
+                    lines.append(f'sysrev_request_duration_seconds_bucket{{{labels(key, le=bound)}}} {self.buckets[key + (bound,)]}')
+                lines.append(f'sysrev_request_duration_seconds_bucket{{{labels(key, le="+Inf")}}} {self.requests[key]}')
+                lines.append(f'sysrev_request_duration_seconds_sum{{{labels(key)}}} {self.sums[key]["request_seconds"]:.6f}')
+                lines.append(f'sysrev_request_duration_seconds_count{{{labels(key)}}} {self.requests[key]}')
+
+            for name, help_text in (
+                ('db_seconds', 'Time spent executing queries.'),
+                ('queries', 'Queries executed.'),
+                ('repeated_queries', f'Executions of queries run {REPEATED_QUERY_THRESHOLD} or more times in a request (N+1).'),
+                ('serializer_seconds', 'Time spent in serializers.'),
+                ('response_bytes', 'Size of the response bodies.'),
+            ):
+                family(f'{name}_total', 'counter', help_text)
+                for key in keys:
+                    value = self.sums[key][name]
+                    value = f'{value:.6f}' if isinstance(value, float) else value
+                    lines.append(f'sysrev_{name}_total{{{labels(key)}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class ProfilingMiddleware:
+    '''See the module docstring. Removed from the middleware stack unless SYSREV_PROFILING is set.'''
+    def __init__(self, get_response):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        instrument_serializers()
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        wrappers = ExitStack()
+        for connection in connections.all():
+            wrappers.enter_context(connection.execute_wrapper(profile))
+        token = _current.set(profile)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            wrappers.close()
+            raise
+        finally:
+            _current.reset(token)
+
+        def finish():
+            wrappers.close()
+            match = request.resolver_match
+            if match is not None and match.view_name != 'metrics':
+                metrics.record(match.route, request.method, response.status_code, profile)
+
+        response['Server-Timing'] = profile.server_timing()
+        if isinstance(response, FileResponse):
+            profile.response_bytes = int(response.get('Content-Length', 0))
+            finish()
+        elif response.streaming:
+            response.streaming_content = self._stream(response.streaming_content, profile, finish)
+        else:
+            profile.response_bytes = len(response.content)
+            finish()
+        return response
+
+    def _stream(self, content, profile, finish):
+        try:
+            for chunk in content:
+                profile.response_bytes += len(chunk)
+                yield chunk
+        finally:
+            finish()
+
+
+def metrics_view(request):
+    '''GET /api/_metrics, the aggregated profiles in the Prometheus text format.'''
+    if not is_enabled():
+        raise Http404
+    return HttpResponse(metrics.render(), content_type=METRICS_CONTENT_TYPE)
@@ -0,0 +1,204 @@
+'''
+Full-text search index over study title, abstract, summary, author names and the text of the study's PDF.
+
+On SQLite the index is the FTS5 table sysrev_study_fts (rowid = study id).
+On PostgreSQL it is the table sysrev_study_search with a weighted tsvector and a GIN index.
+Both are created by migration 0002, recreated with the PDF body in 0008 and refilled in 0012,
+which hold their own frozen copy of the DDL, and kept in sync by the signals in sysrev/signals.py,
+by the import path, by the PDF extraction and by the rebuild_search_index management command.
+'''
+import re
+from django.db import connection
+
+FTS_TABLE = 'sysrev_study_fts'
+PG_TABLE = 'sysrev_study_search'
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_END = '</mark>'
+BATCH_SIZE = 500
+
+# author names of a study joined into one text, used by both backends
+AUTHORS_SQL = '''
+    (SELECT {agg} FROM sysrev_study_authors sa
+     JOIN sysrev_author a ON a.id = sa.author_id
+     WHERE sa.study_id = s.id)
+'''
+
+# text extracted from the study's PDF, see sysrev/extraction.py
+BODY_SQL = "COALESCE((SELECT b.text FROM sysrev_pdfblob b WHERE b.id = s.pdf_id), '')"
+
+
+def is_supported(conn=None):
+    return (conn or connection).vendor in ('sqlite', 'postgresql')
+
+
+def _batches(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+def remove_studies(study_ids):
+    '''Removes studies from the index.'''
+    if not is_supported():
+        return
+    column = 'rowid' if connection.vendor == 'sqlite' else 'study_id'
+    table = FTS_TABLE if connection.vendor == 'sqlite' else PG_TABLE
+    with connection.cursor() as cursor:
+        for batch in _batches(study_ids):
+            cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({_placeholders(batch)})', batch)
+
+
+def remove_review(review_id):
+    '''Removes all the studies of a review from the index, in one statement.'''
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT id FROM sysrev_study WHERE review_id = %s)', [review_id])
+        else:
+            cursor.execute(f'DELETE FROM {PG_TABLE} WHERE review_id = %s', [review_id])
+
+
+def _index_where(where, params):
+    '''(Re)indexes the studies matching a WHERE clause over sysrev_study s, in one statement.'''
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT s.id FROM sysrev_study s WHERE {where})', params)
+            authors = AUTHORS_SQL.format(agg="group_concat(a.name, ' ')")
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, abstract, summary, authors, body, review_id) '
+                f"SELECT s.id, s.title, s.abstract, s.summary, COALESCE({authors}, ''), {BODY_SQL}, s.review_id "
+                f'FROM sysrev_study s WHERE {where}',
+                params,
+            )
+        else:
+            authors = AUTHORS_SQL.format(agg="string_agg(a.name, ' ')")
+            cursor.execute(
+                f'INSERT INTO {PG_TABLE} (study_id, review_id, document) '
+                "SELECT s.id, s.review_id, "
+                "setweight(to_tsvector('simple', s.title), 'A') || "
+                f"setweight(to_tsvector('simple', COALESCE({authors}, '')), 'B') || "
+                "setweight(to_tsvector('simple', s.abstract), 'C') || "
+                "setweight(to_tsvector('simple', s.summary), 'D') || "
+                f"setweight(to_tsvector('simple', {BODY_SQL}), 'D') "
+                f'FROM sysrev_study s WHERE {where} '
+                'ON CONFLICT (study_id) DO UPDATE SET review_id = EXCLUDED.review_id, document = EXCLUDED.document',
+                params,
+            )
+
+
+def index_studies(study_ids):
+    '''Adds or refreshes the given studies in the index.'''
+    if not is_supported():
+        return
+    for batch in _batches(study_ids):
+        _index_where(f's.id IN ({_placeholders(batch)})', batch)
+
+
+def rebuild(review_id=None):
+    '''Rebuilds the index for one review, or for every review when review_id is None.'''
+    if not is_supported():
+        return
+    table = FTS_TABLE if connection.vendor == 'sqlite' else PG_TABLE
+    if review_id is not None:
+        # FTS5 columns have no type affinity, so the id must be compared as an integer
+        review_id = int(review_id)
+    with connection.cursor() as cursor:
+        if review_id is None:
+            cursor.execute(f'DELETE FROM {table}')
+        else:
+            cursor.execute(f'DELETE FROM {table} WHERE review_id = %s', [review_id])
+    if review_id is None:
+        _index_where('1 = 1', [])
+    else:
+        _index_where('s.review_id = %s', [review_id])
+
+
+def _fts5_query(text):
+    '''Turns free text into an FTS5 query: every word must match, the last one as a prefix.'''
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search(review_id, text, limit=50):
+    '''
+    Ranked search over the studies of a review.
+    Returns dicts with id, title, year, score and the highlights of every indexed column: title, abstract,
+    summary, authors and body, with the matches between HIGHLIGHT_START and HIGHLIGHT_END. The title and
+    authors are highlighted whole, the longer columns as fragments around the matches. The substring
+    search of other database backends returns no highlights.
+    '''
+    if connection.vendor == 'sqlite':
+        query = _fts5_query(text)
+        if query is None:
+            return []
+        sql = (
+            f'SELECT s.id, s.title, s.year, -bm25({FTS_TABLE}, 10.0, 2.0, 1.0, 4.0, 0.5) AS score, '
+            f"highlight({FTS_TABLE}, 0, %s, %s), "
+            f"snippet({FTS_TABLE}, 1, %s, %s, '…', 24), "
+            f"snippet({FTS_TABLE}, 2, %s, %s, '…', 24), "
+            f"highlight({FTS_TABLE}, 3, %s, %s), "
+            f"snippet({FTS_TABLE}, 4, %s, %s, '…', 24) "
+            f'FROM {FTS_TABLE} JOIN sysrev_study s ON s.id = {FTS_TABLE}.rowid '
+            f'WHERE {FTS_TABLE} MATCH %s AND s.review_id = %s '
+            f'ORDER BY bm25({FTS_TABLE}, 10.0, 2.0, 1.0, 4.0, 0.5) LIMIT %s'
+        )
+        params = [HIGHLIGHT_START, HIGHLIGHT_END] * 5 + [query, review_id, limit]
+    elif connection.vendor == 'postgresql':
+        if not text.strip():
+            return []
+        options = f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxFragments=2'
+        whole = f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, HighlightAll=true'
+        authors = AUTHORS_SQL.format(agg="string_agg(a.name, ' ')")
+        sql = (
+            "WITH q AS (SELECT websearch_to_tsquery('simple', %s) AS query) "
+            'SELECT s.id, s.title, s.year, ts_rank(i.document, q.query) AS score, '
+            "ts_headline('simple', s.title, q.query, %s), "
+            "ts_headline('simple', s.abstract, q.query, %s), "
+            "ts_headline('simple', s.summary, q.query, %s), "
+            f"ts_headline('simple', COALESCE({authors}, ''), q.query, %s), "
+            f"ts_headline('simple', {BODY_SQL}, q.query, %s) "
+            f'FROM {PG_TABLE} i JOIN sysrev_study s ON s.id = i.study_id, q '
+            'WHERE i.document @@ q.query AND i.review_id = %s '
+            'ORDER BY score DESC LIMIT %s'
+        )
+        params = [text, whole, options, options, whole, options, review_id, limit]
+    else:
+        return _search_fallback(review_id, text, limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    return [
+        {
+            'id': study_id,
+            'title': title,
+            'year': year,
+            'score': score,
+            'highlights': {'title': h_title, 'abstract': h_abstract, 'summary': h_summary, 'authors': h_authors, 'body': h_body},
+        }
+        for study_id, title, year, score, h_title, h_abstract, h_summary, h_authors, h_body in rows
+    ]
+
+
+def _search_fallback(review_id, text, limit):
+    '''Unranked substring search for database backends without a full-text index.'''
+    from django.db.models import Q
+    from .models import Study
+
+    studies = Study.objects.filter(review_id=review_id).filter(
+        Q(title__icontains=text) | Q(abstract__icontains=text) | Q(summary__icontains=text)
+    ).values_list('id', 'title', 'year')[:limit]
+    return [
+        {'id': study_id, 'title': title, 'year': year, 'score': None, 'highlights': {}}
+        for study_id, title, year in studies
+    ]
@@ -0,0 +1,208 @@
+'''
+Synthetic reviews for benchmarks, profiling and load tests.
+
+Everything is written with bulk inserts, so the derived data that the model signals would
+maintain (tag closure, review version and, with build_indexes=True, the search and duplicate indexes)
+is updated here explicitly.
+The rows of a new review are not logged in its change feed, no client has loaded it yet.
+The generated review only depends on the seed and the sizes.
+'''
+import itertools
+import random
+import time
+from bisect import bisect
+from django.db import connection, transaction
+from . import search, dedupe
+from .cache import bump_review_version
+from .models import Review, Tag, TagClosure, Study, Author
+
+BATCH_SIZE = 2000
+
+# share of studies carrying each flag
+FLAG_RATES = {'Reviewed': 0.4, 'Pending Review': 0.3, 'Missing Data': 0.05, 'Flagged': 0.1}
+
+# the most frequent words, the rest of the vocabulary is made of SYLLABLES
+WORDS = (
+    'adaptive analysis approach assessment bayesian clinical cohort comparison control data design '
+    'detection diagnosis effect efficacy evaluation evidence framework health impact intervention '
+    'learning measurement meta method model network outcome patient performance population prediction '
+    'protocol quality randomized regression risk sample screening selection study survey system '
+    'treatment trial validation'
+).split()
+
+SYLLABLES = (
+    'ba be bi bo ca co da de di do fa fe fi ga ge go la le li lo ma me mi mo na ne ni no pa pe pi po '
+    'ra re ri ro sa se si so ta te ti to va ve vi vo za ze zi zo tra pro con ex in ul an er'
+).split()
+VOCABULARY_SIZE = 20_000
+# word frequencies fall off like 1 / rank ** ZIPF_EXPONENT
+ZIPF_EXPONENT = 0.8
+# share of studies that are another study imported again, with a different DOI and small edits
+DUPLICATE_RATE = 0.01
+
+SURNAMES = (
+    'Smith Garcia Müller Rossi Silva Kim Nguyen Novak Jensen Dubois Kowalski Tanaka Ivanov Cohen '
+    'Okafor Larsen Moreno Fischer Schmidt Wang Lopez Andersen Costa Ricci'
+).split()
+
+
+def default_fanout(tags, depth):
+    '''The smallest fan-out for which a complete tree of the given depth has at least this many tags.'''
+    fanout = 1
+    while depth > 0 and sum(fanout ** level for level in range(1, depth + 1)) < tags:
+        fanout += 1
+    return fanout
+
+
+class _Text:
+    '''
+    Random text over a vocabulary of made-up words with Zipf-like frequencies, so that unrelated
+    studies share few title and abstract shingles, as in real reviews, and the duplicate index
+    gets small buckets.
+    '''
+    def __init__(self, rng, size=VOCABULARY_SIZE):
+        self.rng = rng
+        made_up = set()
+        while len(made_up) < size - len(WORDS):
+            made_up.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+        self.vocabulary = WORDS + sorted(made_up - set(WORDS))
+        self.cum_weights = list(itertools.accumulate(1 / rank ** ZIPF_EXPONENT for rank in range(1, len(self.vocabulary) + 1)))
+
+    def _draw(self, count):
+        return self.rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=count)
+
+    def words(self, count):
+        return ' '.join(self._draw(count)).capitalize()
+
+    def paragraph(self, words):
+        drawn = self._draw(words)
+        sentences, start = [], 0
+        while start < words:
+            end = start + self.rng.randint(8, 20)
+            sentences.append(' '.join(drawn[start:end]).capitalize() + '.')
+            start = end
+        return ' '.join(sentences)
+
+
+class _Skewed:
+    '''Draws ids with a Zipf-like popularity, so a few tags and authors are used by many studies.'''
+    def __init__(self, rng, ids):
+        self.rng = rng
+        self.ids = list(ids)
+        self.rng.shuffle(self.ids)
+        self.cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(self.ids) + 1)))
+
+    def sample(self, count):
+        if not self.ids or count <= 0:
+            return set()
+        total = self.cum_weights[-1]
+        return {
+            self.ids[min(bisect(self.cum_weights, self.rng.random() * total), len(self.ids) - 1)]
+            for _ in range(min(count, len(self.ids)))
+        }
+
+
+def _insert_pairs(table, columns, rows):
+    '''Plain multi-row insert for the M2M tables, model instances are not needed there.'''
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES (%s, %s)', rows)
+
+
+def seed_review(owner, name='Synthetic review', studies=1000, tags=None, tag_depth=3, tag_fanout=5,
+                authors=200, tags_per_study=3, authors_per_study=3, abstract_words=150, seed=0, build_indexes=False,
+                progress=None):
+    '''
+    Creates a synthetic review and returns it.
+
+    The tag tree is filled level by level with tag_fanout children per tag (and tag_fanout roots),
+    down to tag_depth levels or until there are tags tags. Studies get on average tags_per_study
+    tags and authors_per_study authors with a skewed popularity, flags at the FLAG_RATES and
+    an abstract of about abstract_words words. About DUPLICATE_RATE of the studies repeat an earlier
+    study with small edits.
+    The search and duplicate indexes are only built with build_indexes=True, the duplicate index takes most
+    of the time on large reviews.
+    progress, if given, is called with (phase, seconds) after every phase.
+    '''
+    rng = random.Random(seed)
+    text = _Text(rng)
+    start = time.perf_counter()
+
+    def done(phase):
+        nonlocal start
+        now = time.perf_counter()
+        if progress is not None:
+            progress(phase, now - start)
+        start = now
+
+    with transaction.atomic():
+        review = Review.objects.create(name=name, owner=owner)
+
+        tag_ids = []
+        parents = [None]
+        for level in range(tag_depth):
+            new_tags = []
+            for parent_id, index in itertools.product(parents, range(tag_fanout)):
+                if tags is not None and len(tag_ids) + len(new_tags) >= tags:
+                    break
+                new_tags.append(Tag(
+                    review=review, parent_tag_id=parent_id, name=f'Tag {level + 1}.{len(new_tags) + 1}',
+                    description=text.words(6),
+                ))
+            if not new_tags:
+                break
+            Tag.objects.bulk_create(new_tags, batch_size=BATCH_SIZE)
+            TagClosure.add_tags(tag.id for tag in new_tags)
+            parents = [tag.id for tag in new_tags]
+            tag_ids.extend(parents)
+        done('tags')
+
+        Author.objects.bulk_create(
+            [Author(review=review, name=f'{rng.choice(SURNAMES)}, {chr(65 + index % 26)}. ({index + 1})')
+             for index in range(authors)],
+            batch_size=BATCH_SIZE,
+        )
+        author_ids = list(Author.objects.filter(review=review).order_by('id').values_list('id', flat=True))
+        done('authors')
+
+        tag_picker = _Skewed(rng, tag_ids)
+        author_picker = _Skewed(rng, author_ids)
+        for offset in range(0, studies, BATCH_SIZE):
+            batch = []
+            for index in range(offset, min(offset + BATCH_SIZE, studies)):
+                if batch and rng.random() < DUPLICATE_RATE:
+                    # the same paper from another database: other letter case, a word less in the abstract
+                    original = rng.choice(batch)
+                    title, abstract = original.title.upper(), original.abstract.split(' ', 1)[-1]
+                else:
+                    title, abstract = f'{text.words(rng.randint(6, 14))} ({index + 1})', text.paragraph(abstract_words)
+                batch.append(Study(
+                    review=review,
+                    title=title,
+                    year=rng.randint(1990, 2025),
+                    summary=text.paragraph(30),
+                    abstract=abstract,
+                    flags=[flag for flag, rate in FLAG_RATES.items() if rng.random() < rate],
+                    doi=f'10.5555/synthetic.{seed}.{index + 1}',
+                    pages=f'{rng.randint(1, 400)}-{rng.randint(401, 800)}',
+                ))
+            Study.objects.bulk_create(batch)
+            done('studies')
+
+            tag_rows, author_rows = [], []
+            for study in batch:
+                tag_rows.extend((study.id, tag_id) for tag_id in tag_picker.sample(rng.randint(0, 2 * tags_per_study)))
+                author_rows.extend(
+                    (study.id, author_id)
+                    for author_id in author_picker.sample(rng.randint(1, max(1, 2 * authors_per_study - 1)))
+                )
+            _insert_pairs(Study.tags.through._meta.db_table, ['study_id', 'tag_id'], tag_rows)
+            _insert_pairs(Study.authors.through._meta.db_table, ['study_id', 'author_id'], author_rows)
+            done('relations')
+
+        if build_indexes:
+            search.rebuild(review.id)
+            done('search_index')
+            dedupe.rebuild(review.id)
+            done('duplicate_index')
+        bump_review_version(review.id)
+    return review
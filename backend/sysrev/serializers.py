@@ -1,6 +1,13 @@
 from rest_framework import serializers
-from .models import Tag, Study, Author, Review
+from rest_framework.relations import MANY_RELATION_KWARGS
+from .models import Tag, Study, Author, Review, ReviewChange, Job
+from . import search, dedupe
+from .changes import record_changes
+from .importer import BATCH_SIZE
+from django.urls import reverse
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 
 
 class ReviewSerializer(serializers.ModelSerializer):
@@ -43,20 +50,186 @@ class TagSerializer(serializers.ModelSerializer):
         return []
     
     
+def study_pdf_url(study):
+    if study.pdf_id is None:
+        return None
+    return f"{reverse('study-pdf', args=[study.id])}?review_id={study.review_id}"
+
+
+class ReviewScopedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    '''
+    A primary key field that only accepts objects of the review in context['review_id']
+    (matched on review_lookup). Ids are resolved in batches: a list of ids takes one query, and
+    the objects are remembered in the context, so StudyListSerializer can resolve the ids of a
+    whole payload up front.
+    '''
+    def __init__(self, review_lookup='review_id', **kwargs):
+        self.review_lookup = review_lookup
+        super().__init__(**kwargs)
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return ReviewScopedManyRelatedField(**list_kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        review_id = self.context.get('review_id')
+        if review_id is not None:
+            queryset = queryset.filter(**{self.review_lookup: review_id})
+        return queryset
+
+    def to_pk(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+    def resolve(self, pks):
+        '''Loads the objects of the ids not seen yet with one query. Returns {id: object or None}.'''
+        objects = self.context.setdefault('related_objects', {}).setdefault(self.queryset.model, {})
+        missing = {pk for pk in pks if pk not in objects}
+        if missing:
+            found = {obj.pk: obj for obj in self.get_queryset().filter(pk__in=missing)}
+            objects.update({pk: found.get(pk) for pk in missing})
+        return objects
+
+    def to_internal_value(self, data):
+        pk = self.to_pk(data)
+        obj = self.resolve([pk])[pk]
+        if obj is None:
+            self.fail('does_not_exist', pk_value=pk)
+        return obj
+
+
+class ReviewScopedManyRelatedField(serializers.ManyRelatedField):
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        pks = list(dict.fromkeys(self.child_relation.to_pk(item) for item in data))
+        objects = self.child_relation.resolve(pks)
+        for pk in pks:
+            if objects[pk] is None:
+                self.child_relation.fail('does_not_exist', pk_value=pk)
+        return [objects[pk] for pk in pks]
+
+
+class StudyListSerializer(serializers.ListSerializer):
+    '''
+    Validates a list of studies with one query per related model, and creates them with bulk inserts.
+    The bulk inserts send no signals, so the search index and change feed are updated here.
+    '''
+    RELATED_FIELDS = ('review', 'tags', 'authors')
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            for name in self.RELATED_FIELDS:
+                field = self.child.fields.get(name)
+                if field is None or field.read_only:
+                    continue
+                many = isinstance(field, serializers.ManyRelatedField)
+                relation = field.child_relation if many else field
+                pks = []
+                for item in data:
+                    values = item.get(name) if isinstance(item, dict) else None
+                    if values is None:
+                        continue
+                    for value in (values if many and isinstance(values, list) else [values]):
+                        try:
+                            pks.append(relation.to_pk(value))
+                        except serializers.ValidationError:
+                            pass  # reported by the field when the item is validated
+                relation.resolve(pks)
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        studies, tag_rows, author_rows = [], [], []
+        with transaction.atomic():
+            for attrs in validated_data:
+                attrs = dict(attrs)
+                tags, authors = attrs.pop('tags', []), attrs.pop('authors', [])
+                studies.append((Study(**attrs), tags, authors))
+            Study.objects.bulk_create([study for study, _, _ in studies], batch_size=BATCH_SIZE)
+            for study, tags, authors in studies:
+                tag_rows.extend(Study.tags.through(study_id=study.id, tag_id=tag.id) for tag in tags)
+                author_rows.extend(Study.authors.through(study_id=study.id, author_id=author.id) for author in authors)
+            Study.tags.through.objects.bulk_create(tag_rows, batch_size=BATCH_SIZE)
+            Study.authors.through.objects.bulk_create(author_rows, batch_size=BATCH_SIZE)
+
+            studies = [study for study, _, _ in studies]
+            search.index_studies([study.id for study in studies])
+            dedupe.add_studies(studies)
+            for review_id in {study.review_id for study in studies}:
+                record_changes(review_id, ReviewChange.STUDY, [study.id for study in studies if study.review_id == review_id], ReviewChange.CREATE)
+
+        prefetch_related_objects(studies, *StudySerializer.prefetch_lookups())
+        return studies
+
+
 class StudySerializer(serializers.ModelSerializer):
-    #write only fields for tags and authors using id arrays
-    tags = serializers.PrimaryKeyRelatedField(queryset=Tag.objects.all(), many=True, write_only=True)
-    authors = serializers.PrimaryKeyRelatedField(queryset=Author.objects.all(), many=True, write_only=True)
+    #write only fields for tags and authors using id arrays, limited to the review in context['review_id']
+    tags = ReviewScopedPrimaryKeyRelatedField(queryset=Tag.objects.all(), many=True, write_only=True)
+    authors = ReviewScopedPrimaryKeyRelatedField(queryset=Author.objects.all(), many=True, write_only=True)
+    review = ReviewScopedPrimaryKeyRelatedField(queryset=Review.objects.all(), review_lookup='id')
 
-    #read only fields for tags and authors using string representations 
-    tags_display = TagSerializer(source='tags', many=True, read_only=True)
+    #read only fields for tags and authors using flat references and string representations
+    tags_display = serializers.SerializerMethodField()
+    pdf_url = serializers.SerializerMethodField()
     authors_display = serializers.StringRelatedField(source='authors', many=True, read_only=True)
 
     class Meta:
         model = Study
-        fields = ['id', 'title', 'year', 'summary', 'abstract', 'flags', 'tags', 'tags_display', 'authors', 'authors_display', 'doi', 'url', 'pages', 'pathto_pdf', 'review']
+        fields = ['id', 'title', 'year', 'summary', 'abstract', 'flags', 'tags', 'tags_display', 'authors', 'authors_display', 'doi', 'url', 'pages', 'pathto_pdf', 'pdf_url', 'review']
+        list_serializer_class = StudyListSerializer
+
+    VALID_FLAGS = {"Reviewed", "Pending Review", "Missing Data", "Flagged", "Possible Duplicate"}
+
+    #fields=[...] restricts the serialized fields to the given subset
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @staticmethod
+    def prefetch_lookups(fields=None):
+        '''
+        The prefetches loading the tags and authors of studies with one query each.
+        When a field subset is given, only the relations it renders are loaded.
+        '''
+        lookups = []
+        if fields is None or 'tags_display' in fields:
+            lookups.append(Prefetch('tags', queryset=Tag.objects.only('id', 'name', 'parent_tag')))
+        if fields is None or 'authors_display' in fields:
+            lookups.append(Prefetch('authors', queryset=Author.objects.only('id', 'name')))
+        return lookups
 
-    VALID_FLAGS = {"Reviewed", "Pending Review", "Missing Data", "Flagged"}
+    @staticmethod
+    def prefetch(queryset, fields=None):
+        '''Loads the tags and authors of every study in the queryset with one query each.'''
+        return queryset.prefetch_related(*StudySerializer.prefetch_lookups(fields))
+
+    #flat tag references, the hierarchy is resolved by the client through parent_tag.
+    #references are shared through a per-request index so each tag is rendered once.
+    def get_tags_display(self, obj):
+        tag_index = self.context.setdefault('tag_index', {})
+        refs = []
+        for tag in obj.tags.all():
+            ref = tag_index.get(tag.id)
+            if ref is None:
+                ref = tag_index[tag.id] = {'id': tag.id, 'name': tag.name, 'parent_tag': tag.parent_tag_id}
+            refs.append(ref)
+        return refs
+
+    def get_pdf_url(self, obj):
+        return study_pdf_url(obj)
 
     def validate_flags(self, value):
         if not isinstance(value, list):
@@ -71,4 +244,17 @@ class AuthorSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Author
-        fields = ['id', 'name', 'studies', 'review']
\ No newline at end of file
+        fields = ['id', 'name', 'studies', 'review']
+
+class JobSerializer(serializers.ModelSerializer):
+    result_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'review', 'status', 'phase', 'rows_processed', 'report', 'error',
+                  'created_at', 'started_at', 'finished_at', 'result_url']
+
+    def get_result_url(self, obj):
+        if obj.status == Job.DONE and obj.result_path:
+            return reverse('job-result', args=[obj.id])
+        return None
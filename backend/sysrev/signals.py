@@ -0,0 +1,134 @@
+'''
+Signal handlers that keep derived data in sync with studies, authors and tags.
+Bulk code paths (bulk_create, update, raw SQL) do not send these signals and must update the derived data themselves.
+'''
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from . import search, dedupe
+from .changes import record_changes
+from .models import Review, ReviewChange, Study, Author, Tag, TagClosure
+
+
+def deleted_with_review(origin):
+    '''
+    Whether a delete cascades from a review (or from a user and their reviews). The derived data of
+    the whole review is removed once by remove_deleted_review instead of once per study, tag or author.
+    '''
+    return (origin.model if isinstance(origin, QuerySet) else type(origin)) in (Review, User)
+
+
+@receiver(pre_delete, sender=Review)
+def remove_deleted_review(sender, instance, **kwargs):
+    # the change feed of the review goes with it, only the search index is not a foreign key of the review
+    search.remove_review(instance.id)
+
+
+@receiver(post_save, sender=Study)
+def index_saved_study(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_studies([instance.id])
+
+
+@receiver(post_delete, sender=Study)
+def unindex_deleted_study(sender, instance, origin=None, **kwargs):
+    if not deleted_with_review(origin):
+        search.remove_studies([instance.id])
+
+
+@receiver(m2m_changed, sender=Study.authors.through)
+def index_study_authors(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        search.index_studies([instance.id])
+    elif pk_set:
+        search.index_studies(pk_set)
+    else:
+        # clearing an author's studies does not report which studies were affected
+        search.rebuild(instance.review_id)
+
+
+@receiver(post_save, sender=Author)
+def index_author_studies(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        search.index_studies(instance.studies.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+def index_deleted_author_studies(sender, instance, origin=None, **kwargs):
+    if deleted_with_review(origin):
+        return
+    # the through rows are gone after the delete, so the studies are collected first
+    study_ids = list(instance.studies.values_list('id', flat=True))
+    if study_ids:
+        transaction.on_commit(lambda: search.index_studies(study_ids))
+
+
+# Near-duplicate index, see sysrev/dedupe.py
+
+DUPLICATE_KEY_FIELDS = {'title', 'abstract', 'doi', 'review'}
+
+
+@receiver(post_save, sender=Study)
+def index_study_duplicate_keys(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if created:
+        dedupe.add_studies([instance])
+    elif update_fields is None or DUPLICATE_KEY_FIELDS & set(update_fields):
+        dedupe.index_study(instance)
+
+
+# Change feed, see sysrev/changes.py. Logging a change also bumps the review version, see sysrev/cache.py
+
+CHANGE_ENTITIES = {Study: ReviewChange.STUDY, Tag: ReviewChange.TAG, Author: ReviewChange.AUTHOR}
+
+
+@receiver(post_save, sender=Study)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Author)
+def log_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        record_changes(instance.review_id, CHANGE_ENTITIES[sender], [instance.id], ReviewChange.CREATE if created else ReviewChange.UPDATE)
+
+
+@receiver(post_delete, sender=Study)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Author)
+def log_deleted(sender, instance, origin=None, **kwargs):
+    if not deleted_with_review(origin):
+        record_changes(instance.review_id, CHANGE_ENTITIES[sender], [instance.id], ReviewChange.DELETE)
+
+
+@receiver(m2m_changed, sender=Study.tags.through)
+@receiver(m2m_changed, sender=Study.authors.through)
+def log_relation_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # clearing a tag's or author's studies does not report which studies were affected
+        instance._cleared_study_ids = list(instance.studies.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        study_ids = [instance.id] if pk_set or action == 'post_clear' else []
+    elif action == 'post_clear':
+        study_ids = instance.__dict__.pop('_cleared_study_ids', [])
+    else:
+        study_ids = pk_set
+    record_changes(instance.review_id, ReviewChange.STUDY, study_ids, ReviewChange.UPDATE)
+
+
+# Tag closure table
+
+@receiver(post_save, sender=Tag)
+def update_tag_closure(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        TagClosure.add_tags([instance.id])
+        return
+    old_parent_id = TagClosure.objects.filter(descendant_id=instance.id, depth=1).values_list('ancestor_id', flat=True).first()
+    if old_parent_id != instance.parent_tag_id:
+        TagClosure.move_subtree(instance.id, instance.parent_tag_id)
@@ -0,0 +1,366 @@
+'''
+Query count and latency budgets for every API route.
+
+The endpoints run against a synthetic review (see sysrev/seeding.py) sized by the
+SYSREV_BENCH_STUDIES, SYSREV_BENCH_TAG_DEPTH, SYSREV_BENCH_TAG_FANOUT and SYSREV_BENCH_AUTHORS
+environment variables. The query ceilings do not depend on the size, so an N+1 regression fails
+whatever the size. Every request is repeated SYSREV_BENCH_REPEAT times with a cold response cache,
+and SYSREV_BENCH_REPORT=path writes the query counts and p50/p95 latencies (ms) per endpoint
+as JSON, to be compared across commits:
+
+    SYSREV_BENCH_STUDIES=5000 SYSREV_BENCH_REPORT=bench.json python manage.py test sysrev.test_budgets
+'''
+import json
+import math
+import os
+import subprocess
+import tempfile
+import time
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, reverse
+from rest_framework.test import APIClient
+from backend.urls import urlpatterns
+from . import changes, jobs, profiling
+from .exporters import CHUNK_SIZE
+from .models import Review, ReviewChange, Tag, Study, Author, Job
+from .seeding import seed_review
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+SIZES = {
+    'studies': env_int('SYSREV_BENCH_STUDIES', 300),
+    'tag_depth': env_int('SYSREV_BENCH_TAG_DEPTH', 3),
+    'tag_fanout': env_int('SYSREV_BENCH_TAG_FANOUT', 4),
+    'authors': env_int('SYSREV_BENCH_AUTHORS', 100),
+}
+REPEAT = env_int('SYSREV_BENCH_REPEAT', 5)
+REPORT_PATH = os.environ.get('SYSREV_BENCH_REPORT')
+
+# label: (route name, query ceiling[, extra queries per chunk of exported studies])
+BUDGETS = {
+    'review_list': ('review-list', 2),
+    'review_create': ('review-list', 1),
+    'review_detail': ('review-detail', 2),
+    'review_changes': ('review-changes', 7),
+    'review_change_stream': ('review-change-stream', 7),
+    'review_update': ('review-detail', 3),
+    # the same for any number of studies, test_reviews deletes reviews of 20 and 200 studies
+    'review_delete': ('review-detail', 22),
+    'tag_tree': ('tag-tree', 2),
+    'tag_tree_depth': ('tag-tree', 2),
+    'tag_create': ('tag-tree', 8),
+    'tag_move': ('tag-tree', 10),
+    'tag_subtree': ('tag-detail', 2),
+    'tag_update': ('tag-detail', 5),
+    'tag_delete': ('tag-detail', 7),
+    'study_list': ('study-list', 4),
+    'study_list_fields': ('study-list', 4),
+    'study_list_filtered': ('study-list', 4),
+    'study_list_page': ('study-list', 4),
+    'study_create': ('study-list', 23),
+    'study_create_many': ('study-list', 17),
+    'study_search': ('study-search', 1),
+    # candidates are read 500 at a time, the studies created by the earlier checks of test_studies are candidates too
+    'study_duplicates': ('study-duplicates', 6),
+    'study_pdf_upload': ('study-pdf', 13),
+    'study_pdf': ('study-pdf', 1),
+    'study_pdf_range': ('study-pdf', 1),
+    'study_bulk_tags': ('study-bulk', 8),
+    'study_bulk_flags': ('study-bulk', 7),
+    'study_bulk_delete': ('study-bulk', 10),
+    'study_detail': ('study-detail', 4),
+    'study_update': ('study-detail', 19),
+    'study_delete': ('study-detail', 8),
+    'tag_counts': ('tag-study-counts', 2),
+    'tag_tree_counts': ('tag-tree-study-counts', 3),
+    'flag_counts': ('flag-study-counts', 2),
+    # includes the SAVEPOINT and RELEASE of the snapshot transaction, nested in the test case's transaction
+    'tag_analytics': ('tag-analytics', 8),
+    'author_list': ('author-list', 5),
+    'author_create': ('author-list', 6),
+    'author_delete': ('author-list', 10),
+    'author_detail': ('author-detail', 5),
+    'export_json': ('review-export', 3, 2),
+    'export_ndjson': ('review-export', 3, 2),
+    'export_async': ('review-export', 2),
+    'export_csv': ('review-export-csv', 1, 2),
+    'import_json': ('review-import', 31),
+    'token': ('token_obtain_pair', 1),
+    'token_refresh': ('token_refresh', 1),
+    'register': ('register', 2),
+    'job_list': ('job-list', 1),
+    'job_detail': ('job-detail', 1),
+    'job_result': ('job-result', 1),
+    'metrics': ('metrics', 0),
+}
+
+
+def percentile(values, percent):
+    '''Nearest-rank percentile.'''
+    values = sorted(values)
+    return values[max(0, round(percent / 100 * len(values)) - 1)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@override_settings(JOB_FILES_ROOT=tempfile.mkdtemp(prefix='sysrev-bench-'), PDF_STORAGE_ROOT=tempfile.mkdtemp(prefix='sysrev-bench-'))
+class EndpointBudgetTests(TestCase):
+    results = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.password = 'bench-password'
+        cls.user = User.objects.create_user('bench', password=cls.password)
+        cls.review = seed_review(cls.user, build_indexes=True, **SIZES)
+        cls.root = Tag.objects.filter(review=cls.review, parent_tag=None).order_by('id').first()
+        cls.study = Study.objects.filter(review=cls.review).order_by('id').first()
+        cls.author = Author.objects.filter(review=cls.review).order_by('id').first()
+        cls.job = jobs.run_job(jobs.enqueue_export(Job.EXPORT_CSV, cls.review.id))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if REPORT_PATH and cls.results:
+            with open(REPORT_PATH, 'w') as file:
+                json.dump({
+                    'commit': git_commit(),
+                    'database': connection.vendor,
+                    'sizes': SIZES,
+                    'repeat': REPEAT,
+                    'endpoints': dict(sorted(cls.results.items())),
+                }, file, indent=2)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.counter = 0
+
+    def url(self, name, *args, **params):
+        query = '&'.join(f'{key}={value}' for key, value in {'review_id': self.review.id, **params}.items())
+        return f'{reverse(name, args=args)}?{query}'
+
+    def unique(self, prefix):
+        self.counter += 1
+        return f'{prefix} {self._testMethodName} {self.counter}'
+
+    def check(self, label, request, expected_status=200):
+        '''
+        Runs request() REPEAT times with a cold cache, failing if any run takes more queries than
+        the budget of label, and records the query count and latencies.
+        request is called with the run number and returns the response, streamed content is consumed.
+        '''
+        route, ceiling, *per_chunk = BUDGETS[label]
+        if per_chunk:
+            ceiling += per_chunk[0] * math.ceil(SIZES['studies'] / CHUNK_SIZE)
+        timings, query_counts = [], []
+        for run in range(REPEAT):
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = request(run)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                timings.append((time.perf_counter() - start) * 1000)
+            response.close()
+            self.assertEqual(response.status_code, expected_status, getattr(response, 'data', None))
+            query_counts.append(len(queries))
+            self.assertLessEqual(
+                len(queries), ceiling,
+                f'{label} ran {len(queries)} queries, the budget is {ceiling}:\n'
+                + '\n'.join(query['sql'] for query in queries.captured_queries),
+            )
+        self.results[label] = {
+            'route': route,
+            'queries': max(query_counts),
+            'query_budget': ceiling,
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p95_ms': round(percentile(timings, 95), 2),
+        }
+
+    def test_every_route_has_a_budget(self):
+        routes = {pattern.name for pattern in urlpatterns if isinstance(pattern, URLPattern)}
+        self.assertEqual(routes - {budget[0] for budget in BUDGETS.values()}, set())
+
+    # Reviews
+
+    def test_reviews(self):
+        self.check('review_list', lambda run: self.client.get(reverse('review-list')))
+        self.check('review_create', lambda run: self.client.post(
+            reverse('review-list'), {'name': self.unique('Review')}, format='json'), 201)
+        self.check('review_detail', lambda run: self.client.get(reverse('review-detail', args=[self.review.id])))
+
+    def test_changes(self):
+        study_ids = Study.objects.filter(review=self.review).order_by('id').values_list('id', flat=True)[:200]
+        changes.record(self.review.id, [
+            *((ReviewChange.STUDY, study_id, ReviewChange.UPDATE) for study_id in study_ids),
+            (ReviewChange.TAG, self.root.id, ReviewChange.UPDATE),
+            (ReviewChange.AUTHOR, self.author.id, ReviewChange.UPDATE),
+            (ReviewChange.STUDY, 0, ReviewChange.DELETE),
+        ])
+        fields = 'id,title,year,authors_display,flags,tags_display'
+        self.check('review_changes', lambda run: self.client.get(self.url('review-changes', self.review.id, since=0, fields=fields)))
+        with override_settings(CHANGE_STREAM_DURATION=0):
+            self.check('review_change_stream', lambda run: self.client.get(
+                self.url('review-change-stream', self.review.id, since=0, fields=fields)))
+        self.check('review_update', lambda run: self.client.patch(
+            reverse('review-detail', args=[self.review.id]), {'status': run % 2 == 0}, format='json'))
+
+        reviews = [seed_review(self.user, studies=(20, 200)[run % 2], tag_depth=2, tag_fanout=3, authors=10, seed=run)
+                   for run in range(REPEAT)]
+        self.check('review_delete', lambda run: self.client.delete(reverse('review-detail', args=[reviews[run].id])), 204)
+
+    # Tags
+
+    def test_tags(self):
+        self.check('tag_tree', lambda run: self.client.get(self.url('tag-tree')))
+        self.check('tag_tree_depth', lambda run: self.client.get(self.url('tag-tree', depth=1)))
+        self.check('tag_subtree', lambda run: self.client.get(self.url('tag-detail', self.root.id)))
+        self.check('tag_create', lambda run: self.client.post(
+            self.url('tag-tree'), {'name': self.unique('Tag'), 'parent_tag': self.root.id}, format='json'), 201)
+        self.check('tag_update', lambda run: self.client.patch(
+            self.url('tag-detail', self.root.id), {'description': self.unique('Description')}, format='json'))
+
+        other_root = Tag.objects.filter(review=self.review, parent_tag=None).exclude(id=self.root.id).first()
+        leaf = Tag.objects.create(review=self.review, name='Moved', parent_tag=self.root)
+        self.check('tag_move', lambda run: self.client.put(
+            self.url('tag-tree'), {'id': leaf.id, 'parent_tag': (other_root, self.root)[run % 2].id}, format='json'))
+
+        tags = [Tag.objects.create(review=self.review, name=f'Deleted {run}', parent_tag=self.root) for run in range(REPEAT)]
+        self.check('tag_delete', lambda run: self.client.delete(self.url('tag-detail', tags[run].id)), 204)
+
+    # Studies
+
+    def test_study_list(self):
+        self.check('study_list', lambda run: self.client.get(self.url('study-list')))
+        self.check('study_list_fields', lambda run: self.client.get(
+            self.url('study-list', fields='id,title,year,authors_display,flags,tags_display')))
+        self.check('study_list_filtered', lambda run: self.client.get(
+            self.url('study-list', tag=self.root.id, include_descendants='true', flag='Reviewed', year_min=2000)))
+        self.check('study_list_page', lambda run: self.client.get(self.url('study-list', limit=50, cursor='NTA=')))
+
+    def test_studies(self):
+        tag_ids = list(Tag.objects.filter(review=self.review).values_list('id', flat=True)[:3])
+        author_ids = list(Author.objects.filter(review=self.review).values_list('id', flat=True)[:3])
+        self.check('study_create', lambda run: self.client.post(self.url('study-list'), {
+            'title': self.unique('Study'), 'year': 2020, 'flags': ['Reviewed'], 'tags': tag_ids, 'authors': author_ids,
+        }, format='json'), 201)
+        self.check('study_create_many', lambda run: self.client.post(self.url('study-list'), [
+            {'title': self.unique('Study'), 'year': 2020, 'tags': tag_ids[:index % 3 + 1], 'authors': author_ids[:index % 2 + 1]}
+            for index in range(200)
+        ], format='json'), 201)
+        self.check('study_detail', lambda run: self.client.get(self.url('study-detail', self.study.id)))
+        self.check('study_update', lambda run: self.client.patch(self.url('study-detail', self.study.id), {
+            'title': self.unique('Study'), 'tags': tag_ids[:run % 3 + 1],
+        }, format='json'))
+        self.check('study_search', lambda run: self.client.get(self.url('study-search', q='clinical trial')))
+        self.check('study_duplicates', lambda run: self.client.get(self.url('study-duplicates', threshold=(0.8, 0.5)[run % 2])))
+
+        studies = list(Study.objects.filter(review=self.review).order_by('-id')[:REPEAT])
+        self.check('study_delete', lambda run: self.client.delete(self.url('study-detail', studies[run].id)), 204)
+
+    def test_study_pdf(self):
+        pdf = b'%PDF-1.7\n' + os.urandom(512 * 1024)
+        url = self.url('study-pdf', self.study.id)
+        self.check('study_pdf_upload', lambda run: self.client.put(url, pdf, content_type='application/pdf'))
+        self.check('study_pdf', lambda run: self.client.get(url))
+        self.check('study_pdf_range', lambda run: self.client.get(url, HTTP_RANGE=f'bytes={run * 1024}-{run * 1024 + 1023}'), 206)
+
+    def test_study_bulk(self):
+        tag_ids = list(Tag.objects.filter(review=self.review).values_list('id', flat=True)[:2])
+        self.check('study_bulk_tags', lambda run: self.client.post(self.url('study-bulk'), {
+            'filter': {'year_min': 2000}, 'operation': ('add_tags', 'remove_tags')[run % 2], 'tags': tag_ids,
+        }, format='json'))
+        self.check('study_bulk_flags', lambda run: self.client.post(self.url('study-bulk'), {
+            'filter': {'tag': tag_ids[:1], 'include_descendants': True},
+            'operation': ('add_flags', 'clear_flags')[run % 2], 'flags': ['Flagged'],
+        }, format='json'))
+
+        ids = list(Study.objects.filter(review=self.review).order_by('-id').values_list('id', flat=True)[:REPEAT * 10])
+        self.check('study_bulk_delete', lambda run: self.client.post(self.url('study-bulk'), {
+            'ids': ids[run * 10:run * 10 + 10], 'operation': 'delete',
+        }, format='json'))
+
+    def test_counts(self):
+        self.check('tag_counts', lambda run: self.client.get(self.url('tag-study-counts')))
+        self.check('tag_tree_counts', lambda run: self.client.get(self.url('tag-tree-study-counts')))
+        self.check('flag_counts', lambda run: self.client.get(self.url('flag-study-counts')))
+        self.check('tag_analytics', lambda run: self.client.get(self.url('tag-analytics', include_descendants=('false', 'true')[run % 2])))
+
+    # Authors
+
+    def test_authors(self):
+        self.check('author_list', lambda run: self.client.get(self.url('author-list')))
+        self.check('author_detail', lambda run: self.client.get(self.url('author-detail', self.author.id)))
+        self.check('author_create', lambda run: self.client.post(
+            self.url('author-list'), {'name': self.unique('Author')}, format='json'), 201)
+
+        authors = list(Author.objects.filter(review=self.review).order_by('-id')[:REPEAT * 2])
+        self.check('author_delete', lambda run: self.client.delete(
+            self.url('author-list'), {'authors': [author.id for author in authors[run * 2:run * 2 + 2]]}, format='json'))
+
+    # Import and export
+
+    def test_export(self):
+        self.check('export_json', lambda run: self.client.get(self.url('review-export')))
+        self.check('export_ndjson', lambda run: self.client.get(self.url('review-export', export_format='ndjson')))
+        self.check('export_csv', lambda run: self.client.get(self.url('review-export-csv')))
+        self.check('export_async', lambda run: self.client.get(self.url('review-export', **{'async': 'true'})), 202)
+
+    def test_import(self):
+        payload = {
+            'tag_tree': [{'name': 'Imported', 'description': '', 'children': [{'name': 'Child', 'children': []}]}],
+            'authors': [{'name': f'Imported author {index}'} for index in range(50)],
+            'studies': [
+                {'title': f'Imported study {index}', 'year': 2000 + index % 20, 'flags': ['Flagged'],
+                 'tags': ['Imported', 'Child'], 'authors': [f'Imported author {index % 50}']}
+                for index in range(200)
+            ],
+        }
+        reviews = [Review.objects.create(name=f'Import {run}', owner=self.user) for run in range(REPEAT)]
+        self.check('import_json', lambda run: self.client.post(
+            reverse('review-import') + f'?review_id={reviews[run].id}', payload, format='json'))
+
+    # Accounts
+
+    def test_accounts(self):
+        client = APIClient()
+        self.check('register', lambda run: client.post(reverse('register'), {
+            'username': f'user{run}', 'email': f'user{run}@example.com', 'password': 'secret', 'password2': 'secret',
+        }, format='json'), 201)
+        self.check('token', lambda run: client.post(
+            reverse('token_obtain_pair'), {'username': 'bench', 'password': self.password}, format='json'))
+        refresh = client.post(reverse('token_obtain_pair'), {'username': 'bench', 'password': self.password}).data['refresh']
+        self.check('token_refresh', lambda run: client.post(reverse('token_refresh'), {'refresh': refresh}, format='json'))
+
+    # Jobs
+
+    def test_jobs(self):
+        self.check('job_list', lambda run: self.client.get(self.url('job-list')))
+        self.check('job_detail', lambda run: self.client.get(reverse('job-detail', args=[self.job.id])))
+        self.check('job_result', lambda run: self.client.get(reverse('job-result', args=[self.job.id])))
+
+    # Profiling
+
+    @override_settings(SYSREV_PROFILING=True)
+    def test_profiling(self):
+        profiling.metrics.reset()
+        response = self.client.get(self.url('author-list'))
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries", serialize;dur=')
+
+        self.check('metrics', lambda run: self.client.get(reverse('metrics')))
+        response = self.client.get(reverse('metrics'))
+        self.assertIn('sysrev_queries_total{route="api/authors/",method="GET",status="200"}', response.content.decode())
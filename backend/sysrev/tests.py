@@ -1,3 +1,1309 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import zlib
+from datetime import timedelta
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.utils import ConnectionHandler
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.http import FileResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+from rest_framework.test import APIClient
+from . import analytics, changes, jobs, pdftext, profiling, search
+from .blobs import blob_path, prune_blobs
+from .loadtest import SQLITE_PRAGMAS, SQLITE_TRANSACTION_MODE, run_write_load
+from .importer import ReviewImporter
+from .jsonstream import JSONStreamError, iter_ndjson_records, iter_review_records
+from .models import Tag, TagClosure, Study, StudyQuerySet, Author, Job, PdfBlob, Review, ReviewChange
+from .pdftext import extract_file, _extract_builtin, _extract_pypdf, _streams
+from .serializers import StudySerializer
 
-# Create your tests here.
+
+class SQLiteProductionProfileTests(SimpleTestCase):
+    def test_connection_applies_pragmas(self):
+        from backend import settings_production
+        with tempfile.TemporaryDirectory() as directory:
+            profile = {**settings_production.DATABASES['default'], 'NAME': os.path.join(directory, 'db.sqlite3')}
+            connection = ConnectionHandler({'default': profile, 'profile': profile})['profile']
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'wal')
+                    cursor.execute('PRAGMA busy_timeout')
+                    self.assertEqual(cursor.fetchone()[0], 5000)
+                self.assertEqual(connection.transaction_mode, SQLITE_TRANSACTION_MODE)
+            finally:
+                connection.close()
+
+    def test_import_leaves_base_settings_alone(self):
+        from backend import settings_production
+        self.assertIsNot(settings_production.DATABASES['default'], settings.DATABASES['default'])
+        self.assertNotIn('init_command', connection.settings_dict['OPTIONS'])
+        self.assertEqual(connection.settings_dict['CONN_MAX_AGE'], 0)
+
+    def test_concurrent_writers_without_lock_errors(self):
+        writers, writes = 8, 50
+        with tempfile.TemporaryDirectory() as directory:
+            result = run_write_load(
+                os.path.join(directory, 'load.sqlite3'),
+                writers=writers,
+                writes_per_writer=writes,
+                init_commands=SQLITE_PRAGMAS,
+                transaction_mode=SQLITE_TRANSACTION_MODE,
+            )
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['writes'], writers * writes)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class QueryPlanTests(TestCase):
+    '''The hot review-scoped queries must be answered from their indexes, not by scanning tables.'''
+
+    def assertUsesIndex(self, queryset, index=None):
+        '''Checks that the query searches the given index, or any index when index is None.'''
+        plan = queryset.explain().replace('COVERING INDEX', 'INDEX')
+        table = queryset.model._meta.db_table
+        self.assertNotIn(f'SCAN {table}', plan)
+        self.assertIn(f'SEARCH {table} USING INDEX {index or ""}', plan)
+
+    def test_tag_tree_levels(self):
+        self.assertUsesIndex(Tag.objects.filter(review_id=1, parent_tag__isnull=True), 'tag_review_parent_name_idx')
+        self.assertUsesIndex(Tag.objects.filter(review_id=1, parent_tag_id=2), 'tag_review_parent_name_idx')
+
+    def test_import_tag_lookup(self):
+        self.assertUsesIndex(Tag.objects.filter(review_id=1, parent_tag_id=2, name='x'), 'tag_review_parent_name_idx')
+
+    def test_import_study_lookup(self):
+        self.assertUsesIndex(Study.objects.filter(review_id=1, title__in=['a', 'b']), 'study_review_title_year_idx')
+        self.assertUsesIndex(Study.objects.filter(review_id=1, title='a', year=2020), 'study_review_title_year_idx')
+
+    def test_author_lookup(self):
+        self.assertUsesIndex(Author.objects.filter(review_id=1, name='x'), 'sqlite_autoindex_sysrev_author_1')
+
+    def test_tag_subtree(self):
+        self.assertUsesIndex(TagClosure.objects.filter(ancestor_id=1))
+        self.assertUsesIndex(TagClosure.objects.filter(descendant_id=1, depth=1), 'tag_closure_descendant_idx')
+
+    def test_job_queue(self):
+        self.assertUsesIndex(Job.objects.filter(status=Job.QUEUED).order_by('id'), 'job_queue_idx')
+
+
+def make_pdf(lines, year=2019):
+    '''A one page PDF showing the lines in a compressed content stream.'''
+    content = b'BT /F1 12 Tf 72 720 Td ' + b' '.join(b'(%s) Tj T*' % line.encode('latin-1') for line in lines) + b' ET'
+    stream = zlib.compress(content)
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [4 0 R] /Count 1 >>',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        b'<< /Type /Page /Parent 2 0 R /Resources << /Font << /F1 3 0 R >> >> /Contents 5 0 R >>',
+        b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(stream), stream),
+        b'<< /CreationDate (D:%d0101000000) >>' % year,
+    ]
+    pdf = b'%PDF-1.4\n' + b''.join(b'%d 0 obj\n%s\nendobj\n' % (n, body) for n, body in enumerate(objects, 1))
+    return pdf + b'trailer << /Root 1 0 R /Info 6 0 R >>\n%%EOF\n'
+
+
+PAPER = [
+    'Screening heuristics for systematic reviews',
+    'doi:10.1234/sysrev.42',
+    'Abstract',
+    'We compare screening heuristics on twelve reviews.',
+    'Keywords: screening',
+    'Introduction',
+]
+
+
+@override_settings(PDF_STORAGE_ROOT=tempfile.mkdtemp(prefix='sysrev-pdf-test-'))
+class PdfExtractionTests(TestCase):
+    def test_extract_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as file:
+            file.write(make_pdf(PAPER))
+            file.flush()
+            result = extract_file(file.name)
+        self.assertEqual(result['page_count'], 1)
+        self.assertEqual(result['doi'], '10.1234/sysrev.42')
+        self.assertEqual(result['year'], 2019)
+        self.assertEqual(result['abstract'], 'We compare screening heuristics on twelve reviews.')
+
+    def test_decoded_size_is_capped(self):
+        bomb = zlib.compress(b'BT (x) Tj ET ' + b' ' * (32 * 1024 * 1024))
+        pdf = make_pdf(PAPER) + b'7 0 obj\n<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream\nendobj\n' % (len(bomb), bomb)
+        self.assertEqual(sum(len(stream) for stream in _streams(pdf, 1024 * 1024)), 1024 * 1024)
+        text, page_count, year = _extract_builtin(pdf, max_decoded=1024 * 1024)
+        self.assertIn('twelve reviews', text)
+
+    def test_pypdf_text_is_capped(self):
+        pages = [mock.Mock(**{'extract_text.return_value': 'x' * 600}) for _ in range(5)]
+        reader = mock.Mock(pages=pages, metadata=None)
+        with mock.patch.object(pdftext, 'pypdf', mock.Mock(**{'PdfReader.return_value': reader})):
+            text, page_count, year = _extract_pypdf('paper.pdf', max_text=1000)
+        self.assertEqual((text, page_count), ('x' * 600 + '\n\n' + 'x' * 398, 5))
+        self.assertEqual([page.extract_text.call_count for page in pages], [1, 1, 0, 0, 0])
+
+    def test_upload_queues_extraction(self):
+        user = User.objects.create(username='owner')
+        review = Review.objects.create(name='Review', owner=user)
+        study = Study.objects.create(review=review, title='Screening', year=2021)
+        client = APIClient()
+        client.force_authenticate(user)
+        url = f"{reverse('study-pdf', args=[study.id])}?review_id={review.id}"
+
+        response = client.put(url, make_pdf(PAPER + ['The xylophone method.']), content_type='application/pdf')
+        self.assertEqual(response.status_code, 200)
+        job = Job.objects.get(id=response.data['extraction_job']['id'])
+        jobs.run_job(jobs.claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE, job.error)
+
+        study.refresh_from_db()
+        self.assertEqual(study.doi, '10.1234/sysrev.42')
+        self.assertEqual(study.abstract, 'We compare screening heuristics on twelve reviews.')
+        self.assertEqual(study.year, 2021)  # only empty fields are filled in
+        self.assertEqual(study.pages, '1')
+        if search.is_supported():
+            self.assertEqual([result['id'] for result in search.search(review.id, 'xylophone')], [study.id])
+
+        # the text of a file is extracted once, another study with the same PDF gets it right away
+        other = Study.objects.create(review=review, title='Copy')
+        url = f"{reverse('study-pdf', args=[other.id])}?review_id={review.id}"
+        response = client.put(url, make_pdf(PAPER + ['The xylophone method.']), content_type='application/pdf')
+        self.assertIsNone(response.data['extraction_job'])
+        other.refresh_from_db()
+        self.assertEqual(other.doi, '10.1234/sysrev.42')
+
+
+class TagTreeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # created out of name order: nodes are ordered by id
+        self.outcome = Tag.objects.create(review=self.review, name='Outcome')
+        self.design = Tag.objects.create(review=self.review, name='Design', description='Study design')
+        self.trial = Tag.objects.create(review=self.review, name='Trial', parent_tag=self.design)
+        self.cohort = Tag.objects.create(review=self.review, name='Cohort', parent_tag=self.design)
+        self.blinded = Tag.objects.create(review=self.review, name='Blinded', parent_tag=self.trial)
+        Tag.objects.create(review=Review.objects.create(name='Other', owner=self.user), name='Elsewhere')
+
+    def get(self, tag_id=None, **params):
+        url = reverse('tag-detail', args=[tag_id]) if tag_id else reverse('tag-tree')
+        return self.client.get(url, {'review_id': self.review.id, **params})
+
+    def shape(self, nodes):
+        return [(node['name'], self.shape(node['children'])) for node in nodes]
+
+    def test_tree(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.shape(response.data), [
+            ('Outcome', []),
+            ('Design', [('Trial', [('Blinded', [])]), ('Cohort', [])]),
+        ])
+        design = response.data[1]
+        self.assertEqual((design['id'], design['description']), (str(self.design.id), 'Study design'))
+
+        self.assertEqual(self.shape(Tag.build_tree(self.review.id, with_ids=False)), self.shape(response.data))
+        self.assertNotIn('id', Tag.build_tree(self.review.id, with_ids=False)[0])
+
+    def test_depth(self):
+        self.assertEqual(self.shape(self.get(depth=0).data), [('Outcome', []), ('Design', [])])
+        self.assertEqual(self.shape(self.get(depth=1).data), [('Outcome', []), ('Design', [('Trial', []), ('Cohort', [])])])
+        self.assertEqual(self.shape(self.get(depth=5).data), self.shape(self.get().data))
+        self.assertEqual(self.get(depth='-1').status_code, 400)
+        self.assertEqual(self.get(depth='x').status_code, 400)
+
+    def test_study_counts(self):
+        for tags in [
+            [self.blinded, self.cohort],  # in two sibling subtrees, counted once for Design
+            [self.trial, self.blinded],  # on a tag and its child, counted once for Trial
+            [self.design],
+            [self.outcome],
+            [],
+        ]:
+            Study.objects.create(review=self.review, title='Study').tags.set(tags)
+        Study.objects.create(review=Review.objects.get(name='Other'), title='Other').tags.set(Tag.objects.filter(name='Elsewhere'))
+
+        def counts(nodes):
+            return [(node['name'], node['direct_count'], node['total_count'], counts(node['children'])) for node in nodes]
+
+        response = self.client.get(reverse('tag-tree-study-counts'), {'review_id': self.review.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(counts(response.data), [
+            ('Outcome', 1, 1, []),
+            ('Design', 1, 3, [('Trial', 1, 2, [('Blinded', 2, 2, [])]), ('Cohort', 1, 1, [])]),
+        ])
+        self.assertEqual(Tag.study_counts(self.review.id), {
+            self.outcome.id: (1, 1), self.design.id: (1, 3), self.trial.id: (1, 2), self.blinded.id: (2, 2), self.cohort.id: (1, 1),
+        })
+
+    def test_subtree(self):
+        response = self.get(self.design.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.shape([response.data]), [('Design', [('Trial', [('Blinded', [])]), ('Cohort', [])])])
+        self.assertEqual(self.shape([self.get(self.design.id, depth=1).data]), [('Design', [('Trial', []), ('Cohort', [])])])
+        self.assertEqual(self.shape([self.get(self.design.id, depth=0).data]), [('Design', [])])
+        self.assertEqual(self.shape([self.get(self.blinded.id).data]), [('Blinded', [])])
+
+        elsewhere = Tag.objects.get(name='Elsewhere')
+        self.assertEqual(self.get(elsewhere.id).status_code, 404)
+        self.assertNotIn('Elsewhere', str(self.get().data))
+
+
+class StudyListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.design = Tag.objects.create(review=self.review, name='Design')
+        self.trial = Tag.objects.create(review=self.review, name='Trial', parent_tag=self.design)
+        self.ada = Author.objects.create(review=self.review, name='Ada')
+        self.studies = []
+        for title, year, flags, tags in [
+            ('A', 2018, ['Reviewed'], [self.design]),
+            ('B', 2019, [], [self.trial]),
+            ('C', 2020, ['Reviewed', 'Flagged'], [self.design, self.trial]),
+            ('D', None, [], []),
+            ('E', 2022, ['Flagged'], []),
+        ]:
+            study = Study.objects.create(review=self.review, title=title, year=year, flags=flags)
+            study.tags.set(tags)
+            self.studies.append(study)
+        self.studies[1].authors.add(self.ada)
+        Study.objects.create(review=Review.objects.create(name='Other', owner=self.user), title='X', flags=['Reviewed'])
+
+    def get(self, **params):
+        return self.client.get(reverse('study-list'), {'review_id': self.review.id, **params})
+
+    def titles(self, **params):
+        response = self.get(**params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [study['title'] for study in response.data]
+
+    def test_filters(self):
+        self.assertEqual(self.titles(), ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(self.titles(flag='Reviewed'), ['A', 'C'])
+        self.assertEqual(self.titles(tag=self.trial.id), ['B', 'C'])
+        self.assertEqual(self.titles(tag=self.design.id), ['A', 'C'])
+        self.assertEqual(self.titles(tag=self.design.id, include_descendants='true'), ['A', 'B', 'C'])
+        self.assertEqual(self.titles(tag=f'{self.design.id},{self.trial.id}'), ['A', 'B', 'C'])
+        self.assertEqual(self.titles(author=self.ada.id), ['B'])
+        self.assertEqual(self.titles(year_min=2019), ['B', 'C', 'E'])
+        self.assertEqual(self.titles(year_max=2019), ['A', 'B'])
+        self.assertEqual(self.titles(year_min=2019, year_max=2020), ['B', 'C'])
+        self.assertEqual(self.titles(flag='Flagged', year_max=2021, tag=self.trial.id), ['C'])
+
+        for params in ({'tag': 'x'}, {'author': '1,y'}, {'year_min': '20x'}, {'fields': 'id,secret'}, {'limit': 0}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+
+    def test_fields(self):
+        response = self.get(fields='id,title', flag='Flagged')
+        self.assertEqual(response.data, [{'id': self.studies[2].id, 'title': 'C'}, {'id': self.studies[4].id, 'title': 'E'}])
+
+    def test_pagination(self):
+        first = self.get(limit=2).data
+        self.assertEqual([study['title'] for study in first['results']], ['A', 'B'])
+        second = self.get(limit=2, cursor=first['next_cursor']).data
+        self.assertEqual([study['title'] for study in second['results']], ['C', 'D'])
+        last = self.get(limit=2, cursor=second['next_cursor']).data
+        self.assertEqual(([study['title'] for study in last['results']], last['next_cursor']), (['E'], None))
+
+        # a full last page has no next cursor, and a cursor alone pages with the default size
+        self.assertIsNone(self.get(limit=5).data['next_cursor'])
+        rest = self.get(cursor=first['next_cursor']).data
+        self.assertEqual([study['title'] for study in rest['results']], ['C', 'D', 'E'])
+
+        filtered = self.get(limit=1, flag='Reviewed').data
+        self.assertEqual(self.get(limit=1, flag='Reviewed', cursor=filtered['next_cursor']).data['results'][0]['title'], 'C')
+
+        for cursor in ('not a cursor', 'eA=='):
+            response = self.get(cursor=cursor)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data, {'error': 'Invalid cursor'})
+
+    def test_flag_counts_and_rows(self):
+        repeated = Study.objects.create(review=self.review, title='F', flags=['Flagged', 'Missing Data', 'Flagged'])
+        a, b, c, d, e = self.studies
+        expected_rows = sorted([
+            (a.id, 'Reviewed'), (c.id, 'Reviewed'), (c.id, 'Flagged'), (e.id, 'Flagged'),
+            (repeated.id, 'Flagged'), (repeated.id, 'Missing Data'),
+        ])
+
+        studies = Study.objects.filter(review=self.review)
+        elements = StudyQuerySet._flag_elements
+        for database in (True, False):
+            # False reads the flags in Python, as on database backends without JSON array functions
+            with mock.patch.object(StudyQuerySet, '_flag_elements', elements if database else lambda queryset: None):
+                self.assertEqual(studies.flag_counts(), {'Reviewed': 2, 'Flagged': 3, 'Missing Data': 1})
+                self.assertEqual(sorted(studies.flag_rows()), expected_rows)
+                self.assertEqual(studies.filter(id__in=[b.id, d.id]).flag_counts(), {})
+                self.assertEqual(studies.filter(id__in=[b.id, d.id]).flag_rows(), [])
+                self.assertEqual(studies.filter(title__in=['A', 'X']).flag_counts(), {'Reviewed': 1})
+                self.assertEqual(Study.objects.filter(review__name='Other').flag_rows(),
+                                 [(Study.objects.get(title='X').id, 'Reviewed')])
+
+
+class JSONStreamTests(SimpleTestCase):
+    EXPORT = {
+        'tag_tree': [{'name': 'Design', 'description': '', 'children': [{'name': 'Trial', 'description': 'ü', 'children': []}]}],
+        'extra': {'ignored': [1, 2.5e3, None]},
+        'authors': [{'name': 'Zoë Ångström'}, {'name': '李雷'}],
+        'studies': [
+            {'title': 'Emoji 😀 and "quotes"', 'year': 2020, 'flags': [], 'abstract': 'Tab\tnew\nline back\\slash'},
+            {'title': '', 'year': -12345678901234, 'pages': '1–2', 'flags': [True, False]},
+        ],
+        'studies_after': [],
+    }
+    RECORDS = [
+        ('tag_tree', EXPORT['tag_tree']),
+        ('author', EXPORT['authors'][0]),
+        ('author', EXPORT['authors'][1]),
+        ('study', EXPORT['studies'][0]),
+        ('study', EXPORT['studies'][1]),
+    ]
+
+    def read(self, body, chunk_size):
+        return list(iter_review_records(io.BytesIO(body), chunk_size=chunk_size))
+
+    def test_every_chunk_boundary(self):
+        # ensure_ascii=True writes \uXXXX escapes (and surrogate pairs), False writes multi-byte UTF-8
+        for ensure_ascii in (False, True):
+            for indent in (None, 2):
+                body = json.dumps(self.EXPORT, ensure_ascii=ensure_ascii, indent=indent).encode()
+                for chunk_size in range(1, 12):
+                    self.assertEqual(self.read(body, chunk_size), self.RECORDS, (ensure_ascii, indent, chunk_size))
+
+    def test_empty(self):
+        self.assertEqual(self.read(b' {} ', 1), [])
+        self.assertEqual(self.read(b'{"authors": [], "studies": []}', 3), [])
+
+    def test_malformed(self):
+        for body, error in [
+            (b'', 'Expected one of'),
+            (b'[]', 'Expected one of'),
+            (b'{"studies": [{"title": "A"}', 'Expected one of'),
+            (b'{"studies": [{"title": "A"', 'Unexpected end of file'),
+            (b'{"studies": [{"title": "A"} {"title": "B"}]}', 'Expected one of'),
+            (b'{"studies": [{"title": nope}]}', 'Invalid JSON'),
+            (b'{1: []}', 'Object keys must be strings'),
+            (b'{"studies": []} []', 'Unexpected data after the end of the export'),
+            (b'{"title": "\xff"}', 'Invalid UTF-8: invalid start byte'),
+        ]:
+            for chunk_size in (1, 5, 1024):
+                with self.assertRaisesRegex(JSONStreamError, error, msg=(body, chunk_size)):
+                    self.read(body, chunk_size)
+
+    def test_malformed_value_stops_reading(self):
+        tail = json.dumps([{'title': f'Study {i}', 'abstract': 'x' * 1000} for i in range(5000)]).encode()
+        for malformed in (b'{"title": nope}', b'{"title": "A" "year": 1}', b'{"title": "\x01"}'):
+            stream = io.BytesIO(b'{"studies": [' + malformed + b', ' + tail[1:] + b'}')
+            with self.assertRaisesRegex(JSONStreamError, 'Invalid JSON', msg=malformed):
+                list(iter_review_records(stream, chunk_size=1024))
+            # the error is found in the first chunks, not after buffering the 5 MB that follow
+            self.assertLessEqual(stream.tell(), 4 * 1024, malformed)
+
+    def test_ndjson(self):
+        lines = [{'type': 'tag_tree', 'tag_tree': self.EXPORT['tag_tree']}]
+        lines += [{'type': 'author', **author} for author in self.EXPORT['authors']]
+        lines += [{'type': 'study', **self.EXPORT['studies'][0]}, self.EXPORT['studies'][1]]
+        body = '\n\n'.join(json.dumps(line, ensure_ascii=False) for line in lines).encode() + b'\r\n'
+        for chunk_size in range(1, 12):
+            self.assertEqual(list(iter_ndjson_records(io.BytesIO(body), chunk_size=chunk_size)), self.RECORDS)
+
+        for body, error in [
+            (b'{"type": "study"}\n{"title": ', 'Line 2: '),
+            (b'[1]\n', 'Line 1: records must be objects'),
+            (b'{"type": "review"}', "Line 1: unknown record type 'review'"),
+        ]:
+            with self.assertRaisesRegex(JSONStreamError, error):
+                list(iter_ndjson_records(io.BytesIO(body), chunk_size=4))
+
+
+class ReviewImportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.source = Review.objects.create(name='Source', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        design = Tag.objects.create(review=self.source, name='Design', description='Study design')
+        trial = Tag.objects.create(review=self.source, name='Trial', parent_tag=design)
+        # a root created after a child tag: it gets a smaller id than the child in the imported review
+        outcome = Tag.objects.create(review=self.source, name='Outcome')
+        zoe = Author.objects.create(review=self.source, name='Zoe')
+        ada = Author.objects.create(review=self.source, name='Ada')
+        first = Study.objects.create(review=self.source, title='Screening heuristics', year=2020, flags=['Reviewed'], doi='10.1/a')
+        for tag in (trial, outcome, design):
+            first.tags.add(tag)
+        for author in (zoe, ada):
+            first.authors.add(author)
+        Study.objects.create(review=self.source, title='Sampling, ünïcode and "quotes"', abstract='Line\nbreak')
+
+    def export(self, review, **params):
+        response = self.client.get(reverse('review-export'), {'review_id': review.id, **params})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def import_into(self, review, body, content_type='application/json', **params):
+        url = reverse('review-import') + '?' + '&'.join(f'{name}={value}' for name, value in {'review_id': review.id, **params}.items())
+        response = self.client.post(url, body, content_type=content_type)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def export_csv(self, **params):
+        response = self.client.get(reverse('review-export-csv'), {'review_id': self.source.id, **params})
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_csv_columns(self):
+        _, body = self.export_csv()
+        rows = list(csv.reader(io.StringIO(body.decode())))
+        self.assertEqual(rows[0], ['Title', 'Year', 'Summary', 'Abstract', 'Flags', 'Tags', 'Authors', 'DOI', 'URL', 'Pages'])
+        self.assertEqual(rows[1], ['Screening heuristics', '2020', '', '', 'Reviewed', 'Trial, Outcome, Design', 'Zoe, Ada', '10.1/a', '', ''])
+        self.assertEqual(rows[2][:4], ['Sampling, ünïcode and "quotes"', '', '', 'Line\nbreak'])
+
+        _, body = self.export_csv(columns='authors, title')
+        self.assertEqual(list(csv.reader(io.StringIO(body.decode()))),
+                         [['Authors', 'Title'], ['Zoe, Ada', 'Screening heuristics'], ['', 'Sampling, ünïcode and "quotes"']])
+
+        response = self.client.get(reverse('review-export-csv'), {'review_id': self.source.id, 'columns': 'title,isbn,color'})
+        self.assertEqual((response.status_code, response.data), (400, {'error': 'Unknown column(s): color, isbn'}))
+
+    def test_csv_gzip(self):
+        _, plain = self.export_csv(columns='title,tags')
+        response, body = self.export_csv(columns='title,tags', gzip='true')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="review_{self.source.id}_export.csv.gz"')
+        self.assertEqual(gzip.decompress(body), plain)
+        self.assertEqual(list(csv.reader(io.StringIO(plain.decode())))[1], ['Screening heuristics', 'Trial, Outcome, Design'])
+
+    def test_csv_queries(self):
+        for number in range(20):
+            study = Study.objects.create(review=self.source, title=f'Extra {number}')
+            study.tags.add(*Tag.objects.filter(review=self.source))
+            study.authors.add(*Author.objects.filter(review=self.source))
+        # the studies, then one query per prefetched relation, whatever the number of studies
+        with self.assertNumQueries(3):
+            self.export_csv()
+        with self.assertNumQueries(2):
+            self.export_csv(columns='title,tags')
+        with self.assertNumQueries(1):
+            self.export_csv(columns='title,year')
+
+    def test_round_trip(self):
+        exported = self.export(self.source)
+        data = json.loads(exported)
+        self.assertEqual(data['studies'][0]['tags'], ['Trial', 'Outcome', 'Design'])
+        self.assertEqual(data['studies'][0]['authors'], ['Zoe', 'Ada'])
+
+        for params in ({}, {'stream': 'true', 'batch_size': 1}):
+            target = Review.objects.create(name='Target', owner=self.user)
+            report = self.import_into(target, exported, **params)
+            self.assertEqual(report['counts']['studies_created'], 2)
+            self.assertEqual(json.loads(self.export(target)), data, params)
+
+        ndjson = self.export(self.source, export_format='ndjson')
+        target = Review.objects.create(name='Target', owner=self.user)
+        self.import_into(target, ndjson, content_type='application/x-ndjson')
+        self.assertEqual(self.export(target, export_format='ndjson'), ndjson)
+
+    def test_reimport_is_idempotent(self):
+        exported = self.export(self.source)
+        counts = (Study.objects.count(), Tag.objects.count(), Author.objects.count())
+        report = self.import_into(self.source, exported)
+        self.assertEqual(report['counts']['studies_created'], 0)
+        self.assertEqual(report['counts']['studies_updated'], 2)
+        self.assertEqual((report['counts']['tags_created'], report['counts']['authors_created']), (0, 0))
+        self.assertEqual((Study.objects.count(), Tag.objects.count(), Author.objects.count()), counts)
+        self.assertEqual(self.export(self.source), exported)
+
+    def test_year_is_coerced(self):
+        data = {'studies': [{'title': 'Screening heuristics', 'year': '2020', 'summary': 'Updated'}]}
+        report = self.import_into(self.source, json.dumps(data))
+        self.assertEqual((report['counts']['studies_created'], report['counts']['studies_updated']), (0, 1))
+        self.assertEqual(Study.objects.get(review=self.source, title='Screening heuristics').summary, 'Updated')
+
+        data['studies'][0]['year'] = 'soon'
+        url = reverse('review-import') + f'?review_id={self.source.id}'
+        response = self.client.post(url, json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Study year must be an integer')
+
+    def test_malformed_stream(self):
+        url = reverse('review-import') + f'?review_id={self.source.id}'
+        for body, content_type, params in [
+            (b'{"studies": [{"title": "A"},', 'application/json', '&stream=true'),
+            (b'{"studies": [{"title": "A"} "B"]}', 'application/json', '&stream=true'),
+            (b'{"title": "A"}\n{"title": ', 'application/x-ndjson', ''),
+            (b'{"studies": [{"title": "\xff"}]}', 'application/json', '&stream=true'),
+        ]:
+            response = self.client.post(url + params, body, content_type=content_type)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn('error', response.data)
+
+
+class ReviewCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tag = Tag.objects.create(review=self.review, name='Design')
+        self.other_tag = Tag.objects.create(review=self.review, name='Outcome')
+        self.study = Study.objects.create(review=self.review, title='Study')
+
+    def get(self, name, etag=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(reverse(name), {'review_id': self.review.id, **params}, **headers)
+
+    def assertInvalidated(self, name, change):
+        '''The ETag of the response before change gets a 304, after it a 200 with the new data.'''
+        before = self.get(name)
+        self.assertEqual(before.status_code, 200)
+        self.assertEqual(self.get(name, before['ETag']).status_code, 304)
+        change()
+        after = self.get(name, before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertNotEqual(after['ETag'], before['ETag'])
+        self.assertNotEqual(after.data, before.data)
+        self.assertEqual(self.get(name, after['ETag']).status_code, 304)
+        return after
+
+    def test_not_modified(self):
+        response = self.get('study-list')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(self.get('study-list', response['ETag']).status_code, 304)
+        self.assertEqual(self.get('study-list', f'"other", {response["ETag"]}').status_code, 304)
+        self.assertEqual(self.get('study-list', '"other"').status_code, 200)
+        # other parameters are another entry
+        filtered = self.get('study-list', response['ETag'], flag='x')
+        self.assertEqual((filtered.status_code, filtered.data), (200, []))
+
+        # changes in another review keep the ETag
+        Study.objects.create(review=Review.objects.create(name='Other', owner=self.user), title='Other')
+        self.assertEqual(self.get('study-list', response['ETag']).status_code, 304)
+
+    def test_m2m_change(self):
+        after = self.assertInvalidated('study-list', lambda: self.study.tags.add(self.tag))
+        self.assertEqual([tag['id'] for tag in after.data[0]['tags_display']], [self.tag.id])
+        self.assertInvalidated('tag-study-counts', lambda: self.study.tags.remove(self.tag))
+
+    def test_bulk_operation(self):
+        self.study.flags = ['Reviewed']
+        self.study.save()
+        bulk = reverse('study-bulk') + f'?review_id={self.review.id}'
+        after = self.assertInvalidated('study-list', lambda: self.client.post(
+            bulk, {'ids': [self.study.id], 'operation': 'add_tags', 'tags': [self.other_tag.id]}, format='json'))
+        self.assertEqual([tag['id'] for tag in after.data[0]['tags_display']], [self.other_tag.id])
+        self.assertInvalidated('flag-study-counts', lambda: self.client.post(
+            bulk, {'ids': [self.study.id], 'operation': 'delete'}, format='json'))
+
+    def test_tag_move(self):
+        url = reverse('tag-tree') + f'?review_id={self.review.id}'
+        after = self.assertInvalidated('tag-tree', lambda: self.client.put(
+            url, {'id': self.other_tag.id, 'parent_tag': self.tag.id}, format='json'))
+        self.assertEqual([(node['name'], len(node['children'])) for node in after.data], [('Design', 1)])
+
+
+class TagClosureTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.a = Tag.objects.create(review=self.review, name='A')
+        self.b = Tag.objects.create(review=self.review, name='B', parent_tag=self.a)
+        self.c = Tag.objects.create(review=self.review, name='C', parent_tag=self.b)
+        self.d = Tag.objects.create(review=self.review, name='D')
+        self.e = Tag.objects.create(review=self.review, name='E', parent_tag=self.d)
+
+    def closure(self):
+        return set(TagClosure.objects.values_list('ancestor__name', 'descendant__name', 'depth'))
+
+    def reflexive(self, *names):
+        return {(name, name, 0) for name in names}
+
+    def move(self, tag, parent_id):
+        return self.client.put(reverse('tag-tree') + f'?review_id={self.review.id}', {'id': tag.id, 'parent_tag': parent_id}, format='json')
+
+    def test_create(self):
+        self.assertEqual(self.closure(), self.reflexive('A', 'B', 'C', 'D', 'E') | {
+            ('A', 'B', 1), ('A', 'C', 2), ('B', 'C', 1), ('D', 'E', 1),
+        })
+
+    def test_move_under_another_tag(self):
+        self.assertEqual(self.move(self.b, self.e.id).status_code, 200)
+        self.assertEqual(self.closure(), self.reflexive('A', 'B', 'C', 'D', 'E') | {
+            ('D', 'E', 1), ('D', 'B', 2), ('D', 'C', 3), ('E', 'B', 1), ('E', 'C', 2), ('B', 'C', 1),
+        })
+        self.assertEqual(set(Tag.objects.get(id=self.c.id).ancestor_links.values_list('ancestor__name', flat=True)), {'C', 'B', 'E', 'D'})
+
+    def test_move_to_root(self):
+        self.assertEqual(self.move(self.b, 0).status_code, 200)
+        self.assertEqual(self.closure(), self.reflexive('A', 'B', 'C', 'D', 'E') | {('B', 'C', 1), ('D', 'E', 1)})
+        self.b.refresh_from_db()
+        self.assertIsNone(self.b.parent_tag_id)
+
+        # and back, through a save
+        self.b.parent_tag = self.a
+        self.b.save()
+        self.test_create()
+
+    def test_cycles_are_rejected(self):
+        before = self.closure()
+        for tag, parent in ((self.a, self.c), (self.a, self.a), (self.b, self.c)):
+            response = self.move(tag, parent.id)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.closure(), before)
+        self.a.refresh_from_db()
+        self.assertIsNone(self.a.parent_tag_id)
+
+    def test_subtree_delete(self):
+        self.b.delete()
+        self.assertFalse(Tag.objects.filter(name__in=['B', 'C']).exists())
+        self.assertEqual(self.closure(), self.reflexive('A', 'D', 'E') | {('D', 'E', 1)})
+
+    def test_bulk_insert(self):
+        ReviewImporter(self.review.id).import_tag_tree([
+            {'name': 'A', 'children': [{'name': 'F', 'children': [{'name': 'G'}]}]},
+            {'name': 'H'},
+        ])
+        self.assertEqual(self.closure(), self.reflexive('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H') | {
+            ('A', 'B', 1), ('A', 'C', 2), ('B', 'C', 1), ('D', 'E', 1),
+            ('A', 'F', 1), ('A', 'G', 2), ('F', 'G', 1),
+        })
+
+
+class StudyBulkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.design = Tag.objects.create(review=self.review, name='Design')
+        self.trial = Tag.objects.create(review=self.review, name='Trial', parent_tag=self.design)
+        self.reviewed = Study.objects.create(review=self.review, title='Reviewed xylophone', flags=['Reviewed'])
+        self.reviewed.tags.add(self.design)
+        self.plain = Study.objects.create(review=self.review, title='Plain xylophone')
+        self.trials = Study.objects.create(review=self.review, title='Trials', flags=['Flagged'])
+        self.trials.tags.add(self.design, self.trial)
+        self.other = Study.objects.create(review=Review.objects.create(name='Other', owner=self.user), title='Other', flags=['Reviewed'])
+
+    def bulk(self, expected_status=200, **data):
+        seq = ReviewChange.objects.filter(review=self.review).order_by('id').values_list('id', flat=True).last()
+        response = self.client.post(reverse('study-bulk') + f'?review_id={self.review.id}', data, format='json')
+        self.assertEqual(response.status_code, expected_status, response.data)
+        logged = ReviewChange.objects.filter(review=self.review, id__gt=seq).order_by('object_id')
+        return response.data, [(change.object_id, change.op) for change in logged]
+
+    def ids(self):
+        return [self.reviewed.id, self.plain.id, self.trials.id, self.other.id]
+
+    def tags(self, study):
+        return set(study.tags.values_list('name', flat=True))
+
+    def flags(self):
+        return [Study.objects.get(id=study.id).flags for study in (self.reviewed, self.plain, self.trials, self.other)]
+
+    def test_add_tags(self):
+        data, logged = self.bulk(ids=self.ids(), operation='add_tags', tags=[self.trial.id])
+        self.assertEqual((data['matched'], data['changed']), (3, 2))
+        self.assertEqual(logged, [(self.reviewed.id, 'update'), (self.plain.id, 'update')])
+        self.assertEqual([self.tags(study) for study in (self.reviewed, self.plain, self.trials)],
+                         [{'Design', 'Trial'}, {'Trial'}, {'Design', 'Trial'}])
+        self.assertEqual(self.tags(self.other), set())
+
+    def test_remove_tags(self):
+        data, logged = self.bulk(filter={}, operation='remove_tags', tags=[self.trial.id])
+        self.assertEqual((data['matched'], data['changed']), (3, 1))
+        self.assertEqual(logged, [(self.trials.id, 'update')])
+        self.assertEqual(self.tags(self.trials), {'Design'})
+
+        data, logged = self.bulk(filter={}, operation='remove_tags', tags=[self.trial.id])
+        self.assertEqual((data['changed'], logged), (0, []))
+
+    def test_add_flags(self):
+        data, logged = self.bulk(ids=self.ids(), operation='add_flags', flags=['Reviewed', 'Missing Data'])
+        self.assertEqual((data['matched'], data['changed']), (3, 3))
+        self.assertEqual(self.flags(), [['Reviewed', 'Missing Data'], ['Reviewed', 'Missing Data'], ['Flagged', 'Reviewed', 'Missing Data'], ['Reviewed']])
+
+        data, logged = self.bulk(ids=self.ids(), operation='add_flags', flags=['Missing Data'])
+        self.assertEqual((data['changed'], logged), (0, []))
+
+    def test_clear_flags(self):
+        data, logged = self.bulk(filter={'tag': [self.design.id]}, operation='clear_flags', flags=['Reviewed'])
+        self.assertEqual((data['matched'], data['changed']), (2, 1))
+        self.assertEqual(logged, [(self.reviewed.id, 'update')])
+
+        data, logged = self.bulk(filter={}, operation='clear_flags')
+        self.assertEqual((data['matched'], data['changed']), (3, 1))
+        self.assertEqual(logged, [(self.trials.id, 'update')])
+        self.assertEqual(self.flags(), [[], [], [], ['Reviewed']])
+
+    def test_filter(self):
+        data, _ = self.bulk(filter={'tag': [self.design.id], 'include_descendants': True, 'flag': 'Flagged'},
+                            operation='add_flags', flags=['Missing Data'])
+        self.assertEqual((data['matched'], data['changed']), (1, 1))
+        self.assertEqual(self.flags()[2], ['Flagged', 'Missing Data'])
+
+    def test_delete(self):
+        if search.is_supported():
+            self.assertEqual(len(search.search(self.review.id, 'xylophone')), 2)
+        data, logged = self.bulk(filter={'tag': [self.design.id]}, operation='delete')
+        self.assertEqual((data['matched'], data['changed']), (2, 2))
+        self.assertEqual(logged, [(self.reviewed.id, 'delete'), (self.trials.id, 'delete')])
+        self.assertEqual(list(Study.objects.filter(review=self.review)), [self.plain])
+        self.assertFalse(Study.tags.through.objects.filter(study_id__in=[self.reviewed.id, self.trials.id]).exists())
+        if search.is_supported():
+            self.assertEqual([result['id'] for result in search.search(self.review.id, 'xylophone')], [self.plain.id])
+
+    def test_invalid(self):
+        elsewhere = Tag.objects.create(review=self.other.review, name='Elsewhere')
+        for data in [
+            {'ids': self.ids(), 'operation': 'add_tags', 'tags': [self.trial.id, elsewhere.id]},
+            {'ids': self.ids(), 'operation': 'remove_tags', 'tags': []},
+            {'ids': self.ids(), 'operation': 'set_flags', 'flags': ['Reviewed']},
+            {'ids': self.ids(), 'operation': 'add_flags', 'flags': []},
+            {'ids': self.ids(), 'filter': {}, 'operation': 'delete'},
+            {'ids': ['1'], 'operation': 'delete'},
+            {'ids': [True, False], 'operation': 'delete'},
+            {'ids': self.ids(), 'operation': 'add_tags', 'tags': [True]},
+            {'filter': {'tag': 'x'}, 'operation': 'delete'},
+        ]:
+            _, logged = self.bulk(expected_status=400, **data)
+            self.assertEqual(logged, [])
+        self.assertEqual(Study.objects.count(), 4)
+        self.assertEqual(self.tags(self.plain), set())
+
+
+@override_settings(PDF_STORAGE_ROOT=tempfile.mkdtemp(prefix='sysrev-pdf-test-'))
+class StudyPdfTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.study = Study.objects.create(review=self.review, title='Study')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.pdf = b'%PDF-1.4\n' + bytes(range(256)) * 4
+        self.url = self.upload(self.study, self.pdf)
+        self.etag = self.client.get(self.url)['ETag']
+
+    def upload(self, study, pdf):
+        url = f"{reverse('study-pdf', args=[study.id])}?review_id={self.review.id}"
+        response = self.client.put(url, pdf, content_type='application/pdf')
+        self.assertEqual(response.status_code, 200, response.data)
+        return url
+
+    def get(self, **headers):
+        response = self.client.get(self.url, **{f'HTTP_{name.upper().replace("-", "_")}': value for name, value in headers.items()})
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_ranges(self):
+        size = len(self.pdf)
+        response, content = self.get()
+        self.assertEqual((response.status_code, content, response['Accept-Ranges']), (200, self.pdf, 'bytes'))
+
+        for header, start, end in [
+            ('bytes=0-9', 0, 9),
+            ('bytes=10-', 10, size - 1),
+            ('bytes=-5', size - 5, size - 1),
+            ('bytes=-100000', 0, size - 1),
+            (f'bytes={size - 3}-{size + 100}', size - 3, size - 1),
+        ]:
+            response, content = self.get(Range=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(content, self.pdf[start:end + 1], header)
+            self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/{size}')
+            self.assertEqual(int(response['Content-Length']), end - start + 1)
+
+        for header in (f'bytes={size}-', 'bytes=9-3', 'bytes=-0'):
+            response, _ = self.get(Range=header)
+            self.assertEqual(response.status_code, 416, header)
+            self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    @override_settings(SYSREV_PROFILING=True)
+    def test_profiling_keeps_file_wrapper(self):
+        profiling.metrics.reset()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for headers, expected in (({}, self.pdf), ({'HTTP_RANGE': 'bytes=10-19'}, self.pdf[10:20])):
+            response = client.get(self.url, **headers)
+            self.assertIn('Server-Timing', response)
+            self.assertEqual(b''.join(response.streaming_content), expected)
+        rendered = profiling.metrics.render()
+        for status, size in ((200, len(self.pdf)), (206, 10)):
+            self.assertIn(f'sysrev_response_bytes_total{{route="api/studies/<int:study_id>/pdf/",method="GET",status="{status}"}} {size}', rendered)
+
+        # the test client wraps every stream itself, so the middleware is called directly: the file is left
+        # for the WSGI handler to send with wsgi.file_wrapper, other streams are still counted as they are sent
+        request = RequestFactory().get(self.url)
+        response = profiling.ProfilingMiddleware(lambda request: FileResponse(io.BytesIO(self.pdf)))(request)
+        self.assertIsNotNone(response.file_to_stream)
+        self.assertIn('Server-Timing', response)
+        response = profiling.ProfilingMiddleware(lambda request: StreamingHttpResponse(iter([b'a', b'bc'])))(request)
+        self.assertEqual(b''.join(response.streaming_content), b'abc')
+
+        # not a single byte range: the whole file
+        for header in ('bytes=0-1,4-5', 'items=0-9'):
+            response, content = self.get(Range=header)
+            self.assertEqual((response.status_code, content), (200, self.pdf))
+
+    def test_validators(self):
+        response, content = self.get(Range='bytes=0-9', **{'If-Range': self.etag})
+        self.assertEqual((response.status_code, content), (206, self.pdf[:10]))
+        response, content = self.get(Range='bytes=0-9', **{'If-Range': '"changed"'})
+        self.assertEqual((response.status_code, content), (200, self.pdf))
+        response, _ = self.get(**{'If-None-Match': self.etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_prune_unused_blobs(self):
+        shared = Study.objects.create(review=self.review, title='Shared')
+        self.upload(shared, self.pdf)
+        replaced = Study.objects.create(review=self.review, title='Replaced')
+        self.upload(replaced, self.pdf + b'first version')
+        self.upload(replaced, self.pdf + b'second version')
+        self.assertEqual(PdfBlob.objects.count(), 3)
+        paths = {blob.sha256: blob_path(blob.sha256) for blob in PdfBlob.objects.all()}
+        first = PdfBlob.objects.get(size=len(self.pdf + b'first version'))
+
+        self.assertEqual(prune_blobs(), 0)  # the grace period protects new uploads
+        self.assertEqual(prune_blobs(before=now()), 1)
+        self.assertFalse(PdfBlob.objects.filter(id=first.id).exists())
+        self.assertFalse(paths[first.sha256].exists())
+
+        self.study.delete()
+        self.assertEqual(prune_blobs(before=now()), 0)  # still used by the shared study
+        shared.delete()
+        self.assertEqual(prune_blobs(before=now()), 1)
+        self.assertEqual(list(PdfBlob.objects.values_list('studies', flat=True)), [replaced.id])
+        replaced.refresh_from_db()
+        self.assertEqual([sha256 for sha256, path in paths.items() if path.exists()], [replaced.pdf.sha256])
+
+
+@override_settings(JOB_FILES_ROOT=tempfile.mkdtemp(prefix='sysrev-jobs-test-'))
+class JobFilesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        Study.objects.create(review=self.review, title='Study')
+        self.uploads = os.path.join(settings.JOB_FILES_ROOT, jobs.UPLOADS_DIR)
+
+    def export(self):
+        jobs.enqueue_export(Job.EXPORT_JSON, self.review.id)
+        job = jobs.run_job(jobs.claim_next_job())
+        self.assertEqual(job.status, Job.DONE, job.error)
+        return job
+
+    def test_failed_upload_leaves_no_job(self):
+        class BrokenUpload(io.BytesIO):
+            def read(self, *args):
+                raise OSError('connection lost')
+
+        with self.assertRaises(OSError):
+            jobs.enqueue_import(self.review.id, BrokenUpload())
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(os.listdir(self.uploads), [])
+
+        job = jobs.enqueue_import(self.review.id, io.BytesIO(b'{"studies": [{"title": "Imported"}]}'))
+        self.assertTrue(os.path.exists(job.input_path))
+        jobs.run_job(jobs.claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE, job.error)
+        self.assertFalse(os.path.exists(job.input_path))
+
+    def test_removed_result(self):
+        job = self.export()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(reverse('job-result', args=[job.id]))
+        self.assertEqual(json.loads(b''.join(response.streaming_content))['studies'][0]['title'], 'Study')
+        response.close()
+        os.remove(job.result_path)
+        self.assertEqual(client.get(reverse('job-result', args=[job.id])).status_code, 410)
+
+    def test_fail_stale_jobs(self):
+        for _ in range(3):
+            jobs.enqueue_export(Job.EXPORT_JSON, self.review.id)
+        stale, legacy, alive = jobs.claim_next_job(), jobs.claim_next_job(), jobs.claim_next_job()
+        long_ago = now() - settings.JOB_STALE_AFTER - timedelta(minutes=1)
+        Job.objects.filter(id=stale.id).update(heartbeat_at=long_ago)
+        Job.objects.filter(id=legacy.id).update(heartbeat_at=None, started_at=long_ago)  # claimed before heartbeats
+        jobs.update_progress(alive, rows=10)
+
+        self.assertEqual(jobs.fail_stale_jobs(), 2)
+        self.assertEqual(dict(Job.objects.values_list('id', 'status')), {stale.id: Job.FAILED, legacy.id: Job.FAILED, alive.id: Job.RUNNING})
+        self.assertEqual(Job.objects.get(id=stale.id).error, 'The worker stopped while running the job')
+
+    def test_prune_jobs(self):
+        old, recent = self.export(), self.export()
+        queued = jobs.enqueue_import(self.review.id, io.BytesIO(b'{}'))
+        orphan = os.path.join(self.uploads, 'orphan.json')
+        with open(orphan, 'wb') as file:
+            file.write(b'{}')
+        for path in (orphan, queued.input_path):
+            os.utime(path, (0, 0))
+        Job.objects.filter(id=old.id).update(finished_at=now() - settings.JOB_RETENTION - timedelta(minutes=1))
+
+        self.assertEqual(jobs.prune_jobs(), 1)
+        self.assertEqual(set(Job.objects.values_list('id', flat=True)), {recent.id, queued.id})
+        self.assertFalse(os.path.exists(old.result_path))
+        self.assertTrue(os.path.exists(recent.result_path))
+        self.assertTrue(os.path.exists(queued.input_path))  # still waiting for a worker
+        self.assertFalse(os.path.exists(orphan))
+
+
+@skipUnless(search.is_supported(), 'The database backend has no full-text index')
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.in_title = Study.objects.create(review=self.review, title='Xylophone tuning', abstract='On instruments.')
+        self.in_abstract = Study.objects.create(review=self.review, title='Percussion', abstract='The xylophone and the marimba.')
+        self.by_author = Study.objects.create(review=self.review, title='Harmonics')
+        self.by_author.authors.add(Author.objects.create(review=self.review, name='Ada Xylander'))
+        self.in_body = Study.objects.create(review=self.review, title='Acoustics',
+                                            pdf=PdfBlob.objects.create(sha256='0' * 64, size=1, text='Tuning the glockenspiel bars.'))
+        other = Review.objects.create(name='Other', owner=self.user)
+        Study.objects.create(review=other, title='Xylophone tuning, again')
+
+    def search(self, text, review=None, status=200):
+        response = self.client.get(reverse('study-search'), {'review_id': (review or self.review).id, 'q': text})
+        self.assertEqual(response.status_code, status, response.data)
+        return response.data
+
+    def ids(self, text, review=None):
+        return [result['id'] for result in self.search(text, review)]
+
+    def test_ranking_and_scope(self):
+        # a title match outranks an abstract match, the study of the other review is not returned
+        self.assertEqual(self.ids('xylophone'), [self.in_title.id, self.in_abstract.id])
+        # every word must match, the last one as a prefix
+        self.assertEqual(self.ids('xylophone tun'), [self.in_title.id])
+        self.assertEqual(self.ids('marimba xylo'), [self.in_abstract.id])
+        self.assertEqual(self.ids('...'), [])
+        self.search(' ', status=400)
+
+    def test_highlights(self):
+        [result] = self.search('xylophone tuning')
+        self.assertEqual(result['highlights']['title'], '<mark>Xylophone</mark> <mark>tuning</mark>')
+        [result] = self.search('marimba')
+        self.assertIn('<mark>marimba</mark>', result['highlights']['abstract'])
+        [result] = self.search('xylander')
+        self.assertEqual(result['highlights']['authors'], 'Ada <mark>Xylander</mark>')
+        [result] = self.search('glockenspiel')
+        self.assertEqual(result['id'], self.in_body.id)
+        self.assertIn('<mark>glockenspiel</mark>', result['highlights']['body'])
+
+    def test_index_follows_changes(self):
+        self.in_title.title = 'Vibraphone tuning'
+        self.in_title.save()
+        self.assertEqual(self.ids('xylophone'), [self.in_abstract.id])
+        self.assertEqual(self.ids('vibraphone'), [self.in_title.id])
+
+        self.in_abstract.delete()
+        self.assertEqual(self.ids('marimba'), [])
+
+        self.by_author.authors.clear()
+        self.assertEqual(self.ids('xylander'), [])
+
+        importer = ReviewImporter(self.review.id)
+        importer.run({'studies': [{'title': 'Imported celesta study'}]})
+        self.assertEqual([result['title'] for result in self.search('celesta')], ['Imported celesta study'])
+
+    def test_review_delete(self):
+        other = Study.objects.exclude(review=self.review).get()
+        self.assertEqual(self.client.delete(reverse('review-detail', args=[self.review.id])).status_code, 204)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'SELECT rowid FROM {search.FTS_TABLE}')
+            else:
+                cursor.execute(f'SELECT study_id FROM {search.PG_TABLE}')
+            self.assertEqual([row[0] for row in cursor.fetchall()], [other.id])
+
+    def test_rebuild_command(self):
+        other = Study.objects.exclude(review=self.review).get()
+        search.remove_studies(Study.objects.values_list('id', flat=True))
+
+        call_command('rebuild_search_index', review=self.review.id, stdout=io.StringIO())
+        self.assertEqual(self.ids('xylophone'), [self.in_title.id, self.in_abstract.id])
+        self.assertEqual(self.ids('xylophone', other.review), [])
+
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.ids('xylophone', other.review), [other.id])
+        self.assertEqual(self.ids('xylophone'), [self.in_title.id, self.in_abstract.id])  # not indexed twice
+
+        with self.assertRaisesRegex(CommandError, 'does not exist'):
+            call_command('rebuild_search_index', review=0)
+
+
+class StudyRelationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tags = [Tag.objects.create(review=self.review, name=f'Tag {number}') for number in range(3)]
+        self.authors = [Author.objects.create(review=self.review, name=f'Author {number}') for number in range(3)]
+        other = Review.objects.create(name='Other', owner=self.user)
+        self.other_tag = Tag.objects.create(review=other, name='Elsewhere')
+        self.other_author = Author.objects.create(review=other, name='Someone else')
+        self.url = f"{reverse('study-list')}?review_id={self.review.id}"
+
+    def post(self, data):
+        return self.client.post(self.url, data, format='json')
+
+    def test_other_review_rejected(self):
+        for field, other in (('tags', self.other_tag), ('authors', self.other_author)):
+            data = {'title': 'Linked', 'tags': [], 'authors': [], field: [getattr(self, field)[0].id, other.id]}
+            response = self.post(data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual([str(error) for error in response.data[field]], [f'Invalid pk "{other.id}" - object does not exist.'])
+
+            response = self.post([{'title': 'Fine', 'tags': [], 'authors': []}, {**data, field: [other.id]}])
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data[0], {})
+            self.assertIn(field, response.data[1])
+
+            study = Study.objects.create(review=self.review, title='Existing')
+            response = self.client.patch(f"{reverse('study-detail', args=[study.id])}?review_id={self.review.id}",
+                                         {field: [other.id]}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(getattr(study, field).exists())
+            study.delete()
+        self.assertFalse(Study.objects.exists())
+
+    def test_many_validated_in_one_query_per_model(self):
+        data = [
+            {'title': f'Study {number}', 'review': self.review.id,
+             'tags': [tag.id for tag in self.tags[:number % 3 + 1]], 'authors': [self.authors[number % 3].id]}
+            for number in range(30)
+        ]
+        serializer = StudySerializer(data=data, many=True, context={'review_id': self.review.id})
+        # the review, the tags and the authors, whatever the number of studies
+        with self.assertNumQueries(3):
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+
+        data[7]['tags'].append(self.other_tag.id)
+        serializer = StudySerializer(data=data, many=True, context={'review_id': self.review.id})
+        with self.assertNumQueries(3):
+            self.assertFalse(serializer.is_valid())
+        self.assertEqual([index for index, errors in enumerate(serializer.errors) if errors], [7])
+
+
+class DuplicateDetectionTests(TestCase):
+    def setUp(self):
+        cache.clear()  # responses are cached per review version, and ids are reused between tests
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_import_flags_duplicates(self):
+        original = Study.objects.create(
+            review=self.review, title='Deep learning for screening randomized trials: a systematic review', year=2020,
+        )
+        same_doi = Study.objects.create(review=self.review, title='Citation screening with transformers', doi='10.1234/abc')
+        Study.objects.create(review=self.review, title='Screening randomized trials, part 1')
+
+        response = self.client.post(reverse('review-import') + f'?review_id={self.review.id}', {'studies': [
+            {'title': 'Deep Learning for Screening Randomised Trials - A Systematic Review.', 'year': 2021},
+            {'title': 'Transformers for citation screening', 'doi': 'https://doi.org/10.1234/ABC'},
+            {'title': 'Screening randomized trials, part 2'},
+            {'title': 'An unrelated study of soil bacteria'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['counts']['possible_duplicates'], 2)
+
+        flagged = set(Study.objects.filter(review=self.review).with_flag('Possible Duplicate').values_list('title', flat=True))
+        self.assertEqual(flagged, {'Deep Learning for Screening Randomised Trials - A Systematic Review.', 'Transformers for citation screening'})
+
+        response = self.client.get(reverse('study-duplicates') + f'?review_id={self.review.id}')
+        self.assertEqual(response.status_code, 200)
+        clusters = [[study['id'] for study in cluster['studies']] for cluster in response.data['clusters']]
+        self.assertEqual(len(clusters), 2)
+        self.assertIn(original.id, clusters[0] + clusters[1])
+        self.assertIn(same_doi.id, clusters[0] + clusters[1])
+
+    def test_index_follows_edits(self):
+        first = Study.objects.create(review=self.review, title='Screening heuristics for systematic reviews')
+        second = Study.objects.create(review=self.review, title='A survey of active learning')
+        url = reverse('study-duplicates') + f'?review_id={self.review.id}'
+        self.assertEqual(self.client.get(url).data['count'], 0)
+
+        second.title = 'Screening heuristics for systematic reviews.'
+        second.save()
+        self.assertEqual(self.client.get(url).data['clusters'][0]['studies'][1]['id'], second.id)
+
+        first.delete()
+        self.assertEqual(self.client.get(url).data['count'], 0)
+
+
+class TagAnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.design = Tag.objects.create(review=self.review, name='Design')
+        self.trial = Tag.objects.create(review=self.review, name='Trial', parent_tag=self.design)
+        self.cohort = Tag.objects.create(review=self.review, name='Cohort', parent_tag=self.design)
+        for year, flags, tags in [
+            (2020, ['Flagged'], [self.trial]),
+            (2020, [], [self.trial, self.cohort]),
+            (2021, ['Flagged', 'Important'], [self.cohort]),
+            (None, [], [self.design]),
+            (2021, [], []),
+        ]:
+            Study.objects.create(review=self.review, title='Study', year=year, flags=flags).tags.set(tags)
+
+    def get(self, **params):
+        response = self.client.get(reverse('tag-analytics'), {'review_id': self.review.id, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_tables(self):
+        data = self.get(top=2)
+        self.assertEqual((data['study_count'], data['tagged_count']), (5, 4))
+        self.assertEqual([(tag['name'], tag['count'], tag['coverage']) for tag in data['tags']],
+                         [('Trial', 2, 0.4), ('Cohort', 2, 0.4), ('Design', 1, 0.2)])
+        self.assertEqual(data['cooccurrence'], [[2, 1], [1, 2]])
+        self.assertEqual((data['years'], data['year_totals']), ([2020, 2021], [2, 2]))
+        self.assertEqual(data['tags_by_year'], [[2, 0], [1, 1]])
+        self.assertEqual((data['flags'], data['flag_totals']), (['Flagged', 'Important'], [2, 1]))
+        self.assertEqual(data['tags_by_flag'], [[1, 0], [1, 1]])
+
+        data = self.get(top=1, include_descendants='true')
+        self.assertEqual(data['tags'][0], {'id': self.design.id, 'name': 'Design', 'count': 4, 'coverage': 0.8})
+        self.assertEqual((data['cooccurrence'], data['tags_by_flag']), ([[4]], [[2, 1]]))
+
+        self.assertEqual(self.client.get(reverse('tag-analytics'), {'review_id': self.review.id, 'top': 0}).status_code, 400)
+
+    @skipUnless(analytics.np is not None, 'NumPy is not installed')
+    def test_python_fallback(self):
+        for include_descendants in (False, True):
+            expected = analytics.tag_analytics(self.review.id, include_descendants=include_descendants)
+            numpy, analytics.np = analytics.np, None
+            try:
+                self.assertEqual(analytics.tag_analytics(self.review.id, include_descendants=include_descendants), expected)
+            finally:
+                analytics.np = numpy
+
+    def test_rows_of_tags_deleted_between_reads(self):
+        # the last tag, so its id sorts after every tag read afterwards
+        read_flag_rows = StudyQuerySet.flag_rows
+
+        def delete_tag_then_read(queryset):
+            Tag.objects.filter(id=self.cohort.id).delete()
+            return read_flag_rows(queryset)
+
+        numpy = analytics.np
+        try:
+            for analytics.np in {numpy, None}:
+                for include_descendants in (False, True):
+                    with transaction.atomic():
+                        with mock.patch.object(StudyQuerySet, 'flag_rows', delete_tag_then_read):
+                            data = analytics.tag_analytics(self.review.id, include_descendants=include_descendants)
+                        transaction.set_rollback(True)
+                    self.assertEqual([tag['name'] for tag in data['tags']],
+                                     ['Design', 'Trial'] if include_descendants else ['Trial', 'Design'])
+                    self.assertEqual(data['tags_by_flag'], [[1, 0], [1, 0]] if include_descendants else [[1, 0], [0, 0]])
+        finally:
+            analytics.np = numpy
+
+
+class ChangeFeedTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.review = Review.objects.create(name='Review', owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('review-changes', args=[self.review.id])
+
+    def feed(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_feed(self):
+        kept = Study.objects.create(review=self.review, title='Kept')
+        removed = Study.objects.create(review=self.review, title='Removed')
+        removed_id = removed.id
+        since = self.feed()['seq']
+        self.assertEqual(self.feed(since=since)['changes'], [])
+
+        tag = Tag.objects.create(review=self.review, name='Screening')
+        kept.tags.add(tag)
+        created = Study.objects.create(review=self.review, title='Created', year=2024)
+        created.tags.add(tag)
+        removed.delete()
+        self.client.post(reverse('study-bulk') + f'?review_id={self.review.id}',
+                         {'ids': [kept.id], 'operation': 'add_flags', 'flags': ['Flagged']}, format='json')
+
+        data = self.feed(since=since, fields='id,title,flags,tags_display')
+        self.assertEqual([(change['entity'], change['id'], change['op']) for change in data['changes']], [
+            ('tag', tag.id, 'create'),
+            ('study', created.id, 'create'),
+            ('study', removed_id, 'delete'),
+            ('study', kept.id, 'update'),
+        ])
+        self.assertEqual(data['seq'], ReviewChange.objects.filter(review=self.review).latest('id').id)
+        self.assertEqual([(study['title'], study['flags']) for study in data['studies']], [('Kept', ['Flagged']), ('Created', [])])
+        self.assertEqual(set(data['studies'][1]), {'id', 'title', 'flags', 'tags_display'})
+        self.assertEqual(data['tags'], [{'id': tag.id, 'name': 'Screening', 'description': '', 'parent_tag': None}])
+
+        first = self.feed(since=since, limit=2)
+        self.assertTrue(first['has_more'])
+        rest = self.feed(since=first['seq'])
+        self.assertFalse(rest['has_more'])
+        self.assertEqual(rest['seq'], data['seq'])
+
+        self.assertEqual(changes.prune(), 0)
+        self.assertGreater(changes.prune(before=now()), 0)
+        pruned = self.feed(since=since)
+        self.assertEqual((pruned['reset'], pruned['seq']), (True, data['seq']))
+        self.assertFalse(self.feed(since=pruned['seq'])['reset'])
+
+        self.assertEqual(self.client.get(self.url, {'since': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('review-changes', args=[0])).status_code, 404)
+
+    @override_settings(CHANGE_STREAM_DURATION=0)
+    def test_stream(self):
+        since = self.feed()['seq']
+        study = Study.objects.create(review=self.review, title='Streamed')
+        response = self.client.get(reverse('review-change-stream', args=[self.review.id]), HTTP_LAST_EVENT_ID=str(since))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = b''.join(response.streaming_content).decode().split('\n\n')
+        self.assertEqual(events[0], f'retry: 2000\nid: {since}')
+        event_id, event, data = events[1].split('\n')
+        self.assertEqual((event_id, event), (f'id: {self.feed()["seq"]}', 'event: changes'))
+        self.assertEqual(json.loads(data.removeprefix('data: '))['studies'][0]['id'], study.id)
+
+    def test_review_delete(self):
+        study = Study.objects.create(review=self.review, title='Study')
+        study.tags.add(Tag.objects.create(review=self.review, name='Tag'))
+        self.review.delete()
+        self.assertFalse(ReviewChange.objects.exists())
+
+        Study.objects.create(review=Review.objects.create(name='Other', owner=self.user), title='Study')
+        self.user.delete()
+        self.assertFalse(ReviewChange.objects.exists())
@@ -3,47 +3,65 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework import status, generics
 from rest_framework.decorators import api_view
-from .models import Tag, Study, Author, Review
-from .serializers import TagSerializer, StudySerializer, AuthorSerializer, ReviewSerializer, RegisterSerializer
-from django.db.models import Count
-from collections import Counter
-import csv
-from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from .models import Tag, Study, Author, Review, ReviewChange, Job
+from . import search, jobs, dedupe, analytics, changes
+from .cache import review_cached
+from .changes import record_changes
+from .importer import ReviewImporter, ReviewImportError, BATCH_SIZE
+from .exporters import iter_review_json, iter_review_ndjson, iter_review_csv, CSV_COLUMNS
+from .jsonstream import iter_review_records, iter_ndjson_records, JSONStreamError
+from .extraction import enqueue_extraction
+from .blobs import store_pdf, blob_path, storage_root, parse_range, FileRange, BlobError
+from .serializers import study_pdf_url, TagSerializer, StudySerializer, AuthorSerializer, ReviewSerializer, RegisterSerializer, JobSerializer
+from django.db import transaction
+from django.db.models import Count, Prefetch
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import defaultdict
+import time
+from django.conf import settings
+from django.http import StreamingHttpResponse, FileResponse, HttpResponse, HttpResponseNotModified
+
+
+def is_true(value):
+    '''Boolean query parameters accept true or 1.'''
+    return value in ('true', '1')
 
-import csv
-from django.http import HttpResponse
 
 class ReviewCSVExportView(APIView):
+    '''
+    Exports the studies of a review as CSV, streamed while the studies are read.
+
+    columns=title,year,...   only export these columns, in this order
+    gzip=true                compress the file on the fly (.csv.gz)
+    async=true               queue the export as a background job, see JobView
+    '''
     def get(self, request):
         review_id = request.query_params.get('review_id')
         if not review_id:
             return Response({'error': 'review_id is required'}, status=400)
 
-        studies = Study.objects.filter(review_id=review_id)
-
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="review_{review_id}_export.csv"'
-
-        writer = csv.writer(response)
-        writer.writerow([
-            'Title', 'Year', 'Summary', 'Abstract', 'Flags',
-            'Tags', 'Authors', 'DOI', 'URL', 'Pages'
-        ])
-
-        for study in studies:
-            writer.writerow([
-                study.title,
-                study.year,
-                study.summary,
-                study.abstract,
-                ", ".join(study.flags),
-                ", ".join(tag.name for tag in study.tags.all()),
-                ", ".join(author.name for author in study.authors.all()),
-                study.doi,
-                study.url,
-                study.pages
-            ])
-
+        columns = None
+        if request.query_params.get('columns'):
+            columns = [name.strip() for name in request.query_params['columns'].split(',') if name.strip()]
+            unknown = set(columns) - set(CSV_COLUMNS)
+            if unknown:
+                return Response({'error': f"Unknown column(s): {', '.join(sorted(unknown))}"}, status=400)
+
+        compress = is_true(request.query_params.get('gzip'))
+        if is_true(request.query_params.get('async')):
+            if not Review.objects.filter(id=review_id).exists():
+                return Response({'error': 'Review not found'}, status=404)
+            job = jobs.enqueue_export(Job.EXPORT_CSV, review_id, columns=columns, compress=compress)
+            return Response(JobSerializer(job).data, status=202)
+
+        chunks = iter_review_csv(review_id, columns=columns, compress=compress)
+        if compress:
+            response = StreamingHttpResponse(chunks, content_type='application/gzip')
+            response['Content-Disposition'] = f'attachment; filename="review_{review_id}_export.csv.gz"'
+        else:
+            response = StreamingHttpResponse(chunks, content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="review_{review_id}_export.csv"'
         return response
 
 
@@ -85,7 +103,12 @@ class SysRevView(APIView):
 
         try:
             review = Review.objects.get(id=review_id)
-            review.delete()
+            with transaction.atomic():
+                # the studies go in bulk first, their delete signals would make review.delete() load them
+                # and delete them in batches of 100
+                search.remove_review(review.id)
+                review.studies.all().bulk_delete()
+                review.delete()
             return Response(status=status.HTTP_204_NO_CONTENT)
         except Review.DoesNotExist:
             return Response({'error': 'Review not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -115,21 +138,26 @@ class TagTreeView(APIView):
     '''
         GET retrieves the tag tree or a specific tag by ID.
     '''
+    @review_cached
     def get(self, request, tag_id=None):
         review_id = request.query_params.get('review_id')
         if not review_id:
             return Response({'error': 'review_id is required'}, status=400)
 
+        # depth=N limits the tree to N levels below the roots (or below tag_id)
+        depth = request.query_params.get('depth')
+        if depth is not None:
+            if not depth.isdigit():
+                return Response({'error': 'depth must be a non-negative integer'}, status=400)
+            depth = int(depth)
+
         if tag_id:
-            try:
-                tag = Tag.objects.get(id=tag_id, review_id=review_id)
-                return Response(tag.get_tree())
-            except Tag.DoesNotExist:
+            tree = Tag.build_tree(review_id, root_id=tag_id, depth=depth)
+            if tree is None:
                 return Response({'error': 'Tag not found or not part of this review'}, status=404)
-        else:
-            root_tags = Tag.objects.filter(parent_tag__isnull=True, review_id=review_id)
-            tree = [tag.get_tree() for tag in root_tags]
             return Response(tree)
+        else:
+            return Response(Tag.build_tree(review_id, depth=depth))
         
         
     '''
@@ -196,9 +224,11 @@ class TagTreeView(APIView):
         elif new_parent_id:
             try:
                 new_parent_tag = Tag.objects.get(id=new_parent_id, review_id=review_id)
-                tag.parent_tag = new_parent_tag
             except Tag.DoesNotExist:
                 return Response({'error': 'New parent tag not found in this review.'}, status=404)
+            if tag.is_ancestor_of(new_parent_tag.id):
+                return Response({'error': 'A tag cannot be moved under itself or one of its descendants.'}, status=400)
+            tag.parent_tag = new_parent_tag
 
         serializer = TagSerializer(tag, data={'id': tag.id}, partial=True)
         if serializer.is_valid():
@@ -261,10 +291,92 @@ class TagTreeView(APIView):
         tag.save()
         return Response({'message': 'Tag updated successfully'}, status=200)
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFERRABLE_STUDY_FIELDS = ('summary', 'abstract')
+
+
+def parse_id_list(value, name):
+    '''Parses a comma separated list of ids from a query parameter.'''
+    try:
+        return [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise ValueError(f'{name} must be a comma separated list of ids')
+
+
+def parse_study_fields(value):
+    '''Parses the fields= projection of the study list, None means every field.'''
+    if not value:
+        return None
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = set(fields) - set(StudySerializer.Meta.fields)
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}")
+    return fields
+
+
+def parse_limit(value):
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def encode_cursor(last_id):
+    return urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return int(urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise ValueError('Invalid cursor')
+
+
+def filter_studies(studies, params):
+    '''
+    Applies the study list filters:
+    tag (ids, include_descendants=true to match subtags), flag, author (ids), year_min and year_max.
+    '''
+    if params.get('tag'):
+        tag_ids = parse_id_list(params['tag'], 'tag')
+        if is_true(params.get('include_descendants')):
+            tag_ids = Tag.subtree_ids(params['review_id'], tag_ids)
+        studies = studies.with_tags(tag_ids)
+    if params.get('flag'):
+        studies = studies.with_flag(params['flag'])
+    if params.get('author'):
+        studies = studies.with_authors(parse_id_list(params['author'], 'author'))
+    for param, lookup in (('year_min', 'year__gte'), ('year_max', 'year__lte')):
+        if params.get(param):
+            try:
+                studies = studies.filter(**{lookup: int(params[param])})
+            except ValueError:
+                raise ValueError(f'{param} must be an integer')
+    return studies
+
+
 class StudiesView(APIView):
     '''
     API view for managing studies.
+
+    GET on the list accepts:
+        fields=id,title,...         only serialize these fields
+        tag=1,2                     studies with any of these tags, include_descendants=true adds their subtags
+        flag=Reviewed               studies with this flag
+        author=3,4                  studies by any of these authors
+        year_min=2010&year_max=2020
+        limit=100&cursor=...        keyset pagination, the response becomes {results, next_cursor}
     '''
+    @review_cached
     def get(self, request, study_id=None):
         review_id = request.query_params.get('review_id')
         if not review_id:
@@ -278,9 +390,31 @@ class StudiesView(APIView):
             except Study.DoesNotExist:
                 return Response({'error': 'Study not found'}, status=404)
         else:
-            studies = Study.objects.filter(review_id=review_id)
-            serializer = StudySerializer(studies, many=True)
-            return Response(serializer.data)
+            try:
+                studies = filter_studies(Study.objects.filter(review_id=review_id), request.query_params)
+                fields = parse_study_fields(request.query_params.get('fields'))
+                limit = parse_limit(request.query_params.get('limit'))
+                after_id = decode_cursor(request.query_params.get('cursor'))
+            except ValueError as e:
+                return Response({'error': str(e)}, status=400)
+
+            # long text columns are only read when they are going to be rendered
+            if fields is not None:
+                studies = studies.defer(*(name for name in DEFERRABLE_STUDY_FIELDS if name not in fields))
+            studies = StudySerializer.prefetch(studies.order_by('id'), fields=fields)
+
+            if limit is None and after_id is None:
+                serializer = StudySerializer(studies, many=True, fields=fields)
+                return Response(serializer.data)
+
+            # keyset pagination over the primary key
+            limit = limit or DEFAULT_PAGE_SIZE
+            if after_id is not None:
+                studies = studies.filter(id__gt=after_id)
+            page = list(studies[:limit + 1])
+            next_cursor = encode_cursor(page[limit - 1].id) if len(page) > limit else None
+            serializer = StudySerializer(page[:limit], many=True, fields=fields)
+            return Response({'results': serializer.data, 'next_cursor': next_cursor})
 
     def delete(self, request, study_id=None):
         review_id = request.query_params.get('review_id')
@@ -309,7 +443,7 @@ class StudiesView(APIView):
         else:
             data['review'] = review_id
 
-        serializer = StudySerializer(data=data, many=isinstance(data, list))
+        serializer = StudySerializer(data=data, many=isinstance(data, list), context={'review_id': review_id})
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data, status=201)
@@ -328,30 +462,280 @@ class StudiesView(APIView):
         except Study.DoesNotExist:
             return Response({'error': 'Study not found or does not belong to this review'}, status=404)
 
-        serializer = StudySerializer(study, data=request.data, partial=True)
+        serializer = StudySerializer(study, data=request.data, partial=True, context={'review_id': review_id})
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
         return Response(serializer.errors, status=400)
 
+def filter_params(review_id, data):
+    '''Turns a JSON filter object into the string parameters filter_studies takes, lists become comma separated.'''
+    if not isinstance(data, dict):
+        raise ValueError('filter must be an object')
+    params = {'review_id': review_id}
+    for name, value in data.items():
+        if isinstance(value, list):
+            value = ','.join(str(item) for item in value)
+        elif isinstance(value, bool):
+            value = 'true' if value else 'false'
+        params[name] = str(value)
+    return params
+
+
+class StudyBulkView(APIView):
+    '''
+    Applies one operation to many studies of a review in a single transaction.
+
+    POST /api/studies/bulk/?review_id=1
+    {
+    "ids": [1, 2, 3],                       the studies, or
+    "filter": {"tag": [4], "flag": "Reviewed", "include_descendants": true},
+                                            the studies matching the study list filters
+    "operation": "add_tags",                add_tags, remove_tags (with "tags": [ids]),
+    "tags": [5, 6]                          add_flags, clear_flags (with "flags": [...], clear_flags
+    }                                       without flags clears them all), or delete
+
+    Every operation is one set based statement over the matched studies. The response reports the
+    matched studies and the changed ones, only those are logged in the change feed.
+    '''
+    OPERATIONS = ('add_tags', 'remove_tags', 'add_flags', 'clear_flags', 'delete')
+
+    def post(self, request):
+        review_id = request.query_params.get('review_id')
+        if not review_id:
+            return Response({'error': 'review_id is required'}, status=400)
+        data = request.data
+
+        operation = data.get('operation')
+        if operation not in self.OPERATIONS:
+            return Response({'error': f"operation must be one of: {', '.join(self.OPERATIONS)}"}, status=400)
+
+        if ('ids' in data) == ('filter' in data):
+            return Response({'error': 'Either ids or filter is required.'}, status=400)
+        studies = Study.objects.filter(review_id=review_id)
+        try:
+            if 'ids' in data:
+                ids = data['ids']
+                # bool is an int subclass, true would be read as study 1
+                if not isinstance(ids, list) or not all(type(study_id) is int for study_id in ids):
+                    raise ValueError('ids must be a list of study ids')
+                studies = studies.filter(id__in=ids)
+            else:
+                studies = filter_studies(studies, filter_params(review_id, data['filter']))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+
+        if operation in ('add_tags', 'remove_tags'):
+            tag_ids = data.get('tags')
+            if not isinstance(tag_ids, list) or not tag_ids or not all(type(tag_id) is int for tag_id in tag_ids):
+                return Response({'error': 'tags must be a non-empty list of tag ids'}, status=400)
+            tag_ids = set(tag_ids)
+            if Tag.objects.filter(review_id=review_id, id__in=tag_ids).count() != len(tag_ids):
+                return Response({'error': 'Tags not found in this review.'}, status=400)
+        elif operation in ('add_flags', 'clear_flags'):
+            flags = data.get('flags')
+            if not (operation == 'clear_flags' and flags is None):
+                serializer = StudySerializer(fields=['flags'], data={'flags': flags}, partial=True)
+                if not serializer.is_valid():
+                    return Response(serializer.errors, status=400)
+                if not flags:
+                    return Response({'error': 'flags must be a non-empty list'}, status=400)
+
+        with transaction.atomic():
+            # the set based statements send no signals, the studies they change are listed first to log them
+            if operation == 'delete':
+                study_ids = list(studies.values_list('id', flat=True))
+                matched = len(study_ids)
+                search.remove_studies(study_ids)
+                # by id, the filters may depend on the tag links deleted first
+                Study.objects.filter(id__in=study_ids).bulk_delete()
+            else:
+                matched = studies.count()
+                if operation == 'add_tags':
+                    targets = studies.missing_tags(tag_ids)
+                elif operation == 'remove_tags':
+                    targets = studies.with_tags(tag_ids)
+                else:
+                    targets = studies.flags_changed_by(flags, add=operation == 'add_flags')
+                study_ids = list(targets.values_list('id', flat=True))
+                if study_ids:
+                    if operation == 'add_tags':
+                        studies.add_tags(tag_ids)
+                    elif operation == 'remove_tags':
+                        studies.remove_tags(tag_ids)
+                    elif operation == 'add_flags':
+                        studies.add_flags(flags)
+                    else:
+                        studies.remove_flags(flags)
+            changed = len(study_ids)
+            if study_ids:
+                record_changes(review_id, ReviewChange.STUDY, study_ids,
+                               ReviewChange.DELETE if operation == 'delete' else ReviewChange.UPDATE)
+
+        return Response({'operation': operation, 'matched': matched, 'changed': changed})
+
+class StudyPdfView(APIView):
+    '''
+    The PDF of a study, kept in the content-addressed store (sysrev/blobs.py).
+
+    PUT /api/studies/<id>/pdf/?review_id=1      the raw PDF as the request body, streamed to disk; its text is
+                                                extracted by a background job (extraction_job in the response)
+    GET /api/studies/<id>/pdf/?review_id=1      the file, with Range requests for page by page loading
+                                                and the SHA-256 as a strong ETag for If-None-Match
+    DELETE /api/studies/<id>/pdf/?review_id=1   detaches the PDF from the study
+    '''
+    def get_study(self, request, study_id):
+        review_id = request.query_params.get('review_id')
+        if not review_id:
+            return None, Response({'error': 'review_id is required'}, status=400)
+        try:
+            return Study.objects.select_related('pdf').defer('pdf__text').get(id=study_id, review_id=review_id), None
+        except Study.DoesNotExist:
+            return None, Response({'error': 'Study not found'}, status=404)
+
+    def get(self, request, study_id):
+        study, error = self.get_study(request, study_id)
+        if error:
+            return error
+        if study.pdf is None:
+            return Response({'error': 'The study has no PDF'}, status=404)
+
+        blob = study.pdf
+        etag = f'"{blob.sha256}"'
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Cache-Control': 'private, max-age=31536000, immutable'}
+        if etag in request.headers.get('If-None-Match', ''):
+            return HttpResponseNotModified(headers=headers)
+
+        if settings.PDF_ACCEL_REDIRECT_PREFIX:
+            # the web server serves the file, ranges included
+            response = HttpResponse(content_type='application/pdf', headers=headers)
+            response['X-Accel-Redirect'] = settings.PDF_ACCEL_REDIRECT_PREFIX + str(blob_path(blob.sha256).relative_to(storage_root()))
+            return response
+
+        byte_range = None
+        if request.headers.get('If-Range', etag) == etag:
+            try:
+                byte_range = parse_range(request.headers.get('Range'), blob.size)
+            except ValueError:
+                return HttpResponse(status=416, headers={**headers, 'Content-Range': f'bytes */{blob.size}'})
+
+        file = open(blob_path(blob.sha256), 'rb')
+        if byte_range is None:
+            # a plain file object, sent with wsgi.file_wrapper (sendfile) when the server supports it
+            return FileResponse(file, content_type='application/pdf', headers=headers)
+        start, end = byte_range
+        response = FileResponse(FileRange(file, start, end), status=206, content_type='application/pdf', headers=headers)
+        response['Content-Range'] = f'bytes {start}-{end}/{blob.size}'
+        response['Content-Length'] = end - start + 1
+        return response
+
+    def put(self, request, study_id):
+        study, error = self.get_study(request, study_id)
+        if error:
+            return error
+        if request.stream is None:
+            return Response({'error': 'The request body is empty'}, status=400)
+        try:
+            blob = store_pdf(request.stream)
+        except BlobError as e:
+            return Response({'error': str(e)}, status=400)
+
+        study.pdf = blob
+        study.save(update_fields=['pdf'])
+        job = enqueue_extraction(study)
+        return Response({
+            'sha256': blob.sha256, 'size': blob.size, 'pdf_url': study_pdf_url(study),
+            'extraction_job': JobSerializer(job).data if job else None,
+        })
+
+    def delete(self, request, study_id):
+        study, error = self.get_study(request, study_id)
+        if error:
+            return error
+        study.pdf = None
+        study.save(update_fields=['pdf'])
+        return Response(status=204)
+
+class StudySearchView(APIView):
+    '''
+    Full-text search over study title, abstract, summary, authors and the text of the study's PDF.
+
+    GET /api/studies/search/?review_id=1&q=text&limit=50
+    Results are ranked by relevance and carry highlighted fragments of the matching columns.
+    '''
+    def get(self, request):
+        review_id = request.query_params.get('review_id')
+        if not review_id:
+            return Response({'error': 'review_id is required'}, status=400)
+
+        text = request.query_params.get('q', '')
+        if not text.strip():
+            return Response({'error': 'q is required'}, status=400)
+
+        try:
+            limit = parse_limit(request.query_params.get('limit')) or DEFAULT_PAGE_SIZE
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+
+        return Response(search.search(review_id, text, limit=limit))
+
+class StudyDuplicatesView(APIView):
+    '''
+    Clusters of likely duplicate studies of a review, found through the near-duplicate index (sysrev/dedupe.py).
+
+    GET /api/studies/duplicates/?review_id=1&threshold=0.8
+    Studies are duplicates when they have the same DOI, or a title or abstract similarity of at least threshold.
+    Clusters come largest first, each with the lowest similarity between its linked studies.
+    '''
+    @review_cached
+    def get(self, request):
+        review_id = request.query_params.get('review_id')
+        if not review_id:
+            return Response({'error': 'review_id is required'}, status=400)
+
+        try:
+            threshold = float(request.query_params.get('threshold', dedupe.DEFAULT_THRESHOLD))
+        except ValueError:
+            return Response({'error': 'threshold must be a number'}, status=400)
+        if not 0 < threshold <= 1:
+            return Response({'error': 'threshold must be between 0 and 1'}, status=400)
+
+        clusters = dedupe.find_duplicates(review_id, threshold=threshold)
+        study_ids = [study_id for cluster in clusters for study_id in cluster['study_ids']]
+        studies = {
+            study['id']: study
+            for study in Study.objects.filter(review_id=review_id, id__in=study_ids).values('id', 'title', 'year', 'doi', 'flags')
+        }
+        return Response({
+            'threshold': threshold,
+            'count': len(clusters),
+            'clusters': [
+                {'similarity': cluster['similarity'], 'studies': [studies[study_id] for study_id in cluster['study_ids']]}
+                for cluster in clusters
+            ],
+        })
+
 class AuthorsView(APIView):
     '''
     API view for managing authors.
     '''
+    @review_cached
     def get(self, request, author_id=None):
         review_id = request.query_params.get('review_id')
         if not review_id:
             return Response({'error': 'review_id is required'}, status=400)
 
+        authors = Author.objects.filter(review_id=review_id).prefetch_related(
+            Prefetch('studies', queryset=StudySerializer.prefetch(Study.objects.all()))
+        )
         if author_id:
             try:
-                author = Author.objects.get(id=author_id, review_id=review_id)
+                author = authors.get(id=author_id)
                 serializer = AuthorSerializer(author)
                 return Response(serializer.data)
             except Author.DoesNotExist:
                 return Response({'error': 'Author not found'}, status=404)
         else:
-            authors = Author.objects.filter(review_id=review_id)
             serializer = AuthorSerializer(authors, many=True)
             return Response(serializer.data)
         
@@ -390,6 +774,7 @@ class AuthorsView(APIView):
         return Response({'deleted': found_ids}, status=200)
 
 @api_view(['GET'])
+@review_cached
 def tag_study_counts(request):
     review_id = request.query_params.get('review_id')
     if not review_id:
@@ -399,146 +784,313 @@ def tag_study_counts(request):
         study_count=Count('studies')
     ).values('id', 'name', 'study_count')
 
-    return Response(tags_with_counts)
+    return Response(list(tags_with_counts))
+
+@api_view(['GET'])
+@review_cached
+def tag_tree_study_counts(request):
+    '''The tag tree with the number of studies tagged with each tag (direct_count)
+    and with each tag or any of its descendants (total_count).'''
+    review_id = request.query_params.get('review_id')
+    if not review_id:
+        return Response({'error': 'review_id is required'}, status=400)
+
+    return Response(Tag.build_count_tree(review_id))
 
 @api_view(['GET'])
+@review_cached
 def flag_study_counts(request):
     review_id = request.query_params.get('review_id')
     if not review_id:
         return Response({'error': 'review_id is required'}, status=400)
 
-    counter = Counter()
-    studies = Study.objects.filter(review_id=review_id)
-    for study in studies:
-        for flag in study.flags:
-            counter[flag] += 1
+    return Response(Study.objects.filter(review_id=review_id).flag_counts())
+
+@api_view(['GET'])
+@review_cached
+def tag_analytics(request):
+    '''
+    Tag coverage, co-occurrence, studies per year by tag and tag × flag counts of a review,
+    see sysrev/analytics.py.
+
+    GET /api/tags/analytics/?review_id=1&top=20&include_descendants=true
+    The matrices cover the top most used tags. With include_descendants a study counts for
+    a tag when it is tagged with the tag or any of its descendants.
+    '''
+    review_id = request.query_params.get('review_id')
+    if not review_id:
+        return Response({'error': 'review_id is required'}, status=400)
+
+    try:
+        top = int(request.query_params.get('top', analytics.DEFAULT_TOP))
+    except ValueError:
+        return Response({'error': 'top must be an integer'}, status=400)
+    if not 1 <= top <= analytics.MAX_TOP:
+        return Response({'error': f'top must be between 1 and {analytics.MAX_TOP}'}, status=400)
+
+    return Response(analytics.tag_analytics(
+        review_id, top=top, include_descendants=is_true(request.query_params.get('include_descendants')),
+    ))
+
+
+def change_feed_page(review, since, limit=changes.DEFAULT_LIMIT, fields=None):
+    '''
+    A page of the change feed of a review after since (its head when None), with the current data of the
+    created and updated studies, tags and authors. See ReviewChangesView.
+    '''
+    page = {'seq': since, 'has_more': False, 'reset': False, 'changes': [], 'studies': [], 'tags': [], 'authors': []}
+    result = changes.read_changes(review, since, limit) if since is not None else None
+    if result is None:
+        page['seq'] = changes.head(review)
+        page['reset'] = since is not None
+        return page
+    page['changes'], page['seq'], page['has_more'] = result
+
+    changed_ids = defaultdict(list)
+    for change in page['changes']:
+        if change['op'] != ReviewChange.DELETE:
+            changed_ids[change['entity']].append(change['id'])
+    # objects deleted after their change are left out, their delete comes later in the feed
+    if changed_ids[ReviewChange.STUDY]:
+        studies = Study.objects.filter(review_id=review.id, id__in=changed_ids[ReviewChange.STUDY])
+        if fields is not None:
+            studies = studies.defer(*(name for name in DEFERRABLE_STUDY_FIELDS if name not in fields))
+        studies = StudySerializer.prefetch(studies.order_by('id'), fields=fields)
+        page['studies'] = StudySerializer(studies, many=True, fields=fields).data
+    if changed_ids[ReviewChange.TAG]:
+        page['tags'] = list(Tag.objects.filter(review_id=review.id, id__in=changed_ids[ReviewChange.TAG])
+                            .order_by('id').values('id', 'name', 'description', 'parent_tag'))
+    if changed_ids[ReviewChange.AUTHOR]:
+        page['authors'] = list(Author.objects.filter(review_id=review.id, id__in=changed_ids[ReviewChange.AUTHOR])
+                               .order_by('id').values('id', 'name'))
+    return page
+
+
+def parse_change_feed_params(params, last_event_id=None):
+    '''Parses the since, limit and fields parameters of the change feed, raising ValueError.'''
+    since = last_event_id or params.get('since')
+    if since is not None:
+        if not since.isdigit():
+            raise ValueError('since must be a sequence number')
+        since = int(since)
+    limit = params.get('limit', changes.DEFAULT_LIMIT)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return since, min(limit, changes.MAX_LIMIT), parse_study_fields(params.get('fields'))
+
+
+def get_feed_review(review_id):
+    return Review.objects.filter(id=review_id).only('id', 'changes_pruned_through').first()
+
+
+class ReviewChangesView(APIView):
+    '''
+    The change feed of a review (sysrev/changes.py), so clients keeping a copy of the review apply what changed.
+
+    GET /api/reviews/<id>/changes/                  the head of the feed in seq, read before loading the review
+    GET /api/reviews/<id>/changes/?since=<seq>&limit=500&fields=id,title,...
+        {seq, has_more, reset, changes: [{seq, entity, id, op}], studies, tags, authors}
+        changes come in sequence order, one per object (its last change), entity is study, tag or author
+        and op create, update or delete. studies, tags and authors hold the current data of the created
+        and updated objects, studies with the given fields like the study list.
+        Read again from seq, right away while has_more. With reset=true the changes after since were
+        pruned and the review has to be loaded again, from seq.
+    A deleted tag or author is removed from its studies without a change of the studies.
+    '''
+    def get(self, request, review_id):
+        try:
+            since, limit, fields = parse_change_feed_params(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        review = get_feed_review(review_id)
+        if review is None:
+            return Response({'error': 'Review not found'}, status=404)
+        return Response(change_feed_page(review, since, limit, fields))
+
+
+CHANGE_POLL_INTERVAL = 1
+CHANGE_KEEPALIVE_INTERVAL = 15
+CHANGE_RETRY_MS = 2000
 
-    return Response(counter)
+
+def iter_change_events(review, since, fields=None):
+    '''
+    Server-Sent Events of the changes of a review after since, polled every CHANGE_POLL_INTERVAL
+    seconds until settings.CHANGE_STREAM_DURATION has passed.
+    '''
+    if since is None:
+        since = changes.head(review)
+    renderer = JSONRenderer()
+    # an event without data only sets the id a reconnecting EventSource sends back in Last-Event-ID
+    yield f'retry: {CHANGE_RETRY_MS}\nid: {since}\n\n'
+    deadline = time.monotonic() + settings.CHANGE_STREAM_DURATION
+    last_sent = time.monotonic()
+    while True:
+        page = change_feed_page(review, since, fields=fields)
+        if page['changes'] or page['reset']:
+            since = page['seq']
+            event = 'reset' if page['reset'] else 'changes'
+            yield f'id: {since}\nevent: {event}\ndata: {renderer.render(page).decode()}\n\n'
+            last_sent = time.monotonic()
+            if page['reset']:
+                return
+            if page['has_more']:
+                continue
+        if time.monotonic() >= deadline:
+            return
+        if time.monotonic() - last_sent >= CHANGE_KEEPALIVE_INTERVAL:
+            # a comment, so proxies do not close an idle connection
+            yield ': keepalive\n\n'
+            last_sent = time.monotonic()
+        time.sleep(CHANGE_POLL_INTERVAL)
+
+
+class ReviewChangeStreamView(APIView):
+    '''
+    The change feed of a review as Server-Sent Events, so reviewers see each other's edits as they happen.
+
+    GET /api/reviews/<id>/changes/stream/?since=<seq>&fields=id,title,...
+    Sends a "changes" event whenever the review changes, with a ReviewChangesView page as its data
+    and its seq as its id, or a "reset" event, that ends the stream, when the changes after since
+    were pruned. Without since the stream starts at the head of the feed. The stream is closed after
+    settings.CHANGE_STREAM_DURATION seconds and EventSource reconnects from the last seq it received
+    (the Last-Event-ID header). An open stream holds a server worker, with the default of 0 the
+    response ends after the pending changes and the browser polls every CHANGE_RETRY_MS instead.
+    '''
+    def get(self, request, review_id):
+        try:
+            since, _, fields = parse_change_feed_params(request.query_params, request.headers.get('Last-Event-ID'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        review = get_feed_review(review_id)
+        if review is None:
+            return Response({'error': 'Review not found'}, status=404)
+        response = StreamingHttpResponse(iter_change_events(review, since, fields), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # nginx would otherwise buffer the events
+        return response
 
 
 class ReviewExportView(APIView):
+    '''
+    Exports the tag tree, authors and studies of a review as JSON.
+    The response is streamed while the studies are read, in chunks.
+    export_format=ndjson writes one tag tree, author or study per line instead.
+    async=true queues the export as a background job, see JobView.
+    '''
     def get(self, request):
         review_id = request.query_params.get('review_id')
         if not review_id:
             return Response({'error': 'review_id is required'}, status=400)
 
-        # Serialize tag tree
-        root_tags = Tag.objects.filter(parent_tag__isnull=True, review_id=review_id)
-        def strip_ids(tree):
-            tree.pop('id', None)
-            for child in tree.get('children', []):
-                strip_ids(child)
-            return tree
-        tag_tree = [strip_ids(tag.get_tree()) for tag in root_tags]
+        if is_true(request.query_params.get('async')):
+            if not Review.objects.filter(id=review_id).exists():
+                return Response({'error': 'Review not found'}, status=404)
+            ndjson = request.query_params.get('export_format') == 'ndjson'
+            job = jobs.enqueue_export(Job.EXPORT_JSON, review_id, ndjson=ndjson)
+            return Response(JobSerializer(job).data, status=202)
 
-        # Serialize authors
-        authors = Author.objects.filter(review_id=review_id).values('name')
+        if request.query_params.get('export_format') == 'ndjson':
+            response = StreamingHttpResponse(iter_review_ndjson(review_id), content_type=NDJSON_CONTENT_TYPE)
+            response['Content-Disposition'] = f'attachment; filename="review_{review_id}_export.ndjson"'
+            return response
 
-        # Serialize studies
-        studies = Study.objects.filter(review_id=review_id)
-        study_list = []
-        for study in studies:
-            study_list.append({
-                "title": study.title,
-                "year": study.year,
-                "summary": study.summary,
-                "abstract": study.abstract,
-                "flags": study.flags,
-                "tags": [tag.name for tag in study.tags.all()],
-                "authors": [author.name for author in study.authors.all()],
-                "doi": study.doi,
-                "url": study.url,
-                "pages": study.pages
-            })
-
-        return Response({
-            "tag_tree": tag_tree,
-            "authors": list(authors),
-            "studies": study_list
-        })
+        response = StreamingHttpResponse(iter_review_json(review_id), content_type='application/json')
+        response['Content-Disposition'] = f'attachment; filename="review_{review_id}_export.json"'
+        return response
 
 class ReviewImportView(APIView):
+    '''
+    Imports a review export into the review.
+    The response reports the timings (ms) and row counts of every import phase.
+
+    By default the whole body is parsed and imported in a single transaction.
+    Large files can be streamed instead, and are then committed in batches of batch_size studies:
+        Content-Type: application/x-ndjson    newline delimited export (ReviewExportView export_format=ndjson)
+        stream=true                           the nested JSON export, read incrementally
+    async=true saves the upload and queues it as a background job (always imported in batches), see JobView.
+    '''
     def post(self, request):
         review_id = request.query_params.get('review_id')
         if not review_id:
             return Response({'error': 'review_id is required'}, status=400)
+        if not Review.objects.filter(id=review_id).exists():
+            return Response({'error': 'Review not found'}, status=404)
 
-        data = request.data
-        tag_tree_data = data.get("tag_tree", [])
-        authors_data = data.get("authors", [])
-        studies_data = data.get("studies", [])
-
-        # Importing tag tree
-        def create_tag_from_tree(data, parent=None):
-            name = data["name"].strip()
-            description = (data.get("description") or "").strip()
-
-            tag, _ = Tag.objects.get_or_create(
-                name=name,
-                parent_tag=parent,
-                review_id=review_id,
-                defaults={"description": description}
-            )
-
-            for child in data.get("children", []):
-                create_tag_from_tree(child, parent=tag)
-
-        for tag_data in tag_tree_data:
-            create_tag_from_tree(tag_data)
-
-        # Build a tag lookup (by name + parent) for fast access
-        tag_map = {(tag.name, tag.parent_tag_id): tag for tag in Tag.objects.filter(review_id=review_id)}
-
-        # Importing authors
-        author_map = {}
-        for author in authors_data:
-            name = author["name"].strip()
-            obj, _ = Author.objects.get_or_create(name=name, review_id=review_id)
-            author_map[name] = obj
-
-        # Importing Studies
-        for study_data in studies_data:
-            tag_names = study_data.pop("tags", [])
-            author_names = study_data.pop("authors", [])
-
-            title = study_data.get("title", "").strip()
-            year = study_data.get("year")
-
-            # remaining fields go into defaults
-            study_defaults = {
-                key: study_data[key]
-                for key in study_data
-                if key not in ["tags", "authors"]
-            }
-            study_defaults["review_id"] = review_id
-
-            # Creates or updates the study
-            study, created = Study.objects.get_or_create(
-            title=title,
-            year=year,
-            review_id=review_id,
-            defaults=study_defaults
-            )
-
-            if not created:
-                for key, value in study_defaults.items():
-                    setattr(study, key, value)
-                study.save()
-
-            # Assigns study tags
-            tag_instances = []
-            for tag_name in tag_names:
-                tag_name = tag_name.strip()
-                matching_tags = [t for (name, _), t in tag_map.items() if name == tag_name]
-                if matching_tags:
-                    tag_instances.append(matching_tags[0])
-            study.tags.set(tag_instances)
-
-            # Assigns study authors
-            study.authors.set([
-                author_map[name.strip()]
-                for name in author_names
-                if name.strip() in author_map
-            ])
-
-        return Response({"message": "Review imported successfully."})
\ No newline at end of file
+        ndjson = request.content_type.startswith(NDJSON_CONTENT_TYPE)
+        if is_true(request.query_params.get('async')):
+            try:
+                options = self.batch_options(request)
+            except ReviewImportError as e:
+                return Response({'error': str(e)}, status=400)
+            job = jobs.enqueue_import(review_id, request.stream, ndjson=ndjson, **options)
+            return Response(JobSerializer(job).data, status=202)
+
+        importer = ReviewImporter(review_id)
+        try:
+            if ndjson:
+                report = importer.run_stream(iter_ndjson_records(request.stream), **self.batch_options(request))
+            elif is_true(request.query_params.get('stream')):
+                report = importer.run_stream(iter_review_records(request.stream), **self.batch_options(request))
+            else:
+                report = importer.run(request.data)
+        except (ReviewImportError, JSONStreamError) as e:
+            return Response({'error': str(e), **importer.report()}, status=400)
+
+        return Response({"message": "Review imported successfully.", **report})
+
+    def batch_options(self, request):
+        if request.stream is None:
+            raise ReviewImportError('The request body is empty')
+        try:
+            batch_size = int(request.query_params.get('batch_size', BATCH_SIZE))
+        except ValueError:
+            raise ReviewImportError('batch_size must be an integer')
+        if batch_size < 1:
+            raise ReviewImportError('batch_size must be positive')
+        return {'batch_size': batch_size}
+
+class JobView(APIView):
+    '''
+    Status of background import and export jobs.
+    GET /api/jobs/<id>/ returns the phase, rows processed and, once done, the result_url of the artifact.
+    GET /api/jobs/?review_id= lists the jobs of a review, newest first.
+    '''
+    def get(self, request, job_id=None):
+        if job_id:
+            try:
+                job = Job.objects.get(id=job_id)
+            except Job.DoesNotExist:
+                return Response({'error': 'Job not found'}, status=404)
+            return Response(JobSerializer(job).data)
+
+        review_id = request.query_params.get('review_id')
+        if not review_id:
+            return Response({'error': 'review_id is required'}, status=400)
+        jobs_qs = Job.objects.filter(review_id=review_id).order_by('-id')
+        return Response(JobSerializer(jobs_qs, many=True).data)
+
+class JobResultView(APIView):
+    '''Downloads the file produced by a finished export job.'''
+    def get(self, request, job_id):
+        try:
+            job = Job.objects.get(id=job_id)
+        except Job.DoesNotExist:
+            return Response({'error': 'Job not found'}, status=404)
+        if job.status != Job.DONE or not job.result_path:
+            return Response({'error': 'Job has no result'}, status=404)
+        try:
+            file = open(job.result_path, 'rb')
+        except FileNotFoundError:
+            return Response({'error': 'The job result was removed'}, status=410)
+
+        return FileResponse(
+            file,
+            as_attachment=True,
+            filename=job.result_name,
+            content_type=job.result_content_type,
+        )
@@ -84,7 +84,9 @@ export const columns = (setStudyOpen, setSelectedStudy, setDeleteOpen) => [
                           ? "bg-orange-400"
                           : flag === "Missing Data"
                             ? "bg-red-400"
-                            : "bg-gray-400 hover:bg-gray-500"
+                            : flag === "Possible Duplicate"
+                              ? "bg-violet-400"
+                              : "bg-gray-400 hover:bg-gray-500"
                   }`}
                 >
                   {flag}
@@ -14,7 +14,9 @@ function EditStudyView() {
     const response = await fetch(`http://localhost:8000/api/studies/${id}?review_id=${reviewId}`);
     const data = await response.json();
 
-    if (data.pathto_pdf) {
+    if (data.pdf_url) {
+      setFileUrl(`http://localhost:8000${data.pdf_url}`);
+    } else if (data.pathto_pdf) {
       const filePath = data.pathto_pdf.startsWith("/")
         ? data.pathto_pdf
         : `/${data.pathto_pdf}`;
@@ -75,7 +75,7 @@ export default function StudyForm({ studyid = "", refreshPdf }) {
   const [deleteOpen, setDeleteOpen] = useState(false);
   const { SHOW_CHILD } = TreeSelect;
   const [tags, setTags] = useState(null);
-  const flagslist = ["Reviewed", "Pending Review", "Missing Data", "Flagged"];
+  const flagslist = ["Reviewed", "Pending Review", "Missing Data", "Flagged", "Possible Duplicate"];
   const [addedAuthor, setAddedAuthor] = useState("");
   const reviewId = localStorage.getItem('review_id');
   const navigate = useNavigate();
@@ -211,6 +211,25 @@ export default function StudyForm({ studyid = "", refreshPdf }) {
     return response.json();
   };
 
+  // the file is sent as the raw request body and stored by the backend
+  const uploadPdf = async (file) => {
+    const response = await fetch(
+      `http://127.0.0.1:8000/api/studies/${studyid}/pdf/?review_id=${reviewId}`,
+      {
+        method: "PUT",
+        headers: { "Content-Type": "application/pdf" },
+        body: file,
+      },
+    );
+    if (!response.ok) {
+      toast.error("Error uploading PDF");
+      return;
+    }
+    if (refreshPdf) {
+      refreshPdf();
+    }
+  };
+
   const fetchAuthors = async () => {
     const response = await fetch(`http://localhost:8000/api/authors/?review_id=${reviewId}`);
     const data = await response.json();
@@ -648,6 +667,9 @@ export default function StudyForm({ studyid = "", refreshPdf }) {
                               const file = e.target.files?.[0];
                               if (file) {
                                 form.setValue("pathto_pdf", file.name);
+                                if (studyid) {
+                                  uploadPdf(file);
+                                }
                               }
                             }}
                           />
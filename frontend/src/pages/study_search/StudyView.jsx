@@ -1,4 +1,4 @@
-import { useEffect, useState } from "react";
+import { useEffect, useMemo, useRef, useState } from "react";
 import { DataTable } from "@/components/custom/dataTable/data-table";
 import { columns } from "@/components/custom/dataTable/columns";
 import { Button } from "@/components/ui/button";
@@ -33,34 +33,83 @@ function StudyView() {
   const [selectedStudy, setSelectedStudy] = useState(null);
   const [importFile, setImportFile] = useState(null);
   const [filterBy, setFilterBy] = useState(null);
-  const [flagCount, setFlagCount] = useState([]);
   const [selectedStudyDetail, setSelectedStudyDetail] = useState(null);
+  const changeStream = useRef(null);
 
   const reviewId = localStorage.getItem('review_id');
 
+  // the table does not show abstracts or notes, so they are not requested
+  const tableFields = "id,title,year,authors_display,flags,tags_display";
+
+  const tableRow = (study) => ({
+    id: study.id,
+    title: study.title,
+    year: study.year,
+    authors: study.authors_display.join(", "),
+    flags: study.flags,
+    tags: study.tags_display.map((tag) => tag.name).join(", "),
+  });
+
+  // counted from the table, which holds every study of the review
+  const flagCount = useMemo(() => {
+    const counts = {};
+    tableData.forEach((study) => study.flags.forEach((flag) => {
+      counts[flag] = (counts[flag] || 0) + 1;
+    }));
+    return counts;
+  }, [tableData]);
+
+  // loads the whole table once, then follows the review's change feed so edits,
+  // imports and deletions (also by other reviewers) are applied as they happen
   const fetchStudyData = async () => {
-    const response = await fetch(`http://localhost:8000/api/studies/?review_id=${reviewId}`);
+    changeStream.current?.close();
+    const head = await fetch(`http://localhost:8000/api/reviews/${reviewId}/changes/`);
+    const { seq } = await head.json();
+    const response = await fetch(`http://localhost:8000/api/studies/?review_id=${reviewId}&fields=${tableFields}`);
     const data = await response.json();
-    const refineTable = data.map((study) => ({
-      id: study.id,
-      title: study.title,
-      year: study.year,
-      authors: study.authors_display.join(", "),
-      flags: study.flags,
-      tags: study.tags_display.map((tag) => tag.name).join(", "),
-    }));
-    setTableData(refineTable);
+    setTableData(data.map(tableRow));
     console.log("fetched table data");
+    followChanges(seq);
   };
 
+  const followChanges = (since) => {
+    const stream = new EventSource(
+      `http://localhost:8000/api/reviews/${reviewId}/changes/stream/?since=${since}&fields=${tableFields}`,
+    );
+    stream.addEventListener("changes", (event) => {
+      const page = JSON.parse(event.data);
+      if (page.changes.some((change) => change.entity !== "study")) {
+        // renamed or deleted tags and authors show up in many rows
+        fetchStudyData();
+        return;
+      }
+      const deleted = new Set(
+        page.changes.filter((change) => change.op === "delete").map((change) => change.id),
+      );
+      const changed = new Map(page.studies.map((study) => [study.id, tableRow(study)]));
+      setTableData((rows) => {
+        const kept = rows
+          .filter((row) => !deleted.has(row.id))
+          .map((row) => changed.get(row.id) || row);
+        const present = new Set(kept.map((row) => row.id));
+        return [...kept, ...[...changed.values()].filter((row) => !present.has(row.id))];
+      });
+    });
+    // the changes since the last event were pruned
+    stream.addEventListener("reset", fetchStudyData);
+    changeStream.current = stream;
+  };
+
+  useEffect(() => {
+    fetchStudyData();
+    return () => changeStream.current?.close();
+  }, []);
+
   const deleteStudyData = async (id) => {
     const response = await fetch(`http://localhost:8000/api/studies/${id}/?review_id=${reviewId}`, {
       method: "DELETE",
     });
-    if (response.ok) {
-      fetchStudyData(); // Trigger data re-fetch after deletion
-      fetchFlagCount();
-    } else {
+    if (!response.ok) {
       console.error("Error deleting study:", response.statusText);
     }
     setDeleteOpen(false);
@@ -101,20 +150,11 @@ function StudyView() {
 
   useEffect(() => {
     console.log("Currently on review ",reviewId);
-    fetchStudyData();
-    fetchFlagCount();
     if ((studyOpen || deleteOpen ) && selectedStudy) {
       fetchStudyDetailed(selectedStudy);
     }
   }, [studyOpen, selectedStudy]);
 
-  const fetchFlagCount = async () => {
-    const response = await fetch(`http://localhost:8000/api/flags/count/?review_id=${reviewId}`);
-    const data = await response.json();
-    setFlagCount(data);
-    console.log(data);
-  };
-
   const handleImportSubmit = async () => {
     if (!importFile) {
       setImportFile(null);
@@ -142,9 +182,6 @@ function StudyView() {
       console.error("Failed to read, parse, or submit the file:", error);
     }
 
-    fetchStudyData();
-    fetchFlagCount();
-
     setImportFile(null);
     setImportOpen(false);
   };
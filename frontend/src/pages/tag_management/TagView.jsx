@@ -97,8 +97,11 @@ function TagView() {
     setTags(data);
   };
 
+  // the table does not show abstracts or notes, so they are not requested
+  const tableFields = "id,title,year,authors_display,flags,tags_display";
+
   const fetchStudyData = async () => {
-    const response = await fetch(`http://localhost:8000/api/studies/?review_id=${reviewId}`);
+    const response = await fetch(`http://localhost:8000/api/studies/?review_id=${reviewId}&fields=${tableFields}`);
     const data = await response.json();
 
     const refineTable = data.map((study) => ({